@@ -0,0 +1,367 @@
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+
+import wandb
+
+
+def _snapshot(value):
+    # tensors (possibly on the device) to numpy arrays, containers copied: training keeps appending
+    # to its metric lists while the job waits in the queue
+    if hasattr(value, 'detach'):
+        return value.detach().float().cpu().numpy()
+    if isinstance(value, dict):
+        return {k: _snapshot(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_snapshot(v) for v in value)
+    return value
+
+
+# ------------------ Renderers (run in the artifact process) ------------------ #
+
+def render_prototypes(data, path):
+    """
+    One row per class with the learned prototype of a task.
+
+    Args:
+        data (dict): 'prototypes' (num_classes, C, H, W) array, optional 'titles' (list of class names).
+        path (str): PNG file to write.
+    """
+    import matplotlib.pyplot as plt
+
+    prototypes, titles = data['prototypes'], data.get('titles')
+    fig, ax = plt.subplots(len(prototypes), 1, figsize=(10, 10), squeeze=False)
+    ax = ax.flatten()
+    for i, prototype in enumerate(prototypes):
+        image = prototype.transpose(1, 2, 0)
+        if image.shape[2] == 1:
+            ax[i].imshow(image[:, :, 0], cmap='gray')
+        else:
+            ax[i].imshow(image.clip(0, 1))
+        ax[i].axis('off')
+        if titles is not None:
+            ax[i].set_title(titles[i])
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def render_training_curves(data, path):
+    """
+    Training and validation loss/accuracy curves over training steps (see utils.training_plot).
+
+    Args:
+        data (dict): 'metrics' (the trainer's metric lists), and the options of utils.training_plot:
+            'title', 'alpha', 'baselines', 'show_epochs', 'show_timesteps'.
+        path (str): PNG file to write.
+    """
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import pandas as pd
+
+    metrics, alpha, baselines = data['metrics'], data.get('alpha', 0.05), data.get('baselines')
+    show_epochs, show_timesteps = data.get('show_epochs', False), data.get('show_timesteps', False)
+
+    fig, (loss_ax, acc_ax) = plt.subplots(1,2)
+
+    # if needing to show timesteps, we plot the curves discontinuously:
+    if show_timesteps:
+        # break the single list of metrics into nested sub-lists:
+        timestep_train_losses, timestep_val_losses = [], []
+        timestep_train_accs, timestep_val_accs = [], []
+        timestep_epoch_steps, timestep_soft_losses = [], []
+        prev_ts = 0
+        epoch_steps = np.asarray(metrics['epoch_steps'])
+        for t, ts in enumerate(metrics['CL_timesteps']):
+            timestep_train_losses.append(metrics['train_losses'][prev_ts:ts])
+            timestep_train_accs.append(metrics['train_accs'][prev_ts:ts])
+            # evaluations of this timestep: those at steps in (prev_ts, ts], tasks can have a
+            # different number of them (eval_frequency, early stopping)
+            first, last = np.searchsorted(epoch_steps, [prev_ts, ts], side='right')
+            timestep_val_losses.append(metrics['val_losses'][first:last])
+            timestep_val_accs.append(metrics['val_accs'][first:last])
+            timestep_epoch_steps.append(metrics['epoch_steps'][first:last])
+            if 'soft_losses' in metrics:
+                timestep_soft_losses.append(metrics['soft_losses'][prev_ts:ts])
+            else:
+                timestep_soft_losses.append(None)
+            prev_ts = ts
+    else:
+        # just treat this as one timestep, by making lists of size 1:
+        timestep_train_losses = [metrics['train_losses']]
+        timestep_train_accs = [metrics['train_accs']]
+        timestep_val_losses = [metrics['val_losses']]
+        timestep_val_accs = [metrics['val_accs']]
+        timestep_epoch_steps = [metrics['epoch_steps']]
+        if 'soft_losses' in metrics:
+            timestep_soft_losses = metrics['soft_losses']
+        else:
+            timestep_soft_losses = [None]
+
+    # zip up the individual curves at each timestep:
+    timestep_metrics = zip(timestep_train_losses,
+                          timestep_train_accs,
+                          timestep_val_losses,
+                          timestep_val_accs,
+                          timestep_epoch_steps,
+                          metrics['CL_timesteps'],
+                          timestep_soft_losses)
+
+    for train_losses, train_accs, val_losses, val_accs, epoch_steps, ts, soft_losses in timestep_metrics:
+        ### plot loss:
+        smooth_train_loss = pd.Series(train_losses).ewm(alpha=alpha).mean()
+        steps = np.arange(ts-len(train_losses), ts)
+
+        # train loss is plotted at every step:
+        loss_ax.plot(steps, smooth_train_loss, 'b-', label=f'train loss')
+        # but val loss is plotted at every epoch:
+        loss_ax.plot(epoch_steps, val_losses, 'r-', label=f'val loss')
+
+        ### plot soft loss if given:
+        if soft_losses is not None:
+            smooth_soft_loss = pd.Series(soft_losses).ewm(alpha=alpha).mean()
+            loss_ax.plot(steps, smooth_soft_loss, 'g-', label=f'soft loss')
+
+        ### plot acc:
+        smooth_train_acc = pd.Series(train_accs).ewm(alpha=alpha).mean()
+
+        acc_ax.plot(steps, smooth_train_acc, 'b-', label=f'train acc')
+        acc_ax.plot(epoch_steps, val_accs, 'r-', label=f'val acc')
+
+
+    loss_legend = ['train loss', 'val loss'] if 'soft_loss' not in metrics else ['train loss', 'val loss', 'soft loss']
+    acc_legend = ['train acc', 'val acc']
+
+    loss_ax.legend(loss_legend); loss_ax.set_xlabel(f'Training step'); loss_ax.set_ylabel(f'Loss (CXE)')
+    acc_ax.legend(acc_legend); acc_ax.set_xlabel(f'Training step'); acc_ax.set_ylabel(f'Accuracy')
+
+    # format as percentage on right:
+    acc_ax.yaxis.set_major_formatter(mpl.ticker.PercentFormatter(xmax=1.0))
+    acc_ax.yaxis.tick_right()
+    acc_ax.yaxis.set_label_position('right')
+
+    # optionally, draw lines at baseline accuracy points:
+    if baselines is not None:
+        if type(baselines) is list:
+            for height in baselines:
+                acc_ax.axhline(height, c=[0.8]*3, linestyle=':')
+            # rescale y-axis to accommodate baselines if needed:
+            plt.ylim([0, max(list(smooth_train_acc) + list(metrics['val_accs']) + baselines)+0.05])
+        elif type(baselines) is dict:
+            for name, height in baselines.items():
+                acc_ax.axhline(height, c=[0.8]*3, linestyle=':')
+                # add text label as well:
+                acc_ax.text(0, height+0.002, name, c=[0.6]*3, size=8)
+            plt.ylim([0, max(list(smooth_train_acc) + list(metrics['val_accs']) + [h for h in baselines.values()])+0.05])
+
+    # optionally, draw epoch boundaries
+    if show_epochs:
+        for ax in (loss_ax, acc_ax):
+            for epoch in metrics['epoch_steps']:
+                ax.axvline(epoch, c=[0.9]*3, linestyle=':', zorder=1)
+
+    # and/or CL timesteps:
+    if show_timesteps:
+        for ax in (loss_ax, acc_ax):
+            for epoch in metrics['CL_timesteps']:
+                ax.axvline(epoch, c=[.7,.7,.9], linestyle='--', zorder=0)
+
+
+    plt.suptitle(data.get('title'))
+    plt.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def render_taskwise_accuracy(data, path):
+    """
+    Bar chart of the test accuracy on every task, the accuracies after the previous tasks
+    behind it in red (forgetting).
+
+    Args:
+        data (dict): 'accs' (accuracy per evaluated task), 'task_labels' (one x label per task),
+            'average', optional 'model_name' (labels the average line), 'prev_accs' (list of earlier
+            accuracy lists) and 'baseline_accs'.
+        path (str): PNG file to write.
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    accs, task_labels, average = data['accs'], data['task_labels'], data['average']
+    model_name, prev_accs, baseline_accs = data.get('model_name'), data.get('prev_accs'), data.get('baseline_accs')
+
+    fig = plt.figure()
+    bar_heights = list(accs) + [0]*(len(task_labels) - len(accs))
+    # display bar plot with accuracy on each evaluation task
+    plt.bar(x = range(len(task_labels)), height=bar_heights, zorder=1)
+
+    plt.xticks(range(len(task_labels)), task_labels, rotation='vertical')
+
+    plt.axhline(average, c=[0.4]*3, linestyle=':')
+    if model_name is not None:
+        plt.text(0, average+0.002, f'{model_name} (average)', c=[0.4]*3, size=8)
+
+    if prev_accs:
+        # plot the previous step's accuracies on top
+        # (will show forgetting in red)
+        for p, prev_acc_list in enumerate(prev_accs):
+            plt.bar(x = range(len(prev_acc_list)), height=prev_acc_list, fc='tab:red', zorder=0, alpha=0.5*((p+1)/len(prev_accs)))
+
+    if baseline_accs is not None:
+        for t, acc in enumerate(baseline_accs):
+            plt.plot([t-0.5, t+0.5], [acc, acc], c='black', linestyle='--')
+
+        # show average as well:
+        baseline_avg = np.mean(baseline_accs)
+        plt.axhline(baseline_avg, c=[0.6]*3, linestyle=':')
+        plt.text(0, baseline_avg+0.002, 'baseline average', c=[0.6]*3, size=8)
+
+    plt.ylim([0, 1])
+    fig.savefig(path)
+    plt.close(fig)
+
+
+RENDERERS = {'prototypes': render_prototypes,
+             'training_curves': render_training_curves,
+             'taskwise_accuracy': render_taskwise_accuracy}
+
+
+def render(kind, path, data, wandb_key=None, log=None):
+    """
+    Renders (and uploads) an artifact on the calling thread, for scripts without an ArtifactWriter.
+    """
+    RENDERERS[kind](_snapshot(data), path)
+    if wandb_key is not None and wandb.run is not None:
+        wandb.log({wandb_key: wandb.Image(path), **(log or {})})
+
+
+def plot_artifact(writer, kind, path, data, wandb_key=None, log=None):
+    """
+    Hands the artifact to `writer` (an ArtifactWriter) if given, renders it right away otherwise.
+    """
+    if writer is not None:
+        writer.submit(kind, path, data, wandb_key=wandb_key, log=log)
+    else:
+        render(kind, path, data, wandb_key=wandb_key, log=log)
+
+
+def _serve(jobs, done):
+    # artifact process: render every job, acknowledge it to the parent (with whether the file was written)
+    while True:
+        try:
+            job = pickle.load(jobs)
+        except EOFError:
+            return
+        kind, path, data, wandb_key, log = job
+        try:
+            RENDERERS[kind](data, path)
+            written = True
+        except Exception as error:
+            print(f"Artifact {path} could not be rendered: {error}", file=sys.stderr)
+            written = False
+        pickle.dump((path, wandb_key, log, written), done)
+        done.flush()
+
+
+class ArtifactWriter:
+    """
+    Renders plots in a separate process and logs them through a `metrics.MetricsLogger`, off the
+    training thread.
+
+    `submit` takes plain arrays (tensors are copied to host memory) and returns immediately: the
+    job is handed to a sender thread, rendered by a headless matplotlib (Agg) in a child python
+    process, and the written file is handed by a receiver thread to `metrics_logger`, whose sinks
+    upload it (wandb) or record its path. At most `max_pending` jobs are in flight (queued, in the
+    pipe or being rendered) until the child acknowledges them, beyond that new jobs are dropped
+    (and counted in `dropped`) rather than blocking training.
+
+    Args:
+        metrics_logger (MetricsLogger, optional): Logs the written files, None to only write them.
+        max_pending (int, optional): Maximum number of jobs in flight. Default is 8.
+    """
+    def __init__(self, metrics_logger=None, max_pending=8):
+        self.metrics_logger = metrics_logger
+        self.dropped = 0
+
+        env = {**os.environ, 'MPLBACKEND': 'Agg'}
+        self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._queue = queue.Queue()
+        # one slot per job in flight, released when the child acknowledges it
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._sender = threading.Thread(target=self._send, daemon=True)
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._sender.start()
+        self._receiver.start()
+
+    def submit(self, kind, path, data, wandb_key=None, log=None):
+        """
+        Args:
+            kind (str): Renderer, a key of `RENDERERS`.
+            path (str): File to write.
+            data (dict): Arrays and values passed to the renderer.
+            wandb_key (str, optional): Name under which the image is logged, None to only write the file.
+            log (dict, optional): Extra values logged with the image (e.g. the task).
+
+        Returns:
+            bool: Whether the job was queued.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.dropped += 1
+            return False
+        self._queue.put((kind, os.path.abspath(path), _snapshot(data), wandb_key, log or {}))
+        return True
+
+    def close(self):
+        """
+        Waits for the queued jobs to be rendered and logged, then stops the artifact process.
+        Close it before its `metrics_logger`.
+        """
+        self._queue.put(None)
+        self._sender.join()
+        self._process.wait()
+        self._receiver.join()
+        if self.dropped:
+            print(f"{self.dropped} artifacts were dropped (queue full)")
+
+    def _send(self):
+        alive = True
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if not alive:
+                # keep draining the queue so that submit and close never block
+                self._slots.release()
+                continue
+            try:
+                pickle.dump(job, self._process.stdin)
+                self._process.stdin.flush()
+            except OSError as error:
+                print(f"Artifact process stopped: {error}")
+                self._slots.release()
+                alive = False
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+
+    def _receive(self):
+        while True:
+            try:
+                path, wandb_key, log, written = pickle.load(self._process.stdout)
+            except EOFError:
+                return
+            self._slots.release()
+            if written and wandb_key is not None and self.metrics_logger is not None:
+                self.metrics_logger.log_image(wandb_key, path, log)
+
+
+if __name__ == "__main__":
+    # the pipe to the parent is stdout, anything printed by the renderers goes to stderr
+    jobs, done = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr
+    _serve(jobs, done)
@@ -0,0 +1,70 @@
+# Peak-memory benchmark of segment-wise activation checkpointing (model_config["checkpoint_segments"]).
+# One training step of an unfrozen backbone with LwF-style student re-forwards for the old tasks,
+# each configuration runs in a fresh process so its peak RSS (or peak CUDA memory) can be measured.
+#
+# usage: python benchmarks/activation_checkpointing.py [--backbone resnet50] [--segments 0 2 4 8] [--batch_size 256]
+
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_step(backbone_name, segments, batch_size, image_size, old_tasks, device):
+    from networks.backbones import backbone_registry
+
+    torch.manual_seed(0)
+    backbone = backbone_registry[backbone_name](pretrained=False, device=device)
+    backbone.enable_activation_checkpointing(segments)
+    head = nn.Linear(backbone.num_features, 10).to(device)
+    opt = torch.optim.SGD(list(backbone.parameters()) + list(head.parameters()), lr=1e-3)
+
+    x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    y = torch.randint(0, 10, (batch_size,), device=device)
+
+    if device != "cpu":
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+
+    opt.zero_grad()
+    loss = nn.functional.cross_entropy(head(backbone(x)), y)
+    # the LwF soft loss re-forwards the student once per old task
+    for _ in range(old_tasks):
+        loss = loss + head(backbone(x)).logsumexp(dim=1).mean()
+    loss.backward()
+    opt.step()
+
+    step_time = time.perf_counter() - start
+    if device != "cpu":
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return peak_mb, step_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet50")
+    parser.add_argument("--segments", nargs="+", type=int, default=[0, 2, 4, 8])
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--image_size", type=int, default=64)
+    parser.add_argument("--old_tasks", type=int, default=2)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    print(f"{args.backbone}, batch {args.batch_size}, {args.image_size}x{args.image_size}, {args.old_tasks} LwF re-forwards on {args.device}")
+    print(f"{'segments':>9}{'peak memory (MB)':>18}{'step time (s)':>15}")
+    for segments in args.segments:
+        with ctx.Pool(1) as pool:
+            peak_mb, step_time = pool.apply(run_step, (args.backbone, segments, args.batch_size,
+                                                       args.image_size, args.old_tasks, args.device))
+        print(f"{segments:>9}{peak_mb:>18.0f}{step_time:>15.2f}")
@@ -0,0 +1,56 @@
+# Benchmark of backbone.optimize_for_inference() on CPU:
+# eager fp32 backbone vs. BatchNorm-folded, channels-last frozen copy.
+#
+# usage: python benchmarks/backbone_inference.py [--backbones resnet18 resnet50 ...]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.backbones import backbone_registry
+
+
+def time_forward(model, x, iters, warmup=3):
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(x)
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbones", nargs="+", default=['resnet18', 'reducedresnet18', 'resnet50', 'mobilenetv2', 'efficientnetb0', 'alexnet'])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    print(f"{'backbone':<16}{'eager (ms)':>12}{'optimized (ms)':>16}{'speedup':>10}{'max abs diff':>14}")
+    for name in args.backbones:
+        # weights do not change the timings, skip the download
+        backbone = backbone_registry[name](pretrained=False, device="cpu").eval()
+        optimized = backbone.optimize_for_inference()
+
+        image_size = 224 if name == 'vit' else args.image_size
+        x = torch.randn(args.batch_size, 3, image_size, image_size)
+
+        with torch.no_grad():
+            diff = (backbone(x) - optimized(x)).abs().max().item()
+
+        eager_time = time_forward(backbone, x, args.iters)
+        optimized_time = time_forward(optimized, x, args.iters)
+        print(f"{name:<16}{eager_time*1e3:>12.2f}{optimized_time*1e3:>16.2f}{eager_time/optimized_time:>9.2f}x{diff:>14.2e}")
@@ -0,0 +1,96 @@
+# End-of-task evaluation of a MultitaskModel_Baseline with a frozen backbone over T tasks: the
+# previous test_evaluate_metrics loop (a shuffled DataLoader of batch 16 per seen task through
+# utils.evaluate_model_timed) vs evaluation.ContinualEvaluator (large unshuffled batches, heads
+# applied to the backbone features), without and with the feature cache. The cached evaluator
+# is run at every task boundary, as in a training run, so it only computes the features of the
+# newest test set. The data is synthetic, shaped like the per-task TensorDatasets of
+# utils.setup_dataset. Prints the largest difference between the accuracy matrices.
+#
+# usage: python benchmarks/continual_eval.py [--backbone resnet18] [--tasks 10] [--test_batch_size 512]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evaluation import ContinualEvaluator
+from networks.backbones import backbone_registry
+from networks.networks_baseline import MultitaskModel_Baseline, TaskHead_simple
+from utils import evaluate_model_timed
+
+
+def loop_evaluate(model, test_sets, num_tasks, device, batch_size):
+    accs = []
+    for test_set in test_sets[:num_tasks]:
+        _, acc, _ = evaluate_model_timed(model, DataLoader(test_set, batch_size=batch_size, shuffle=True), device=device)
+        accs.append(acc)
+    return accs
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet18")
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--samples_per_task", type=int, default=1000)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--num_classes", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch size of the previous loop")
+    parser.add_argument("--test_batch_size", type=int, default=512)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    backbone = backbone_registry[args.backbone](pretrained=False, device=device)
+    model = MultitaskModel_Baseline(backbone, device)
+    for param in model.backbone.parameters():
+        param.requires_grad = False
+
+    test_sets = []
+    for t in range(args.tasks):
+        n = args.samples_per_task
+        test_sets.append(TensorDataset(torch.randn(n, 3, args.image_size, args.image_size),
+                                       torch.randint(0, args.num_classes, (n,)), torch.full((n,), t, dtype=torch.long)))
+
+    plain = ContinualEvaluator(test_sets, batch_size=args.test_batch_size)
+    cached = ContinualEvaluator(test_sets, batch_size=args.test_batch_size, cache_features=True)
+
+    totals = {'loop': 0.0, 'evaluator': 0.0, 'cached': 0.0}
+    max_diff = 0.0
+    print(f"{args.backbone}, {args.tasks} tasks x {args.samples_per_task} test samples on {args.device}")
+    print(f"{'task':>6}{'loop (s)':>10}{'evaluator (s)':>15}{'cached (s)':>12}")
+    for t in range(args.tasks):
+        model.add_task(t, TaskHead_simple(input_size=backbone.num_features, num_classes=args.num_classes, device=device))
+        # the heads change between task boundaries, the frozen backbone does not
+        for head in model.task_heads.values():
+            torch.nn.init.normal_(head.classifier.weight, std=0.1)
+
+        loop_accs, loop_time = timed(lambda: loop_evaluate(model, test_sets, t + 1, device, args.batch_size), device)
+        (accs, _), plain_time = timed(lambda: plain.evaluate(model, t + 1, device), device)
+        (cached_accs, _), cached_time = timed(lambda: cached.evaluate(model, t + 1, device), device)
+
+        max_diff = max(max_diff, *[abs(a - b) for a, b in zip(accs, cached_accs)], *[abs(a - b) for a, b in zip(accs, loop_accs)])
+        totals['loop'] += loop_time
+        totals['evaluator'] += plain_time
+        totals['cached'] += cached_time
+        print(f"{t:>6}{loop_time:>10.2f}{plain_time:>15.2f}{cached_time:>12.2f}")
+
+    print(f"{'total':>6}{totals['loop']:>10.2f}{totals['evaluator']:>15.2f}{totals['cached']:>12.2f}")
+    # the loop averages per-batch accuracies of shuffled batches, the evaluator counts samples
+    print(f"largest accuracy difference to the evaluator: {max_diff:.2%}")
@@ -0,0 +1,91 @@
+# Scaling of data-parallel CPU training (gloo) from 1 to N processes on one machine, with the
+# helpers the trainer uses under torchrun: a fixed global batch is sharded across the ranks,
+# gradients are all-reduced before every step and the threads are split between the processes.
+# The model is a backbone + a hypernetwork generating a BatchLinear head, as in HyperCMTL.
+#
+# usage: python benchmarks/data_parallel.py [--backbone reducedresnet18] [--processes 1 2 4] [--steps 30]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distributed import all_reduce_gradients, broadcast_module
+from networks.backbones import backbone_registry
+from networks.hypernetwork import TaskHead_simple
+from networks.metamodules import HyperNetwork_seq
+
+
+class HyperModel(nn.Module):
+    def __init__(self, backbone_name, num_classes=10, emb_size=128):
+        super().__init__()
+        self.backbone = backbone_registry[backbone_name](pretrained=False, device="cpu")
+        self.task_head = TaskHead_simple(input_size=self.backbone.num_features, num_classes=num_classes, device="cpu")
+        self.hyper_emb = nn.Embedding(1, emb_size)
+        self.hypernet = HyperNetwork_seq(hyper_in_features=emb_size, hyper_hidden_layers=2, hyper_hidden_features=256,
+                                         hypo_module=self.task_head)
+
+    def forward(self, x):
+        params = self.hypernet(self.hyper_emb(torch.zeros(1, dtype=torch.long)))
+        return self.task_head(self.backbone(x), params=params)
+
+
+def worker(rank, world_size, args, results):
+    os.environ["MASTER_ADDR"], os.environ["MASTER_PORT"] = "127.0.0.1", str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+    torch.manual_seed(rank)
+    model = HyperModel(args.backbone)
+    broadcast_module(model)
+    opt = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    local_batch = args.batch_size // world_size
+    x = torch.randn(local_batch, 3, args.image_size, args.image_size)
+    y = torch.randint(0, 10, (local_batch,))
+
+    def step():
+        opt.zero_grad()
+        nn.functional.cross_entropy(model(x).squeeze(0), y).backward()
+        all_reduce_gradients(model)
+        opt.step()
+
+    for _ in range(3):
+        step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    if rank == 0:
+        results[world_size] = args.steps / (time.perf_counter() - start)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="reducedresnet18")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--port", type=int, default=29511)
+    args = parser.parse_args()
+
+    results = mp.Manager().dict()
+    for world_size in args.processes:
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size, join=True)
+        args.port += 1
+
+    print(f"{args.backbone}, global batch {args.batch_size}, {args.image_size}x{args.image_size}, {os.cpu_count()} cores")
+    print(f"{'processes':>10}{'steps/sec':>12}{'speedup':>10}")
+    for world_size in args.processes:
+        print(f"{world_size:>10}{results[world_size]:>12.2f}{results[world_size] / results[args.processes[0]]:>9.2f}x")
@@ -0,0 +1,79 @@
+# Cost of training K seeds of HyperCMTL_seq_simple (frozen backbone): K separate models stepped
+# one after the other (as K separate runs would) vs one HyperEnsemble (shared backbone pass,
+# vmapped hypernetworks and heads). Reports the time of one training step over the same batch.
+#
+# usage: python benchmarks/ensemble.py [--backbone resnet18] [--replicas 1 2 5 10] [--device cpu]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.ensemble import HyperEnsemble
+from networks.hypernetwork import HyperCMTL_seq_simple
+
+
+def model_config(backbone):
+    lr_config = {name: 1e-4 for name in ["hyper_emb", "hyper_emb_reg", "backbone", "backbone_reg",
+                                         "task_head", "task_head_reg", "hypernet", "hypernet_reg"]}
+    # weights do not change the timings, skip the download
+    return {"backbone": backbone, "hyper_hidden_features": 256, "hyper_hidden_layers": 6, "frozen_backbone": True,
+            "emb_size": 128, "mean_initialization_emb": 0.5, "std_initialization_emb": 0.1, "lr_config": lr_config,
+            "pretrained": False}
+
+
+def time_steps(models, x, y, steps, device):
+    opts = [torch.optim.AdamW(model.get_optimizer_list()) for model in models]
+
+    def step():
+        for model, opt in zip(models, opts):
+            opt.zero_grad()
+            # the ensemble returns (K, batch, num_classes)
+            pred = model(x, 0).reshape(-1, args.num_classes)
+            loss = nn.functional.cross_entropy(pred, y.repeat(len(pred) // len(y)))
+            loss.backward()
+            opt.step()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet18")
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 5, 10])
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--num_classes", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    y = torch.randint(0, args.num_classes, (args.batch_size,), device=device)
+
+    print(f"{args.backbone} (frozen), batch {args.batch_size}, {args.image_size}x{args.image_size} on {args.device}")
+    print(f"{'replicas':>9}{'separate (ms)':>15}{'ensemble (ms)':>15}{'speedup':>10}")
+    for k in args.replicas:
+        replicas = []
+        for seed in range(k):
+            torch.manual_seed(seed)
+            replicas.append(HyperCMTL_seq_simple(num_tasks=5, num_classes_per_task=args.num_classes,
+                                                 model_config=model_config(args.backbone), device=device).to(device))
+        separate_time = time_steps(replicas, x, y, args.steps, device)
+        ensemble_time = time_steps([HyperEnsemble(replicas).to(device)], x, y, args.steps, device)
+        print(f"{k:>9}{separate_time*1e3:>15.1f}{ensemble_time*1e3:>15.1f}{separate_time/ensemble_time:>9.2f}x")
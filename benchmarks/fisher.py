@@ -0,0 +1,66 @@
+# Diagonal Fisher of a MultitaskModel_Baseline (backbone + one head per task) on a batch mixing
+# the tasks: the per-sample gradients of the vmapped engine (regularizers.compute_fisher with
+# normalization='sample') vs one backward pass per sample, which is the only way to get them with
+# autograd. Reports the time of both and the largest difference between the two estimates.
+#
+# usage: python benchmarks/fisher.py [--backbone reducedresnet18] [--samples 200] [--chunk_size 8 32 64]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.backbones import backbone_registry
+from networks.networks_baseline import MultitaskModel_Baseline, TaskHead_simple
+from regularizers import compute_fisher, compute_fisher_loop
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="reducedresnet18")
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--chunk_size", type=int, nargs="+", default=[8, 32, 64])
+    parser.add_argument("--num_tasks", type=int, default=2)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--num_classes", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    backbone = backbone_registry[args.backbone](pretrained=False, device=device)
+    model = MultitaskModel_Baseline(backbone, device)
+    for t in range(args.num_tasks):
+        model.add_task(t, TaskHead_simple(input_size=backbone.num_features, num_classes=args.num_classes, device=device))
+
+    x = torch.randn(args.samples, 3, args.image_size, args.image_size)
+    y = torch.randint(0, args.num_classes, (args.samples,))
+    task_ids = torch.randint(0, args.num_tasks, (args.samples,))
+    loader = DataLoader(TensorDataset(x, y, task_ids), batch_size=64)
+
+    reference, loop_time = timed(lambda: compute_fisher_loop(model, loader, device, sample_size=args.samples), device)
+    scale = max(f.abs().max() for f in reference.values())
+
+    print(f"{args.backbone}, {args.samples} samples over {args.num_tasks} task heads on {args.device}")
+    print(f"{'method':>16}{'time (s)':>10}{'speedup':>10}{'max rel. diff':>15}")
+    print(f"{'batch-1 loop':>16}{loop_time:>10.2f}{1:>9.2f}x{0:>15.1e}")
+    for chunk_size in args.chunk_size:
+        fisher, vmap_time = timed(lambda: compute_fisher(model, loader, device, sample_size=args.samples, chunk_size=chunk_size, normalization='sample'), device)
+        diff = max((fisher[n] - reference[n]).abs().max() for n in fisher) / scale
+        print(f"{f'vmap chunk {chunk_size}':>16}{vmap_time:>10.2f}{loop_time / vmap_time:>9.2f}x{diff:>15.1e}")
@@ -0,0 +1,65 @@
+# Loader throughput of joint training over T tasks: ConcatDataset of random_split Subsets with the
+# default DataLoader (one __getitem__ per sample, then collate) vs utils.concat_task_datasets +
+# utils.batched_loader (one contiguous tensor set, one vectorized index per batch), and a single
+# task Subset for reference. The data is synthetic, shaped like the per-task TensorDatasets of
+# utils.setup_dataset. Checks that the joint set holds the same samples as the ConcatDataset.
+#
+# usage: python benchmarks/joint_dataset.py [--tasks 10] [--samples_per_task 4500] [--batch_size 128]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import ConcatDataset, DataLoader, TensorDataset, random_split
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import batched_loader, concat_task_datasets
+
+
+def throughput(loader, epochs):
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for x, y, task_ids in loader:
+            samples += len(x)
+    return samples / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--samples_per_task", type=int, default=4500)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    train_sets = []
+    for t in range(args.tasks):
+        n = args.samples_per_task
+        task_dataset = TensorDataset(torch.randn(n, 3, args.image_size, args.image_size),
+                                     torch.randint(0, 10, (n,)), torch.full((n,), t, dtype=torch.long))
+        train_set, _ = random_split(task_dataset, [int(0.9 * n), n - int(0.9 * n)])
+        train_sets.append(train_set)
+
+    concat = ConcatDataset(train_sets)
+    joint = concat_task_datasets(train_sets)
+    same = all(torch.equal(a, b) for a, b in zip(joint[:len(joint)], next(iter(DataLoader(concat, batch_size=len(concat))))))
+
+    results = [
+        ("single task, DataLoader", throughput(DataLoader(train_sets[0], batch_size=args.batch_size, shuffle=True), args.epochs)),
+        ("ConcatDataset, DataLoader", throughput(DataLoader(concat, batch_size=args.batch_size, shuffle=True), args.epochs)),
+        ("single task, batched", throughput(batched_loader(train_sets[0], batch_size=args.batch_size, shuffle=True), args.epochs)),
+        ("joint tensors, batched", throughput(batched_loader(joint, batch_size=args.batch_size, shuffle=True), args.epochs)),
+    ]
+
+    print(f"{args.tasks} tasks x {len(train_sets[0])} samples, batch {args.batch_size}")
+    print(f"{'loader':>28}{'samples/s':>12}")
+    for name, rate in results:
+        print(f"{name:>28}{rate:>12.0f}")
+    print(f"joint set matches ConcatDataset: {same}")
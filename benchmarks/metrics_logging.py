@@ -0,0 +1,85 @@
+# Training throughput with per-step metric logging (`.item()` on every loss + one log call per
+# batch, as the scripts used to do) vs the buffered MetricsLogger (device tensors, read back and
+# written on a background thread every `log_frequency` steps). Metrics go to a local JSONL file.
+#
+# usage: python benchmarks/metrics_logging.py [--backbone resnet18] [--steps 200] [--log_frequency 50] [--device cuda]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import JSONLSink, MetricsLogger
+from networks.backbones import backbone_registry
+
+
+def train_steps(backbone, head, opt, x, y, steps, log):
+    for step in range(steps):
+        opt.zero_grad()
+        pred = head(backbone(x))
+        hard_loss = nn.functional.cross_entropy(pred, y)
+        soft_loss = pred.logsumexp(dim=1).mean() * 0.0
+        total_loss = hard_loss + soft_loss
+        total_loss.backward()
+        opt.step()
+        log(step, hard_loss.detach(), soft_loss.detach(), total_loss.detach(), (pred.argmax(axis=1) == y).float().mean())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet18")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--log_frequency", type=int, default=50)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    backbone = backbone_registry[args.backbone](pretrained=False, device=args.device)
+    head = nn.Linear(backbone.num_features, 10).to(args.device)
+    opt = torch.optim.SGD(list(backbone.parameters()) + list(head.parameters()), lr=1e-3)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=args.device)
+    y = torch.randint(0, 10, (args.batch_size,), device=args.device)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sink = JSONLSink(os.path.join(tmp_dir, "per_step.jsonl"))
+
+        def log_per_step(step, hard_loss, soft_loss, total_loss, accuracy):
+            sink.write({'hard_loss': hard_loss.item(), 'soft_loss': soft_loss.item(), 'train_loss': total_loss.item(),
+                        'train_accuracy': accuracy.item(), 'batch_idx': step})
+
+        metrics_logger = MetricsLogger([JSONLSink(os.path.join(tmp_dir, "buffered.jsonl"))], log_frequency=args.log_frequency)
+
+        def log_buffered(step, hard_loss, soft_loss, total_loss, accuracy):
+            metrics_logger.log_step({'hard_loss': hard_loss, 'soft_loss': soft_loss, 'train_loss': total_loss,
+                                     'train_accuracy': accuracy}, batch_idx=step)
+
+        # warmup
+        train_steps(backbone, head, opt, x, y, 10, lambda *_: None)
+
+        results = {}
+        for name, log in [("per-step .item()", log_per_step), (f"buffered (every {args.log_frequency})", log_buffered)]:
+            if args.device != "cpu":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            train_steps(backbone, head, opt, x, y, args.steps, log)
+            if log is log_buffered:
+                metrics_logger.wait()
+            if args.device != "cpu":
+                torch.cuda.synchronize()
+            results[name] = args.steps / (time.perf_counter() - start)
+        metrics_logger.close()
+        sink.close()
+
+    print(f"{args.backbone}, batch {args.batch_size}, {args.image_size}x{args.image_size} on {args.device}")
+    print(f"{'logging':>24}{'steps/sec':>12}")
+    for name, steps_per_sec in results.items():
+        print(f"{name:>24}{steps_per_sec:>12.2f}")
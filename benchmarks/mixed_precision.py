@@ -0,0 +1,105 @@
+# Mixed precision (training.mixed_precision) vs fp32 on a short synthetic task-incremental run:
+# training throughput and final average accuracy (AA) / forgetting (FM), with LwF distillation on
+# a backbone + one linear head per task. Each task separates a few classes of noisy per-class
+# template images, so the accuracies are meaningful but the run needs no dataset.
+#
+# usage: python benchmarks/mixed_precision.py [--backbone resnet18] [--modes fp32 bf16] [--tasks 3] [--device cpu]
+
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.backbones import backbone_registry
+from trainer import AUTOCAST_DTYPES
+from utils import compute_FM_BWT, distillation_output_loss
+
+
+def make_task(templates, n, noise=0.5):
+    y = torch.randint(len(templates), (n,))
+    return templates[y] + noise * torch.randn(n, *templates.shape[1:]), y
+
+
+def accuracy(backbone, head, x, y, batch_size):
+    backbone.eval()
+    with torch.no_grad():
+        correct = sum((head(backbone(x[i:i+batch_size])).argmax(1) == y[i:i+batch_size]).sum().item()
+                      for i in range(0, len(x), batch_size))
+    backbone.train()
+    return correct / len(x)
+
+
+def run(mode, args, tasks, device):
+    torch.manual_seed(0)
+    dtype = AUTOCAST_DTYPES[None if mode == 'fp32' else mode]
+    backbone = backbone_registry[args.backbone](pretrained=False, device=device)
+    heads = nn.ModuleList([nn.Linear(backbone.num_features, args.classes) for _ in tasks]).to(device)
+    opt = torch.optim.AdamW(list(backbone.parameters()) + list(heads.parameters()), lr=1e-3)
+    scaler = torch.amp.GradScaler(device.type, enabled=mode == 'fp16')
+
+    prev_accs, steps, train_time = [], 0, 0.0
+    teacher = None
+    for t, (x_train, y_train, _, _) in enumerate(tasks):
+        start = time.perf_counter()
+        for _ in range(args.epochs):
+            for i in range(0, len(x_train), args.batch_size):
+                x, y = x_train[i:i+args.batch_size], y_train[i:i+args.batch_size]
+                opt.zero_grad()
+                with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                    features = backbone(x)
+                    loss = nn.functional.cross_entropy(heads[t](features), y)
+                    if teacher is not None:
+                        with torch.no_grad():
+                            old_features = teacher[0](x)
+                        for old_t in range(t):
+                            loss = loss + distillation_output_loss(heads[old_t](features), teacher[1][old_t](old_features), 2.0).mean()
+                scaler.scale(loss).backward()
+                scaler.step(opt)
+                scaler.update()
+                steps += 1
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        train_time += time.perf_counter() - start
+
+        teacher = (deepcopy(backbone).eval(), deepcopy(heads))
+        prev_accs.append([accuracy(backbone, heads[i], tasks[i][2], tasks[i][3], args.batch_size) for i in range(t+1)])
+
+    task_test_accs = prev_accs[-1]
+    FM, _ = compute_FM_BWT(task_test_accs, prev_accs[:-1]) if len(prev_accs) > 1 else (0.0, 0.0)
+    return steps / train_time, np.mean(task_test_accs), FM
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet18")
+    parser.add_argument("--modes", nargs="+", default=["fp32", "bf16"], choices=["fp32", "bf16", "fp16"])
+    parser.add_argument("--tasks", type=int, default=3)
+    parser.add_argument("--classes", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=512)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(1)
+    tasks = []
+    for t in range(args.tasks):
+        templates = torch.randn(args.classes, 3, args.image_size, args.image_size)
+        x_train, y_train = make_task(templates, args.samples)
+        x_test, y_test = make_task(templates, args.samples // 4)
+        tasks.append((x_train.to(device), y_train.to(device), x_test.to(device), y_test.to(device)))
+
+    print(f"{'mode':<8}{'steps/sec':>12}{'AA':>10}{'FM':>10}")
+    for mode in args.modes:
+        steps_per_sec, AA, FM = run(mode, args, tasks, device)
+        print(f"{mode:<8}{steps_per_sec:>12.2f}{AA:>10.2%}{FM:>10.2%}")
@@ -0,0 +1,74 @@
+# Disk usage of a per-task model history: one full state_dict per task vs checkpointing.ModelHistory
+# (content-addressed tensors, unchanged tensors stored once). The model mimics
+# HyperCMTL_seq_prototype_simple: a backbone, a frozen copy of it for the prototypes and a small
+# hypernetwork + task embeddings. Every task perturbs the trainable part.
+#
+# usage: python benchmarks/model_history.py [--backbone resnet18] [--tasks 10] [--frozen_backbone] [--half]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpointing import ModelHistory
+from networks.backbones import backbone_registry
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet18")
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--frozen_backbone", action="store_true")
+    parser.add_argument("--half", action="store_true")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    # weights do not change the sizes, skip the download
+    backbone = backbone_registry[args.backbone](pretrained=False, device="cpu")
+    model = nn.ModuleDict({'backbone': backbone,
+                           'backbone_prototype_frozen': deepcopy(backbone),
+                           'hyper_emb': nn.Embedding(args.tasks, 128),
+                           'hypernet': nn.Sequential(nn.Linear(128, 256), nn.ReLU(), nn.Linear(256, 256))})
+    trainable = [model['hyper_emb'], model['hypernet']] + ([] if args.frozen_backbone else [model['backbone']])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full_dir, history_dir = os.path.join(tmp_dir, 'full'), os.path.join(tmp_dir, 'history')
+        os.makedirs(full_dir)
+        history = ModelHistory(history_dir, half=args.half)
+
+        full_time, history_time = 0.0, 0.0
+        for t in range(args.tasks):
+            with torch.no_grad():
+                for module in trainable:
+                    for p in module.parameters():
+                        p.add_(torch.randn_like(p) * 1e-3)
+            state_dict = {name: tensor.clone() for name, tensor in model.state_dict().items()}
+
+            start = time.perf_counter()
+            torch.save(state_dict, os.path.join(full_dir, f'task_{t}.pt'))
+            full_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            history.add(t, state_dict)
+            history_time += time.perf_counter() - start
+
+        restored = history.load(args.tasks - 1)
+        max_diff = max((restored[name].float() - tensor.float()).abs().max().item() for name, tensor in state_dict.items())
+
+        full_size, history_size = folder_size(full_dir), folder_size(history_dir)
+        print(f"{'format':<16}{'size (MB)':>12}{'write (s)':>12}")
+        print(f"{'full per task':<16}{full_size/2**20:>12.1f}{full_time:>12.2f}")
+        print(f"{'model history':<16}{history_size/2**20:>12.1f}{history_time:>12.2f}")
+        print(f"{full_size/history_size:.1f}x smaller, max abs diff of the last task: {max_diff:.2e}")
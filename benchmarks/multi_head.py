@@ -0,0 +1,107 @@
+# LwF training step of a MultitaskModel_Baseline at task t: student and teacher called once per
+# head (a backbone pass each, as before) vs forward_heads (one backbone pass, the heads in one
+# grouped matmul). Also checks that a mixed-task batch (one task id per sample) gives the logits
+# of each sample's own head.
+#
+# usage: python benchmarks/multi_head.py [--backbone resnet18] [--tasks 2 5 10] [--head simple]
+
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.backbones import backbone_registry
+from networks.networks_baseline import MultitaskModel_Baseline, TaskHead_Baseline, TaskHead_simple
+from utils import distillation_output_loss
+
+
+def build_model(args, num_tasks, device):
+    torch.manual_seed(0)
+    backbone = backbone_registry[args.backbone](pretrained=False, device=device)
+    model = MultitaskModel_Baseline(backbone, device)
+    for t in range(num_tasks):
+        if args.head == 'simple':
+            head = TaskHead_simple(input_size=backbone.num_features, num_classes=args.num_classes, device=device)
+        else:
+            head = TaskHead_Baseline(input_size=backbone.num_features, projection_size=256, num_classes=args.num_classes, device=device)
+        model.add_task(t, head)
+    return model
+
+
+def loop_loss(model, teacher, x, y, t):
+    loss = nn.functional.cross_entropy(model(x, t), y)
+    for old_task_id in range(t):
+        with torch.no_grad():
+            old_pred = teacher(x, old_task_id)
+        loss = loss + distillation_output_loss(model(x, old_task_id), old_pred, 2.0).mean()
+    return loss
+
+
+def fused_loss(model, teacher, x, y, t):
+    pred, *new_prev_preds = model.forward_heads(x, [t, *range(t)])
+    loss = nn.functional.cross_entropy(pred, y)
+    with torch.no_grad():
+        old_preds = teacher.forward_heads(x, list(range(t)))
+    for new_prev_pred, old_pred in zip(new_prev_preds, old_preds):
+        loss = loss + distillation_output_loss(new_prev_pred, old_pred, 2.0).mean()
+    return loss
+
+
+def time_steps(loss_fn, model, teacher, x, y, t, steps, device):
+    opt = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    def step():
+        opt.zero_grad()
+        loss_fn(model, teacher, x, y, t).backward()
+        opt.step()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet18")
+    parser.add_argument("--tasks", type=int, nargs="+", default=[2, 5, 10])
+    parser.add_argument("--head", choices=["simple", "baseline"], default="simple")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--num_classes", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    y = torch.randint(0, args.num_classes, (args.batch_size,), device=device)
+
+    print(f"{args.backbone}, TaskHead_{args.head} heads, batch {args.batch_size} on {args.device}")
+    print(f"{'task':>6}{'per head (ms)':>15}{'fused (ms)':>12}{'speedup':>10}")
+    for num_tasks in args.tasks:
+        t = num_tasks - 1
+        # eval mode: no BatchNorm statistics updates, both versions see the same weights
+        model = build_model(args, num_tasks, device).eval()
+        teacher = deepcopy(model)
+        loop_time = time_steps(loop_loss, deepcopy(model), teacher, x, y, t, args.steps, device)
+        fused_time = time_steps(fused_loss, deepcopy(model), teacher, x, y, t, args.steps, device)
+        print(f"{t:>6}{loop_time * 1e3:>15.1f}{fused_time * 1e3:>12.1f}{loop_time / fused_time:>9.2f}x")
+
+    with torch.no_grad():
+        task_ids = torch.randint(0, num_tasks, (args.batch_size,))
+        mixed = model(x, task_ids)
+        reference = torch.stack([model(x[i:i+1], task_ids[i])[0] for i in range(args.batch_size)])
+    print(f"mixed-task batch, max difference to per-sample heads: {(mixed - reference).abs().max():.1e}")
@@ -0,0 +1,122 @@
+# Per-step cost of the EWC/SI penalty on a MultitaskModel_Baseline_notaskid: the per-parameter
+# loop differentiated by autograd (ewc_loss, as the baselines computed it before) vs the flat
+# buffers of regularizers.py (penalty value + gradient added to the flat gradient buffer).
+# Reports the time of the regularizer alone (value and gradient) and checks both give the same
+# gradients. Then the same for the SI path integral: clones of the parameters before every step
+# and a loop over them after it vs the optimizer step hooks of regularizers.PathIntegral, which
+# must accumulate exactly the same W.
+#
+# usage: python benchmarks/regularizer_penalty.py [--backbone resnet50] [--steps 50] [--device cpu]
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.backbones import backbone_registry
+from networks.networks_baseline import MultitaskModel_Baseline_notaskid, TaskHead_simple
+from regularizers import FlatParameters, QuadraticPenalty, PathIntegral
+
+
+def ewc_loss(model, old_params, fisher, ewc_lambda):
+    loss = 0.0
+    for n, p in model.named_parameters():
+        if p.requires_grad and n in old_params:
+            loss += (fisher[n] * (p - old_params[n]).pow(2)).sum()
+    return ewc_lambda * loss
+
+
+def timed(step, steps, device):
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet50")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--ewc_lambda", type=float, default=5000)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    backbone = backbone_registry[args.backbone](pretrained=False, device=device)
+    model = MultitaskModel_Baseline_notaskid(backbone, device)
+    model.add_task(0, TaskHead_simple(input_size=backbone.num_features, num_classes=10, device=device))
+    params = [p for p in model.parameters() if p.requires_grad]
+
+    old_params = {n: p.detach() + 0.01 * torch.randn_like(p) for n, p in model.named_parameters() if p.requires_grad}
+    fisher = {n: torch.rand_like(p) for n, p in model.named_parameters() if p.requires_grad}
+
+    def loop_step():
+        for p in params:
+            p.grad = None
+        ewc_loss(model, old_params, fisher, args.ewc_lambda).backward()
+
+    loop_time = timed(loop_step, args.steps, device)
+    loop_grads = torch.cat([p.grad.reshape(-1) for p in params])
+
+    flat = FlatParameters(model)
+    penalty = QuadraticPenalty(flat, args.ewc_lambda)
+    penalty.set(flat.flatten(old_params), flat.flatten(fisher))
+
+    def flat_step():
+        flat.grads.zero_()
+        penalty.value()
+        penalty.add_grad()
+
+    flat_time = timed(flat_step, args.steps, device)
+    diff = (flat.grads - loop_grads).abs().max() / loop_grads.abs().max()
+
+    print(f"{args.backbone}: {len(params)} tensors, {flat.params.numel() / 1e6:.1f}M parameters on {args.device}")
+    print(f"{'penalty':>18}{'ms/step':>10}{'speedup':>10}")
+    print(f"{'per-param loop':>18}{loop_time * 1e3:>10.2f}{1:>9.2f}x")
+    print(f"{'flat buffers':>18}{flat_time * 1e3:>10.2f}{loop_time / flat_time:>9.2f}x")
+    print(f"max relative gradient difference: {diff:.1e}")
+
+    # SI path integral over optimizer steps on random gradients
+    optimizer = torch.optim.AdamW(params, lr=1e-3)
+    grads = [torch.randn_like(flat.grads) for _ in range(4)]
+    W_loop = {n: torch.zeros_like(p) for n, p in zip(flat.names, params)}
+
+    def loop_path_step(i=[0]):
+        flat.grads.copy_(grads[i[0] % len(grads)])
+        i[0] += 1
+        pre_update_params = {n: p.data.clone() for n, p in zip(flat.names, params)}
+        optimizer.step()
+        # the baseline SIStrategy.after_step, unchanged
+        for n, p in zip(flat.names, params):
+            W_loop[n] += (p.data - pre_update_params[n]) * p.grad.data
+
+    start_state = flat.params.clone()
+    loop_path_time = timed(loop_path_step, args.steps, device)
+
+    flat.params.copy_(start_state)
+    optimizer = torch.optim.AdamW(params, lr=1e-3)
+    path_integral = PathIntegral(flat, optimizer)
+
+    def hook_path_step(i=[0]):
+        flat.grads.copy_(grads[i[0] % len(grads)])
+        i[0] += 1
+        optimizer.step()
+
+    hook_path_time = timed(hook_path_step, args.steps, device)
+    identical = torch.equal(path_integral.W, flat.flatten(W_loop))
+
+    print(f"{'SI path integral':>18}{'ms/step':>10}{'speedup':>10}")
+    print(f"{'clones + loop':>18}{loop_path_time * 1e3:>10.2f}{1:>9.2f}x")
+    print(f"{'step hooks':>18}{hook_path_time * 1e3:>10.2f}{loop_path_time / hook_path_time:>9.2f}x")
+    print(f"identical W: {identical}")
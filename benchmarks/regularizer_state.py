@@ -0,0 +1,65 @@
+# Memory of the EWC/SI regularizer state (anchor + importance) in every storage format of
+# regularizers.QuadraticPenalty, and the error each one makes on the penalty and its gradient
+# compared to fp32. The importance is a heavy-tailed synthetic Fisher (squared Gaussian
+# gradients), the parameters are moved away from the anchor as during a later task.
+#
+# The effect on AA/FM is measured by training with the same options (regularizer_anchor_dtype,
+# regularizer_importance in configs/baseline_ewc.py / baseline_si.py): the trainer logs both
+# after every task, and the strategies log the size of their state.
+#
+# usage: python benchmarks/regularizer_state.py [--backbone resnet50] [--drift 1e-3] [--device cpu]
+
+import argparse
+import os
+import sys
+
+import torch
+
+# Add the project root directory to PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networks.backbones import backbone_registry
+from networks.networks_baseline import MultitaskModel_Baseline_notaskid, TaskHead_simple
+from regularizers import FlatParameters, QuadraticPenalty
+
+FORMATS = [(None, None), ('bf16', None), ('fp16', None), (None, 'int8'), ('fp16', 'int8'),
+           (None, 'topk'), ('fp16', 'topk')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", default="resnet50")
+    parser.add_argument("--drift", type=float, default=1e-3, help="Std of the parameter change since the anchor")
+    parser.add_argument("--topk_fraction", type=float, default=0.1)
+    parser.add_argument("--block_size", type=int, default=256)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    backbone = backbone_registry[args.backbone](pretrained=False, device=device)
+    model = MultitaskModel_Baseline_notaskid(backbone, device)
+    model.add_task(0, TaskHead_simple(input_size=backbone.num_features, num_classes=10, device=device))
+    flat = FlatParameters(model)
+
+    anchor = flat.params.clone()
+    importance = torch.randn_like(anchor).pow(2) * torch.rand_like(anchor).pow(4)
+    flat.params.add_(args.drift * torch.randn_like(anchor))
+
+    results = {}
+    for anchor_dtype, importance_format in FORMATS:
+        penalty = QuadraticPenalty(flat, 1.0, anchor_dtype=anchor_dtype, importance_format=importance_format,
+                                   topk_fraction=args.topk_fraction, block_size=args.block_size)
+        penalty.set(anchor.clone(), importance.clone())
+        flat.grads.zero_()
+        penalty.add_grad()
+        results[(anchor_dtype, importance_format)] = (penalty.nbytes(), penalty.value().item(), flat.grads.clone())
+
+    full_bytes, full_value, full_grad = results[(None, None)]
+    print(f"{args.backbone}: {flat.params.numel() / 1e6:.1f}M trainable parameters, drift {args.drift} on {args.device}")
+    print(f"{'anchor':>8}{'importance':>12}{'state (MB)':>12}{'saving':>9}{'penalty err':>13}{'grad err':>10}")
+    for (anchor_dtype, importance_format), (nbytes, value, grad) in results.items():
+        value_error = abs(value - full_value) / abs(full_value)
+        grad_error = ((grad - full_grad).norm() / full_grad.norm()).item()
+        print(f"{anchor_dtype or 'fp32':>8}{importance_format or 'fp32':>12}{nbytes / 2**20:>12.1f}"
+              f"{full_bytes / nbytes:>8.2f}x{value_error:>13.1e}{grad_error:>10.1e}")
@@ -0,0 +1,239 @@
+import glob
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+from functools import partial
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    """
+    Returns the state of every random number generator used during training (python, numpy,
+    torch CPU and CUDA), so a resumed run draws the same dataloader orders and initializations.
+    """
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    # written to a temporary file and renamed, so a crash never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def snapshot_to_cpu(obj):
+    """
+    Copies every tensor of a (nested) state to the host, so it can be written while training
+    keeps updating the originals.
+
+    Device tensors are copied asynchronously into pinned memory: the copies are ordered on the
+    current stream before any later update, and `CheckpointWriter` waits for them in its own
+    thread, so the training loop is not blocked by the transfer.
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cuda':
+            copy = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return copy.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread.
+
+    `save` snapshots the state to host memory and returns immediately, the file is serialized
+    by the writer thread (written to a temporary file and renamed, so a crash never leaves a
+    truncated checkpoint behind). At most `max_pending` checkpoints wait in memory, `save`
+    blocks beyond that.
+
+    Args:
+        checkpoint_dir (str): Folder where the checkpoints are written.
+        max_pending (int, optional): Maximum number of checkpoints waiting to be written. Default is 1.
+    """
+    def __init__(self, checkpoint_dir, max_pending=1):
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def save(self, state, filename):
+        """
+        Args:
+            state (dict): Checkpoint content (tensors may live on the device).
+            filename (str): File name inside `checkpoint_dir`.
+        """
+        self.submit(state, partial(atomic_save, path=os.path.join(self.checkpoint_dir, filename)))
+
+    def submit(self, state, write_fn):
+        """
+        Snapshots `state` to host memory and calls `write_fn(state)` on the writer thread.
+        """
+        state = snapshot_to_cpu(state)
+        copy_done = torch.cuda.Event() if torch.cuda.is_available() else None
+        if copy_done is not None:
+            copy_done.record()
+        self._queue.put((state, write_fn, copy_done))
+
+    def wait(self):
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, write_fn, copy_done = item
+            try:
+                if copy_done is not None:
+                    copy_done.synchronize()
+                write_fn(state)
+            except Exception as error:
+                print(f"Checkpoint could not be written: {error}")
+            finally:
+                self._queue.task_done()
+
+
+def find_checkpoint(path):
+    """
+    Resolves the checkpoint to resume from.
+
+    Args:
+        path (str): A checkpoint file, or the results folder of a run (or its `checkpoints`
+            folder), in which case the most recently written checkpoint is used.
+
+    Returns:
+        str: Path of the checkpoint file.
+    """
+    if os.path.isfile(path):
+        return path
+    candidates = glob.glob(os.path.join(path, '*.pt')) + glob.glob(os.path.join(path, 'checkpoints', '*.pt'))
+    if not candidates:
+        raise FileNotFoundError(f"No checkpoint found in {path}")
+    return max(candidates, key=os.path.getmtime)
+
+
+def load_checkpoint(path):
+    return torch.load(find_checkpoint(path), map_location='cpu', weights_only=False)
+
+
+def tensor_digest(tensor):
+    """
+    Content hash of a (CPU) tensor: dtype, shape and raw bytes.
+    """
+    tensor = tensor.detach().contiguous()
+    digest = hashlib.sha1(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+    digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class ModelHistory:
+    """
+    Per-task model history with content-addressed tensors.
+
+    Every tensor is stored once, the first time its content is seen: frozen or unchanged tensors
+    (e.g. a frozen backbone, or `backbone_prototype_frozen` that starts as a copy of the backbone)
+    are shared by every task, and each task only adds the tensors that changed since (embeddings,
+    hypernetwork, fine-tuned backbone, ...). A 10-task history takes about one full model plus
+    the deltas.
+
+    Layout of `history_dir`:
+
+        blobs/task_<t>.pt       tensors first seen at task t, keyed by their digest
+        task_<t>.json           manifest, name -> [digest, blob, dtype] for the whole state dict
+
+    Blobs are memory-mapped when a task is loaded, so only the tensors that are read are paged in.
+
+    Args:
+        history_dir (str): Folder of the history (existing manifests are indexed, so a resumed
+            run keeps deduplicating against the tasks already stored).
+        half (bool, optional): Store the changed floating point tensors of every task after the
+            first one in fp16. They are cast back to their dtype when loaded. Default is False.
+    """
+    def __init__(self, history_dir, half=False):
+        self.history_dir = history_dir
+        self.half = half
+        os.makedirs(os.path.join(history_dir, 'blobs'), exist_ok=True)
+
+        # digest -> blob file holding it
+        self._blobs = {}
+        for t in self.tasks():
+            for digest, blob, _ in self.manifest(t).values():
+                self._blobs.setdefault(digest, blob)
+
+    def tasks(self):
+        manifests = glob.glob(os.path.join(self.history_dir, 'task_*.json'))
+        return sorted(int(os.path.basename(path)[len('task_'):-len('.json')]) for path in manifests)
+
+    def manifest(self, t):
+        with open(os.path.join(self.history_dir, f'task_{t}.json')) as f:
+            return json.load(f)
+
+    def add(self, t, state_dict):
+        """
+        Stores the model state after task t.
+
+        Args:
+            t (int): Task id.
+            state_dict (dict): State dict of CPU tensors (e.g. snapshotted by `CheckpointWriter.submit`).
+        """
+        blob = f'task_{t}.pt'
+        half = self.half and len(self._blobs) > 0
+        new_tensors, manifest = {}, {}
+        for name, tensor in state_dict.items():
+            digest = tensor_digest(tensor)
+            if digest not in self._blobs and digest not in new_tensors:
+                new_tensors[digest] = tensor.half() if half and tensor.is_floating_point() else tensor
+            manifest[name] = [digest, self._blobs.get(digest, blob), str(tensor.dtype).replace('torch.', '')]
+
+        # the blob goes first, a manifest never points to a missing blob
+        atomic_save(new_tensors, os.path.join(self.history_dir, 'blobs', blob))
+        tmp_path = os.path.join(self.history_dir, f'task_{t}.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.history_dir, f'task_{t}.json'))
+
+        for digest in new_tensors:
+            self._blobs[digest] = blob
+
+    def load(self, t):
+        """
+        Returns:
+            dict: State dict of the model after task t (CPU tensors, memory-mapped unless they
+                were stored in fp16 and cast back).
+        """
+        blobs = {}
+        state_dict = {}
+        for name, (digest, blob, dtype) in self.manifest(t).items():
+            if blob not in blobs:
+                blobs[blob] = torch.load(os.path.join(self.history_dir, 'blobs', blob), map_location='cpu', mmap=True, weights_only=True)
+            state_dict[name] = blobs[blob][digest].to(getattr(torch, dtype))
+        return state_dict
@@ -48,8 +48,6 @@ training_config = {
     "epochs_per_timestep": 12,  # Number of epochs per timestep (task).
     "temperature": 2.0,  # Temperature for distillation loss (used in knowledge distillation).
     "stability": 3,  # Stability weight for soft distillation loss.
-    "weight_hard_loss_prototypes": 0.2,  # Weight for the hard loss applied to the prototypes.
-    "weight_soft_loss_prototypes": 0.05,  # Weight for the soft loss applied to the prototypes.
     "weight_smoothness_loss": 0,
     "optimizer": "AdamW",  # Optimizer used for training. AdamW is used here.
 }
@@ -22,19 +22,32 @@ model_config = {
     "backbone": "BACKBONE",  # Backbone architecture used for the model (e.g., "resnet50").
     "task_head_projection_size": 512,  # The size of the task-specific projection layer.}
     "frozen_backbone": FREEZE_BKBN,  # Whether to freeze the backbone during training.
+    "checkpoint_segments": 0,  # Segment-wise activation checkpointing of the backbone (0 = off).
 }
 
 # 3. Training Parameters
 # -----------------------
 training_config = {
     "epochs_per_timestep": 12,  # Number of epochs per timestep (task).
+    "checkpoint_frequency": 5,  # Epochs between mid-task checkpoints (0 = only at task boundaries, None = no checkpoints).
+    "resume": None,  # Checkpoint file or results folder of a previous run to continue from.
+    "mixed_precision": None,  # Autocast dtype of the training forward: "bf16", "fp16" or None (fp32). Weights stay in fp32.
+    "micro_batch_size": None,  # Split every BATCH_SIZE batch into micro-batches of this size and accumulate their gradients (None = no split).
+    "early_stopping_patience": None,  # Stop a task after this many evaluations without validation accuracy improvement (None = train every epoch).
+    "early_stopping_min_delta": 0.0,  # Minimum validation accuracy increase counted as an improvement.
+    "restore_best_weights": True,  # With early stopping, restore the weights of the best evaluated epoch at the end of each task.
+    "threads_per_process": None,  # Intra-op threads of each process under torchrun (None = an equal share of the cores).
     "lr": 1e-4,  # Learning rate for the optimizer (can be tuned via Optuna).
     "l2_reg": 1e-6,  # L2 regularization coefficient (currently unused).
     "temperature": 2.0,  # Temperature for distillation loss (used in knowledge distillation).
     "stability": 3,  # Stability weight for soft distillation loss.
-    "ewc_lambda": 5000,  # Lambda hyperparameter for EWC.
+    "ewc_lambda": 5000,  # Lambda hyperparameter for EWC (unused by SI, tuned for the "batch" Fisher normalization).
     "si_epsilon": 1e-5,  # Epsilon hyperparameter for SI.
     "si_lambda": 1.0,  # Lambda hyperparameter for SI.
+    "regularizer_anchor_dtype": None,  # Store the anchor parameters of the penalty in "fp16" or "bf16" (None = fp32).
+    "regularizer_importance": None,  # Store the importance (Fisher / Omega) as "int8" (blockwise quantized) or "topk" (largest values only), None = fp32.
+    "regularizer_topk_fraction": 0.1,  # Fraction of the importance values kept with "topk".
+    "regularizer_block_size": 256,  # Values sharing one quantization scale with "int8".
     "weight_hard_loss_prototypes": 0.2,  # Weight for the hard loss applied to the prototypes.
     "weight_soft_loss_prototypes": 0.05,  # Weight for the soft loss applied to the prototypes.
     #"freeze_backbone": FREEZE_BKBN,  # Whether to freeze the backbone during training.
@@ -55,6 +68,10 @@ logging_config = {
     "results_dir": "results",  # Folder to save the results.
     "name": name,  # or SI_Baseline pr SI_Baseline
     "group": "SI",  # Group name for the experiment.    
+    "log_frequency": 50,  # Number of training steps aggregated into each logged value (metrics are read back asynchronously).
+    "metric_sinks": ["wandb"],  # Where metrics are written: "wandb", "jsonl" and/or "sqlite" (local files in the results folder).
+    "model_history": False,  # Keep the model after every task in the results folder (unchanged tensors stored once).
+    "model_history_half": False,  # Store the per-task deltas of the model history in fp16.
 }
 
 # 6. Miscellaneous Parameters
@@ -69,6 +86,9 @@ misc_config = {
 evaluation_config = {
     "eval_frequency": 1,  # Frequency of evaluation (e.g., every epoch).
     "plot_results": True,  # Whether to plot results after each timestep.
+    "quantized_inference": False,  # Also evaluate an int8 CPU copy of the model (static backbone, dynamic heads).
+    "test_batch_size": 512,  # Batch size of the end-of-task evaluation on the test sets (unshuffled).
+    "cache_test_features": True,  # Reuse the test set features of a frozen backbone across tasks.
 }
 
 
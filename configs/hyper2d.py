@@ -46,10 +46,16 @@ model_config = {
 # -----------------------
 training_config = {
     "epochs_per_timestep": 15,  # Number of epochs per timestep (task).
+    "checkpoint_frequency": 5,  # Epochs between mid-task checkpoints (0 = only at task boundaries, None = no checkpoints).
+    "resume": None,  # Checkpoint file or results folder of a previous run to continue from.
+    "mixed_precision": None,  # Autocast dtype of the training forward: "bf16", "fp16" or None (fp32). Weights stay in fp32.
+    "micro_batch_size": None,  # Split every BATCH_SIZE batch into micro-batches of this size and accumulate their gradients (None = no split).
+    "early_stopping_patience": None,  # Stop a task after this many evaluations without validation accuracy improvement (None = train every epoch).
+    "early_stopping_min_delta": 0.0,  # Minimum validation accuracy increase counted as an improvement.
+    "restore_best_weights": True,  # With early stopping, restore the weights of the best evaluated epoch at the end of each task.
+    "threads_per_process": None,  # Intra-op threads of each process under torchrun (None = an equal share of the cores).
     "temperature": 2.0,  # Temperature for distillation loss (used in knowledge distillation).
     "stability": 3,  # Stability weight for soft distillation loss.
-    "weight_hard_loss_prototypes": 0.2,  # Weight for the hard loss applied to the prototypes.
-    "weight_soft_loss_prototypes": 0.05,  # Weight for the soft loss applied to the prototypes.
     "weight_smoothness_loss": 0,
     "optimizer": "AdamW",  # Optimizer used for training. AdamW is used here.
 }
@@ -67,7 +73,11 @@ logging_config = {
     "verbose": True,  # Whether to show detailed logs for each epoch.
     "results_dir": "results",  # Folder to save the results.
     "name": name,  # or EWC_Baseline pr SI_Baseline,
-    "group": "Hyper2d"
+    "group": "Hyper2d",
+    "log_frequency": 50,  # Number of training steps aggregated into each logged value (metrics are read back asynchronously).
+    "metric_sinks": ["wandb"],  # Where metrics are written: "wandb", "jsonl" and/or "sqlite" (local files in the results folder).
+    "model_history": False,  # Keep the model after every task in the results folder (unchanged tensors stored once).
+    "model_history_half": False,  # Store the per-task deltas of the model history in fp16.
 }
 
 # 6. Miscellaneous Parameters
@@ -82,6 +92,21 @@ misc_config = {
 evaluation_config = {
     "eval_frequency": 1,  # Frequency of evaluation (e.g., every epoch).
     "plot_results": True,  # Whether to plot results after each timestep.
+    "prototype_plot_frequency": 5,  # Render the learned prototypes (in the artifact process) every N validation evaluations of a task (None = never).
+    "test_batch_size": 512,  # Batch size of the end-of-task evaluation on the test sets (unshuffled).
+    "cache_test_features": True,  # Reuse the test set features of a frozen backbone across tasks.
+}
+
+# 8. Hyperparameter Search (optuna_train_hyper2d.py)
+# --------------------------------------------------
+optuna_config = {
+    "n_trials": 30,  # Number of finished (complete or pruned) trials in the study, including those of earlier runs.
+    "n_workers": 1,  # Trials run in parallel, one process each (sharing the dataset in memory).
+    "storage": None,  # Optuna storage URL. Defaults to a SQLite file in the results folder, so the search can resume.
+    "study_name": None,  # Defaults to the logging name.
+    "pruner": "median",  # "median" stops trials whose accuracy after a task is below the median of earlier trials, None disables pruning.
+    "n_startup_trials": 5,  # Trials that run to completion before the pruner starts.
+    "n_warmup_tasks": 1,  # Number of first tasks after which trials are never pruned (their accuracy is too noisy).
 }
 
 
@@ -94,4 +119,5 @@ config = {
     "logging": logging_config,
     "misc": misc_config,
     "evaluation": evaluation_config,
+    "optuna": optuna_config,
 }
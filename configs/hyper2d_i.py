@@ -48,8 +48,6 @@ training_config = {
     "epochs_per_timestep": 12,  # Number of epochs per timestep (task).
     "temperature": 2.0,  # Temperature for distillation loss (used in knowledge distillation).
     "stability": 3,  # Stability weight for soft distillation loss.
-    "weight_hard_loss_prototypes": 0.2,  # Weight for the hard loss applied to the prototypes.
-    "weight_soft_loss_prototypes": 0.05,  # Weight for the soft loss applied to the prototypes.
     "weight_smoothness_loss": 0,
     "optimizer": "AdamW",  # Optimizer used for training. AdamW is used here.
 }
@@ -82,6 +80,9 @@ misc_config = {
 evaluation_config = {
     "eval_frequency": 1,  # Frequency of evaluation (e.g., every epoch).
     "plot_results": True,  # Whether to plot results after each timestep.
+    "prototype_plot_frequency": 5,  # Render the learned prototypes (in the artifact process) every N validation evaluations of a task (None = never).
+    "test_batch_size": 512,  # Batch size of the end-of-task evaluation on the test sets (unshuffled).
+    "cache_test_features": True,  # Reuse the test set features of a frozen backbone across tasks.
 }
 
 
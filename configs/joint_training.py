@@ -22,6 +22,7 @@ model_config = {
     "backbone": "BACKBONE",  # Backbone architecture used for the model (e.g., "resnet50").
     "task_head_projection_size": 512,  # The size of the task-specific projection layer.}
      "frozen_backbone": FREEZE_BKBN,  # Whether to freeze the backbone during training.
+     "checkpoint_segments": 0,  # Segment-wise activation checkpointing of the backbone (0 = off).
 }
 
 # 3. Training Parameters
@@ -0,0 +1,91 @@
+import os
+import time
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(config):
+    """
+    Joins the process group when the script is started by a local launcher, e.g.
+
+        torchrun --standalone --nproc_per_node 4 train_hyper.py configs/hyper.py
+
+    Processes communicate over gloo (CPU). Every rank gets `training.threads_per_process` intra-op
+    threads, by default an equal share of the machine's cores. Without a launcher (WORLD_SIZE
+    unset or 1) nothing happens and training runs in a single process.
+
+    Returns:
+        tuple: Rank of the process and number of processes.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend='gloo')
+
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        threads = config['training'].get('threads_per_process', None) or max(1, os.cpu_count() // local_world_size)
+        torch.set_num_threads(threads)
+    return get_rank(), get_world_size()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def run_timestamp():
+    """
+    Timestamp used in the run name, identical on every rank so they share the results folder.
+    """
+    timestamp = [time.strftime("%Y%m%d-%H%M%S")]
+    if get_world_size() > 1:
+        dist.broadcast_object_list(timestamp, src=0)
+    return timestamp[0]
+
+
+def broadcast_module(module):
+    """
+    Copies the parameters and buffers of rank 0 to every rank (e.g. after a task head was
+    randomly initialized).
+    """
+    if get_world_size() == 1:
+        return
+    with torch.no_grad():
+        for tensor in module.state_dict().values():
+            dist.broadcast(tensor, src=0)
+
+
+def all_reduce_mean(tensors):
+    """
+    Averages a list of tensors across ranks in place, with a single flattened all-reduce per dtype.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    for dtype in {tensor.dtype for tensor in tensors}:
+        group = [tensor for tensor in tensors if tensor.dtype == dtype]
+        flat = _flatten_dense_tensors(group)
+        dist.all_reduce(flat)
+        flat /= world_size
+        for tensor, reduced in zip(group, _unflatten_dense_tensors(flat, group)):
+            tensor.copy_(reduced)
+
+
+def all_reduce_gradients(module):
+    all_reduce_mean([p.grad for p in module.parameters() if p.grad is not None])
+
+
+def average_buffers(module):
+    """
+    Averages the floating point buffers (BatchNorm running statistics) that every rank updated
+    on its own shard of the data.
+    """
+    all_reduce_mean([buffer for buffer in module.buffers() if buffer.is_floating_point()])
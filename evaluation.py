@@ -0,0 +1,166 @@
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from utils import dataset_tensors
+
+
+class ContinualEvaluator:
+    """
+    End-of-task evaluation of a continual model on the test sets of the tasks seen so far.
+
+    Every test set is gathered once into contiguous tensors and run in large unshuffled batches
+    (`batch_size`), and the correct predictions are counted on the device, so there is one host
+    sync per test set instead of one per batch. Models that expose `backbone_features(x)` and
+    `task_classifier(task_id, prototypes=None)` get their task classifier built once per test
+    set (for the hypernetwork models: the head weights are generated once, not once per batch);
+    other models (e.g. the int8 QuantizedMultitaskModel) are called as `model(x, task_id)` or
+    `model(x, prototypes, task_id)`.
+
+    With `cache_features`, the backbone features of every test set are kept on the device and
+    reused at the next task boundaries, as long as the backbone is frozen: none of its
+    parameters requires grad and its buffers (BatchNorm running statistics) are unchanged since
+    the features were computed. Otherwise they are recomputed, so the accuracies are always
+    those of the current model.
+
+    The accuracy of a test set is the fraction of its samples classified correctly, which does
+    not depend on the batch size or order. The time is the average forward time per batch; for
+    cached features it is the backbone time measured when they were computed plus the current
+    head time.
+
+    Args:
+        test_sets (list[Dataset]): Test set of every task, in task order.
+        batch_size (int, optional): Evaluation batch size. Default is 512.
+        cache_features (bool, optional): Reuse the backbone features of a frozen backbone. Default is False.
+    """
+    def __init__(self, test_sets, batch_size=512, cache_features=False):
+        self.test_sets = list(test_sets)
+        self.batch_size = batch_size
+        self.cache_features = cache_features
+        self._tensors = {}
+        # test set index -> (features, labels, task id, backbone time per batch), valid for _cache_key
+        self._features = {}
+        self._cache_key = None
+
+    def tensors(self, t):
+        """Images, labels and task id of test set t, gathered once (None if it is not tensor-backed)."""
+        if t not in self._tensors:
+            try:
+                x, y, task_ids = dataset_tensors(self.test_sets[t])
+                self._tensors[t] = (x, y, int(task_ids[0]))
+            except TypeError:
+                self._tensors[t] = None
+        return self._tensors[t]
+
+    def batches(self, t):
+        """Yields the (x, y, task_id) batches of test set t, in order."""
+        tensors = self.tensors(t)
+        if tensors is None:
+            for x, y, task_ids in DataLoader(self.test_sets[t], batch_size=self.batch_size, shuffle=False):
+                yield x, y, int(task_ids[0])
+            return
+        x, y, task_id = tensors
+        for start in range(0, len(y), self.batch_size):
+            yield x[start:start + self.batch_size], y[start:start + self.batch_size], task_id
+
+    def backbone_state(self, model):
+        """Snapshot of a frozen backbone's buffers, None if the backbone is being trained."""
+        backbone = getattr(model, 'backbone', None)
+        if backbone is None or any(p.requires_grad for p in backbone.parameters()):
+            return None
+        return [buffer.detach().clone() for buffer in backbone.buffers()]
+
+    def cache_valid(self, model):
+        """True if the cached features were computed by this model's backbone, still frozen and unchanged."""
+        if self._cache_key is None:
+            return False
+        model_id, buffers = self._cache_key
+        if model_id != id(model) or any(p.requires_grad for p in model.backbone.parameters()):
+            return False
+        current = list(model.backbone.buffers())
+        return (len(current) == len(buffers)
+                and all(torch.equal(a, b) for a, b in zip(current, buffers)))
+
+    def features(self, model, t, device):
+        """Backbone features and labels of test set t (on the device), its task id and the backbone time per batch."""
+        if t not in self._features:
+            features, labels, times = [], [], []
+            for x, y, task_id in self.batches(t):
+                x = x.to(device, non_blocking=True)
+                start_time = time.time()
+                features.append(model.backbone_features(x))
+                times.append(time.time() - start_time)
+                labels.append(y.to(device, non_blocking=True))
+            self._features[t] = (torch.cat(features), torch.cat(labels), task_id, np.mean(times))
+        return self._features[t]
+
+    def evaluate_features(self, model, t, device, prototypes):
+        features, labels, task_id, backbone_time = self.features(model, t, device)
+        start_time = time.time()
+        classifier = model.task_classifier(task_id, prototypes)
+        correct = torch.zeros((), dtype=torch.long, device=device)
+        num_batches = 0
+        for start in range(0, len(labels), self.batch_size):
+            pred = classifier(features[start:start + self.batch_size])
+            correct += (pred.argmax(dim=1) == labels[start:start + self.batch_size]).sum()
+            num_batches += 1
+        head_time = (time.time() - start_time) / num_batches
+        return correct.item() / len(labels), backbone_time + head_time
+
+    def evaluate_forward(self, model, t, device, prototypes):
+        correct = torch.zeros((), dtype=torch.long, device=device)
+        num_samples, times = 0, []
+        classifier = None
+        for x, y, task_id in self.batches(t):
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            start_time = time.time()
+            if hasattr(model, 'task_classifier'):
+                if classifier is None:
+                    classifier = model.task_classifier(task_id, prototypes)
+                pred = classifier(model.backbone_features(x))
+            else:
+                pred = model(x, prototypes, task_id) if prototypes is not None else model(x, task_id)
+            times.append(time.time() - start_time)
+            correct += (pred.argmax(dim=1) == y).sum()
+            num_samples += len(y)
+        return correct.item() / num_samples, np.mean(times)
+
+    def evaluate(self, model, num_tasks, device, task_prototypes=None, use_cache=True):
+        """
+        Accuracy of the model on the test sets of the first `num_tasks` tasks.
+
+        Args:
+            model (nn.Module): Model to evaluate, restored to its previous train/eval mode afterwards.
+            num_tasks (int): Number of test sets to evaluate.
+            device (torch.device): Device to run on.
+            task_prototypes (list[torch.Tensor], optional): Prototypes of every task, for the prototype models.
+            use_cache (bool, optional): Allow the feature cache (with `cache_features`). Default is True.
+
+        Returns:
+            tuple: Accuracy and average inference time per batch of every test set.
+        """
+        was_training = model.training
+        model.eval()
+
+        use_cache = use_cache and self.cache_features and hasattr(model, 'backbone_features')
+        if use_cache and not self.cache_valid(model):
+            self._features = {}
+            state = self.backbone_state(model)
+            self._cache_key = (id(model), state) if state is not None else None
+        use_cache = use_cache and self._cache_key is not None
+
+        accs, times = [], []
+        with torch.no_grad():
+            for t in range(num_tasks):
+                prototypes = task_prototypes[t].to(device) if task_prototypes is not None else None
+                if use_cache:
+                    acc, time_inf = self.evaluate_features(model, t, device, prototypes)
+                else:
+                    acc, time_inf = self.evaluate_forward(model, t, device, prototypes)
+                accs.append(acc)
+                times.append(time_inf)
+
+        model.train(was_training)
+        return accs, times
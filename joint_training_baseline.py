@@ -75,6 +75,9 @@ backbone_name = config["model"]["backbone"]
 backbone = backbone_dict[backbone_name](device=config["misc"]["device"], pretrained=False)
 logger.log(f"Using backbone: {backbone_name}")
 
+# Optional segment-wise activation checkpointing of the backbone (trades recomputation for memory)
+backbone.enable_activation_checkpointing(config["model"].get("checkpoint_segments", 0))
+
 # Freeze backbone if specified
 if config["model"]["frozen_backbone"]:
     for param in backbone.parameters():
@@ -88,12 +91,12 @@ train_datasets = [train_set for train_set, _ in data["timestep_tasks"].values()]
 val_datasets = [val_set for _, val_set in data["timestep_tasks"].values()]
 logger.log(f"Number of training samples per task: {[len(ds) for ds in train_datasets]}")
 logger.log(f"Number of validation samples: {[len(ds) for ds in val_datasets]}")
-joint_train_dataset = ConcatDataset(train_datasets)
-joint_val_dataset = ConcatDataset(val_datasets)
+joint_train_dataset = concat_task_datasets(train_datasets)
+joint_val_dataset = concat_task_datasets(val_datasets)
 logger.log(f"Number of training samples after concatenation: {len(joint_train_dataset)}")
 logger.log(f"Number of validation samples after concatenation: {len(joint_val_dataset)}")
-joint_train_loader = DataLoader(joint_train_dataset, batch_size=config["dataset"]["BATCH_SIZE"], shuffle=True)
-joint_val_loader = DataLoader(joint_val_dataset, batch_size=config["dataset"]["BATCH_SIZE"], shuffle=False)
+joint_train_loader = batched_loader(joint_train_dataset, batch_size=config["dataset"]["BATCH_SIZE"], shuffle=True)
+joint_val_loader = batched_loader(joint_val_dataset, batch_size=config["dataset"]["BATCH_SIZE"], shuffle=False)
 logger.log("Joint training and validation datasets created")
 logger.log("Number of training samples: {}".format(len(joint_train_dataset)))
 logger.log("Number of validation samples: {}".format(len(joint_val_dataset)))
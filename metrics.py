@@ -0,0 +1,252 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import torch
+import wandb
+
+
+def _to_python(value):
+    # numpy scalars / arrays and tensors (e.g. test accuracies) to plain python values
+    if isinstance(value, torch.Tensor):
+        return value.tolist()
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_python(v) for v in value]
+    return value
+
+
+class WandbSink:
+    """
+    Forwards every record to the active wandb run.
+    """
+    def write(self, record):
+        wandb.log(record)
+
+    def write_image(self, name, path, record):
+        wandb.log({name: wandb.Image(path), **record})
+
+    def close(self):
+        pass
+
+
+class JSONLSink:
+    """
+    Appends every record as one JSON line to a local file, for offline runs.
+
+    Args:
+        path (str): File to append to.
+    """
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def write_image(self, name, path, record):
+        # only the path of the image file is recorded
+        self.write({name: path, **record})
+
+    def close(self):
+        self.file.close()
+
+
+class SQLiteSink:
+    """
+    Writes every record to a local SQLite database, one row per (step, name) in the `metrics`
+    table. Scalars are stored as numbers, anything else (e.g. per-task accuracy lists) as JSON.
+
+    Args:
+        path (str): Database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def write(self, record):
+        # connected lazily, sqlite connections are bound to the thread that creates them
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metrics (step INTEGER, time REAL, name TEXT, value)")
+        step, timestamp = record.get("step"), time.time()
+        rows = [(step, timestamp, name, value if isinstance(value, (int, float)) else json.dumps(value))
+                for name, value in record.items()]
+        self.connection.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def write_image(self, name, path, record):
+        # only the path of the image file is recorded
+        self.write({name: path, **record})
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+def build_sinks(names, results_dir):
+    """
+    Builds metric sinks from their names.
+
+    Args:
+        names (list[str]): Any of 'wandb', 'jsonl' and 'sqlite'.
+        results_dir (str): Folder of the run, where the local sinks write `metrics.jsonl` / `metrics.db`.
+
+    Returns:
+        list: Metric sinks.
+    """
+    sinks = []
+    for name in names:
+        if name == "wandb":
+            sinks.append(WandbSink())
+        elif name == "jsonl":
+            sinks.append(JSONLSink(os.path.join(results_dir, "metrics.jsonl")))
+        elif name == "sqlite":
+            sinks.append(SQLiteSink(os.path.join(results_dir, "metrics.db")))
+        else:
+            raise ValueError(f"Unknown metric sink: {name}")
+    return sinks
+
+
+class MetricsLogger:
+    """
+    Buffered, asynchronous metric logging for the training hot loop.
+
+    Per-step metrics are kept as device tensors and never read back in the training loop.
+    Every `log_frequency` steps they are stacked (on device) and handed to a background thread,
+    which copies them to the host, averages them over the window and writes one record to every
+    sink. Training only synchronizes with the device when the thread reads the stacked values,
+    and never waits on the sinks.
+
+    The per-step values are also kept, on the device and in the training thread, until
+    `pop_history` reads them (e.g. for the training curves); reading them synchronizes with the
+    device but does not wait on the sinks.
+
+    Args:
+        sinks (list): Metric sinks (see `build_sinks`).
+        log_frequency (int, optional): Number of steps aggregated into each record. Default is 50.
+    """
+    def __init__(self, sinks, log_frequency=50):
+        self.sinks = sinks
+        self.log_frequency = max(int(log_frequency), 1)
+
+        self.step = 0
+        self._history = {}
+        # last aggregated values, for progress bars
+        self.last = {}
+
+        self._buffer = {}
+        self._context = {}
+        self._window_start = time.perf_counter()
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def log_step(self, values, **context):
+        """
+        Buffers the metrics of one training step.
+
+        Args:
+            values (dict[str, torch.Tensor | float]): Scalar metrics of the step, may live on the device.
+            **context: Host values describing the step (epoch, task_id, batch_idx, ...), the last
+                ones of the window are logged with the aggregated record.
+        """
+        for name, value in values.items():
+            self._buffer.setdefault(name, []).append(torch.as_tensor(value).detach().float().reshape(()))
+        self._context = context
+        self.step += 1
+
+        if len(next(iter(self._buffer.values()))) >= self.log_frequency:
+            self.flush_steps()
+
+    def flush_steps(self):
+        """
+        Hands the buffered steps to the background thread. Does not block.
+        """
+        if not self._buffer:
+            return
+        now = time.perf_counter()
+        num_steps = len(next(iter(self._buffer.values())))
+        stacked = {name: torch.stack(values) for name, values in self._buffer.items()}
+        context = {**self._context, 'step': self.step, 'steps_per_sec': num_steps / max(now - self._window_start, 1e-9)}
+
+        for name, values in stacked.items():
+            self._history.setdefault(name, []).append(values)
+        self._queue.put(("steps", stacked, context))
+        self._buffer = {}
+        self._window_start = now
+
+    def log(self, record):
+        """
+        Logs a record of host values (validation / test metrics) right after the pending steps.
+        """
+        self.flush_steps()
+        self._queue.put(("record", {**record, 'step': self.step}, None))
+
+    def log_image(self, name, path, record=None):
+        """
+        Logs an image file (e.g. a plot written by the artifact process) with a record of host
+        values. Can be called from any thread, the pending steps are not flushed.
+        """
+        self._queue.put(("image", {**(record or {}), 'step': self.step}, (name, path)))
+
+    def wait(self):
+        """
+        Flushes the pending steps and blocks until every record has been written.
+        """
+        self.flush_steps()
+        self._queue.join()
+
+    def pop_history(self):
+        """
+        Returns the per-step values logged so far and clears them. Does not wait on the sinks.
+
+        Returns:
+            dict[str, list[float]]: Per-step values of every metric, in step order.
+        """
+        self.flush_steps()
+        history, self._history = self._history, {}
+        return {name: torch.cat(values).tolist() for name, values in history.items()}
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # closed from the writer thread, which owns the sqlite connection
+                for sink in self.sinks:
+                    sink.close()
+                self._queue.task_done()
+                return
+            kind, payload, context = item
+            try:
+                if kind == "steps":
+                    record = {}
+                    for name, values in payload.items():
+                        record[name] = float(np.mean(values.tolist()))
+                    self.last = record
+                    record = {**record, **context}
+                elif kind == "image":
+                    record = {name: _to_python(value) for name, value in payload.items()}
+                    for sink in self.sinks:
+                        sink.write_image(*context, record)
+                    continue
+                else:
+                    record = {name: _to_python(value) for name, value in payload.items()}
+
+                for sink in self.sinks:
+                    sink.write(record)
+            except Exception as error:
+                # a failing sink must not stop training (or the other sinks)
+                print(f"Metric logging failed: {error}")
+            finally:
+                self._queue.task_done()
@@ -1,20 +1,173 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision.models import resnet50, mobilenet_v2, resnet18, alexnet
-import timm  # For EfficientNet and other models
-from timm import create_model  # For ViT and other models from the "timm" library
-from utils import config_load
-import sys
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from copy import deepcopy
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext
+from torch.utils.checkpoint import checkpoint
+from torchvision.models import resnet50, mobilenet_v2, resnet18, get_weight
+from networks import weight_store
+
+# torchvision checkpoints used for pretrained=True (same weights as the legacy `pretrained=True` flag)
+TORCHVISION_WEIGHTS = {
+    'resnet50': 'ResNet50_Weights.IMAGENET1K_V1',
+    'resnet18': 'ResNet18_Weights.IMAGENET1K_V1',
+    'mobilenet_v2': 'MobileNet_V2_Weights.IMAGENET1K_V1',
+}
+
+
+@lru_cache(maxsize=None)
+def load_pretrained_state_dict(arch):
+    # Pretrained weights are fetched at most once per process, every later backbone reuses the cached state dict
+    if arch in TORCHVISION_WEIGHTS:
+        return get_weight(TORCHVISION_WEIGHTS[arch]).get_state_dict(progress=False)
+
+    import timm  # timm is slow to import, only pay for it when a timm model is requested
+    return timm.create_model(arch, pretrained=True).state_dict()
+
+
+def load_pretrained(model, arch):
+    # Zero-copy (memory-mapped) load when the weights were converted into the local weight store,
+    # see networks/weight_store.py. Otherwise fall back to torchvision / timm.
+    if weight_store.has_weights(arch):
+        model.load_state_dict(weight_store.load_weights(arch), assign=True)
+    else:
+        model.load_state_dict(load_pretrained_state_dict(arch))
+
+
+def fold_batchnorm(module):
+    # Fold every BatchNorm2d that directly follows a Conv2d (in registration order) into the conv.
+    # This matches the forward order of torchvision's ResNet blocks / MobileNetV2 and timm's EfficientNet.
+    children = list(module.named_children())
+    for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+            # timm's BatchNormAct2d also applies dropout + activation after normalizing, keep those
+            setattr(module, bn_name, nn.Sequential(bn.drop, bn.act) if hasattr(bn, "act") else nn.Identity())
+
+    for child in module.children():
+        fold_batchnorm(child)
+    return module
+
+
+def flatten_sequential(module):
+    # Expands nested nn.Sequential containers (e.g. the ResNet layers) into a flat list of blocks
+    modules = []
+    for child in module.children():
+        if type(child) is nn.Sequential:
+            modules.extend(flatten_sequential(child))
+        else:
+            modules.append(child)
+    return modules
+
+
+@contextmanager
+def keep_batchnorm_stats(module):
+    # The recomputation during backward must not update the BatchNorm running statistics a second time
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, num_batches) in zip(bns, saved):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(num_batches)
+
+
+def checkpointed_forward(forward, segment_modules, segments, x):
+    """
+    Runs the feature extractor with segment-wise activation checkpointing.
+
+    The blocks are split into `segments` chunks and only the input of each chunk is kept for
+    backward, the activations inside a chunk are recomputed when the gradients are computed.
+    The last chunk is run normally since its activations are needed right away. Checkpointing
+    is skipped (plain `forward`) when it is disabled, in eval mode, under no_grad or when
+    nothing in the backbone needs gradients (frozen backbone).
+
+    Args:
+        forward (callable): Regular forward of the feature extractor.
+        segment_modules (list[nn.Module]): Blocks of the feature extractor, in forward order.
+        segments (int): Number of checkpointed segments (0 disables checkpointing).
+        x (torch.Tensor): Input images.
+
+    Returns:
+        torch.Tensor: Feature maps, identical to `forward(x)`.
+    """
+    if not segments or not torch.is_grad_enabled() or not segment_modules[0].training:
+        return forward(x)
+    if not x.requires_grad and not any(p.requires_grad for m in segment_modules for p in m.parameters()):
+        return forward(x)
+
+    segment_size = -(-len(segment_modules) // segments)
+    chunks = [nn.Sequential(*segment_modules[i:i + segment_size]) for i in range(0, len(segment_modules), segment_size)]
+    for chunk in chunks[:-1]:
+        x = checkpoint(chunk, x, use_reentrant=False,
+                       context_fn=lambda chunk=chunk: (nullcontext(), keep_batchnorm_stats(chunk)))
+    return chunks[-1](x)
+
+
+class TimmFeatures(nn.Module):
+    # Exposes the forward_features of a timm model as a regular module
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_features(x)
+
+
+class InferenceBackbone(nn.Module):
+    """
+    Frozen, inference-only version of a backbone, returned by `optimize_for_inference()`.
+
+    BatchNorm layers are folded into the preceding convolutions, weights and inputs use the
+    channels-last memory format and all parameters are frozen. It keeps the `forward(x)` and
+    `num_features` interface of the backbones, so it can replace `model.backbone` and the model
+    can be evaluated with `evaluate_model_timed` as usual.
+
+    Args:
+        feature_extractor (nn.Module): Feature extractor of the backbone (copied, not modified).
+        pool (nn.Module): Pooling applied to the feature maps.
+        num_features (int): Number of output features.
+        device (str): Device of the backbone.
+    """
+    def __init__(self, feature_extractor, pool, num_features, device):
+        super().__init__()
+
+        self.feature_extractor = fold_batchnorm(deepcopy(feature_extractor).eval())
+        self.feature_extractor = self.feature_extractor.to(memory_format=torch.channels_last)
+        self.pool = pool
+        self.num_features = num_features
+        self.device = device
+
+        for param in self.parameters():
+            param.requires_grad = False
+        self.eval()
+
+    def forward(self, x):
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = self.feature_extractor(x)
+        x = self.pool(x)
+        x = x.view(x.size(0), -1)
+        return x
+
+    def train(self, mode=True):
+        # always stays in eval mode, BatchNorm statistics are already folded into the weights
+        return super().train(False)
 
-config = config_load(sys.argv[1])["config"]
 
 class ResNet50(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
 
         # Load pretrained ResNet-50
-        resnet = resnet50(pretrained=pretrained)
+        resnet = resnet50()
+        if pretrained:
+            load_pretrained(resnet, 'resnet50')
         # Remove the fully connected layer and retain only the convolutional backbone
         self.feature_extractor = nn.Sequential(
             *(list(resnet.children())[:-2])  # Removes FC and avg pooling
@@ -26,12 +179,15 @@ class ResNet50(nn.Module):
         # Set the number of output features (512 for ResNet-50)
         self.num_features = resnet.fc.in_features
 
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
+        self.segment_modules = []
         self.device = device
         self.to(device)
 
     def forward(self, x):
         # Pass through ResNet backbone
-        x = self.feature_extractor(x)
+        x = checkpointed_forward(self.feature_extractor, self.segment_modules, self.checkpoint_segments, x)
         # print(x.shape)
         # Global average pooling to get feature vector
         x = self.pool(x)
@@ -43,12 +199,23 @@ class ResNet50(nn.Module):
         # Add a lower learning rate for the pretrained parameters
         return [{'params': self.feature_extractor.parameters(), 'lr': 1e-4}]
 
+    def optimize_for_inference(self):
+        # Frozen eval copy with BatchNorm folded into the convolutions and channels-last layout
+        return InferenceBackbone(self.feature_extractor, self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # Recompute the activations of the feature extractor in `segments` chunks during backward instead of storing them
+        self.checkpoint_segments = segments
+        self.segment_modules = flatten_sequential(self.feature_extractor)
+
 class ResNet18(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
 
         # Load pretrained ResNet-50
-        resnet = resnet18(pretrained=pretrained)
+        resnet = resnet18()
+        if pretrained:
+            load_pretrained(resnet, 'resnet18')
         # Remove the fully connected layer and retain only the convolutional backbone
         self.feature_extractor = nn.Sequential(
             *(list(resnet.children())[:-2])  # Removes FC and avg pooling
@@ -60,12 +227,15 @@ class ResNet18(nn.Module):
         # Set the number of output features (512 for ResNet-50)
         self.num_features = resnet.fc.in_features
         #print(self.num_features)
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
+        self.segment_modules = []
         self.device = device
         self.to(device)
 
     def forward(self, x):
         # Pass through ResNet backbone
-        x = self.feature_extractor(x)
+        x = checkpointed_forward(self.feature_extractor, self.segment_modules, self.checkpoint_segments, x)
         # #print(x.shape)
         # Global average pooling to get feature vector
         x = self.pool(x)
@@ -77,12 +247,23 @@ class ResNet18(nn.Module):
         # Add a lower learning rate for the pretrained parameters
         return [{'params': self.feature_extractor.parameters(), 'lr': 1e-4}]   
 
+    def optimize_for_inference(self):
+        # Frozen eval copy with BatchNorm folded into the convolutions and channels-last layout
+        return InferenceBackbone(self.feature_extractor, self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # Recompute the activations of the feature extractor in `segments` chunks during backward instead of storing them
+        self.checkpoint_segments = segments
+        self.segment_modules = flatten_sequential(self.feature_extractor)
+
 class ReducedResNet18(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
 
         # Load the standard ResNet-18 model
-        resnet = resnet18(pretrained=pretrained)
+        resnet = resnet18()
+        if pretrained:
+            load_pretrained(resnet, 'resnet18')
 
         # Modify the convolutional layers to reduce feature maps
         resnet.conv1 = nn.Conv2d(3, 64 // 3, kernel_size=7, stride=2, padding=3, bias=False)
@@ -105,6 +286,9 @@ class ReducedResNet18(nn.Module):
 
         # Set the number of output features
         self.num_features = 512 // 3
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
+        self.segment_modules = []
         self.device = device
         self.to(device)
 
@@ -130,7 +314,7 @@ class ReducedResNet18(nn.Module):
 
     def forward(self, x):
         # print("x.shape", x.shape)  # Check input shape
-        x = self.feature_extractor(x)
+        x = checkpointed_forward(self.feature_extractor, self.segment_modules, self.checkpoint_segments, x)
         x = self.pool(x)
         # print("x.shape after pool", x.shape)  # Check shape after pooling
         x = x.view(x.size(0), -1)
@@ -139,14 +323,25 @@ class ReducedResNet18(nn.Module):
 
     def get_optimizer_list(self):
         return [{'params': self.feature_extractor.parameters(), 'lr': 1e-4}]
+
+    def optimize_for_inference(self):
+        # Frozen eval copy with BatchNorm folded into the convolutions and channels-last layout
+        return InferenceBackbone(self.feature_extractor, self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # Recompute the activations of the feature extractor in `segments` chunks during backward instead of storing them
+        self.checkpoint_segments = segments
+        self.segment_modules = flatten_sequential(self.feature_extractor)
     
 
 class MobileNetV2(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
 
         # Load pretrained MobileNetV2
-        mobilenet = mobilenet_v2(pretrained=pretrained)
+        mobilenet = mobilenet_v2()
+        if pretrained:
+            load_pretrained(mobilenet, 'mobilenet_v2')
         # Remove the fully connected layer and retain only the convolutional backbone
         self.feature_extractor = mobilenet.features
         
@@ -157,12 +352,15 @@ class MobileNetV2(nn.Module):
         self.num_features = mobilenet.classifier[1].in_features
         #print(self.num_features)
 
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
+        self.segment_modules = []
         self.device = device
         self.to(device)
 
     def forward(self, x):
         # Pass through MobileNetV2 backbone
-        x = self.feature_extractor(x)
+        x = checkpointed_forward(self.feature_extractor, self.segment_modules, self.checkpoint_segments, x)
         
         # Global average pooling to get feature vector
         x = self.pool(x)
@@ -174,20 +372,36 @@ class MobileNetV2(nn.Module):
         # Add a lower learning rate for the pretrained parameters
         return [{'params': self.feature_extractor.parameters(), 'lr': 1e-4}]
 
+    def optimize_for_inference(self):
+        # Frozen eval copy with BatchNorm folded into the convolutions and channels-last layout
+        return InferenceBackbone(self.feature_extractor, self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # Recompute the activations of the feature extractor in `segments` chunks during backward instead of storing them
+        self.checkpoint_segments = segments
+        self.segment_modules = flatten_sequential(self.feature_extractor)
+
 class EfficientNetB0(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
 
+        import timm
+
         # Use the timm library to load EfficientNetB0
-        self.model = timm.create_model('efficientnet_b0', pretrained=pretrained)
+        self.model = timm.create_model('efficientnet_b0', pretrained=False)
+        if pretrained:
+            load_pretrained(self.model, 'efficientnet_b0')
         self.pool = nn.AdaptiveAvgPool2d((1, 1))
         self.num_features = self.model.classifier.in_features
         #print(self.num_features)
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
+        self.segment_modules = []
         self.device = device
         self.to(device)
 
     def forward(self, x):
-        x = self.model.forward_features(x)
+        x = checkpointed_forward(self.model.forward_features, self.segment_modules, self.checkpoint_segments, x)
         x = self.pool(x)
         x = x.view(x.size(0), -1)
         return x
@@ -195,14 +409,23 @@ class EfficientNetB0(nn.Module):
     def get_optimizer_list(self):
         return [{'params': self.model.parameters(), 'lr': 1e-4}]
 
+    def optimize_for_inference(self):
+        # Frozen eval copy with BatchNorm folded into the convolutions and channels-last layout
+        return InferenceBackbone(TimmFeatures(self.model), self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # Recompute the activations of the feature extractor in `segments` chunks during backward instead of storing them
+        self.checkpoint_segments = segments
+        self.segment_modules = [self.model.conv_stem, self.model.bn1, *flatten_sequential(self.model.blocks),
+                                self.model.conv_head, self.model.bn2]
+
 
 class AlexNet(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
         print("Pretrained:", pretrained)
-        # Load pretrained AlexNet
-        alexnet_ = alexnet(pretrained=pretrained)
-        
+        # The torchvision AlexNet weights do not fit the smaller kernels below, so nothing is loaded
+
         # Modify the feature extractor to handle smaller inputs
         self.feature_extractor = nn.Sequential(
             nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1),  # Smaller kernel and stride
@@ -230,12 +453,15 @@ class AlexNet(nn.Module):
         # Set the number of output features (256 for AlexNet)
         self.num_features = 256
 
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
+        self.segment_modules = []
         self.device = device
         self.to(device)
 
     def forward(self, x):
         # Pass through AlexNet backbone
-        x = self.feature_extractor(x)
+        x = checkpointed_forward(self.feature_extractor, self.segment_modules, self.checkpoint_segments, x)
         # Global average pooling to get feature vector
         x = self.pool(x)
         x = x.view(x.size(0), -1)
@@ -245,13 +471,26 @@ class AlexNet(nn.Module):
         # Add a lower learning rate for the pretrained parameters
         return [{'params': self.feature_extractor.parameters(), 'lr': 1e-4}]
 
+    def optimize_for_inference(self):
+        # Frozen eval copy in channels-last layout (there is no BatchNorm to fold)
+        return InferenceBackbone(self.feature_extractor, self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # Recompute the activations of the feature extractor in `segments` chunks during backward instead of storing them
+        self.checkpoint_segments = segments
+        self.segment_modules = flatten_sequential(self.feature_extractor)
+
 
 class ViT(nn.Module):
-    def __init__(self, pretrained=config['model']['pretrained'], device="cuda"):
+    def __init__(self, pretrained, device="cuda"):
         super().__init__()
 
+        import timm
+
         # Load pretrained Vision Transformer
-        vit = create_model('vit_base_patch16_224', pretrained=pretrained)
+        vit = timm.create_model('vit_base_patch16_224', pretrained=False)
+        if pretrained:
+            load_pretrained(vit, 'vit_base_patch16_224')
         #print(vit)
         # Remove the fully connected layer and retain only the transformer backbone
         self.feature_extractor = vit.forward_features
@@ -264,6 +503,8 @@ class ViT(nn.Module):
         #print(self.num_features)
 
         # Store the device and move the model to the correct device
+        # activation checkpointing is off until enable_activation_checkpointing is called
+        self.checkpoint_segments = 0
         self.device = device
         self.to(device)  # Make sure the model is on the correct device
 
@@ -284,35 +525,51 @@ class ViT(nn.Module):
         # Add a lower learning rate for the pretrained parameters
         return [{'params': self.feature_extractor.parameters(), 'lr': 1e-4}]
 
-
-
+    def optimize_for_inference(self):
+        # Frozen eval copy in channels-last layout (there is no BatchNorm to fold)
+        return InferenceBackbone(TimmFeatures(self.feature_extractor.__self__), self.pool, self.num_features, self.device)
+
+    def enable_activation_checkpointing(self, segments):
+        # timm checkpoints the transformer blocks one by one, the number of segments is not used
+        self.checkpoint_segments = segments
+        self.feature_extractor.__self__.set_grad_checkpointing(segments > 0)
+
+
+
+
+# Registry of the available backbones. Only the classes are referenced here, a backbone
+# (and its pretrained weights) is built when requested through get_backbone
+backbone_registry = {
+    'resnet50': ResNet50,
+    'resnet18': ResNet18,
+    'reducedresnet18': ReducedResNet18,
+    'resnet18_reduced': ReducedResNet18,
+    'mobilenetv2': MobileNetV2,
+    'efficientnetb0': EfficientNetB0,
+    'vit': ViT,
+    'alexnet': AlexNet,
+}
+
+# Pretrained checkpoint each backbone starts from (AlexNet is always trained from scratch)
+backbone_archs = {
+    'resnet50': 'resnet50',
+    'resnet18': 'resnet18',
+    'reducedresnet18': 'resnet18',
+    'resnet18_reduced': 'resnet18',
+    'mobilenetv2': 'mobilenet_v2',
+    'efficientnetb0': 'efficientnet_b0',
+    'vit': 'vit_base_patch16_224',
+}
 
 # Function to initialize the backbone
-def get_backbone(name, pretrained=True, device="cuda"):
-    if name == "resnet50":
-        print("ResNet50", ResNet50(pretrained, device))
-        return ResNet50(pretrained, device)
-    if name == "resnet18":
-        print("ResNet18", ResNet18(pretrained, device))
-        return ResNet18(pretrained, device)
-    elif name == "mobilenetv2":
-        print("MobileNetV2", MobileNetV2(pretrained, device))
-        return MobileNetV2(pretrained, device)
-    elif name == "efficientnetb0":
-        print("EfficientNetB0", EfficientNetB0(pretrained, device))
-        return EfficientNetB0(pretrained, device)
-    elif name == "vit":
-        print("ViT", ViT(pretrained, device))
-        return ViT(pretrained, device)
-    elif name == "alexnet":
-        print("AlexNet", AlexNet(pretrained, device))
-        return AlexNet(pretrained, device)
-    elif name == "resnet18_reduced":
-        print("ReducedResNet18", ReducedResNet18(pretrained, device))
-        return ReducedResNet18(pretrained, device)
-    else:
+def get_backbone(name, pretrained, device="cuda"):
+    if name not in backbone_registry:
         raise ValueError(f"Backbone {name} is not supported.")
 
+    backbone = backbone_registry[name](pretrained=pretrained, device=device)
+    print(type(backbone).__name__, backbone)
+    return backbone
+
 if __name__ == "__main__":
     name = "resnet18"
     backbone = get_backbone(name, pretrained=True, device="cuda")
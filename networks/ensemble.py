@@ -0,0 +1,118 @@
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+
+class HyperHeads(nn.Module):
+    """
+    Everything of a HyperCMTL_seq_simple but the backbone: task embeddings, hypernetwork and the
+    generated task head, applied to precomputed backbone features.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.hyper_emb = model.hyper_emb
+        self.hypernet = model.hypernet
+        self.task_head = model.task_head
+
+    def forward(self, backbone_out, task_idx):
+        params = self.hypernet(self.hyper_emb(task_idx))
+        return self.task_head(backbone_out, params=params).squeeze(0)
+
+
+class HyperEnsemble(nn.Module):
+    """
+    K replicas of HyperCMTL_seq_simple (e.g. built with different seeds) trained at once.
+
+    The replicas share one frozen backbone, which runs once per batch. Their embeddings,
+    hypernetworks and task heads are stacked along a leading replica dimension
+    (`torch.func.stack_module_state`) and applied with `vmap`, so a step costs about one backbone
+    pass plus K small head computations instead of K full runs.
+
+    Args:
+        replicas (list[HyperCMTL_seq_simple]): Models to stack. They must have the same
+            configuration and a frozen backbone; the backbone of the first one is kept.
+
+    Attributes:
+        num_replicas (int): Number of stacked replicas (K).
+        backbone (nn.Module): Shared frozen backbone.
+        stacked (nn.Module): Stacked head parameters and buffers, of shape (K, ...). Their names
+            are the replica names with '.' replaced by ':'.
+    """
+    def __init__(self, replicas):
+        super().__init__()
+        template = replicas[0]
+        if not template.frozen_backbone:
+            raise ValueError("HyperEnsemble shares one backbone between the replicas, it must be frozen (frozen_backbone=True)")
+
+        self.num_replicas = len(replicas)
+        self.backbone = template.backbone
+        self.device = template.device
+        self.frozen_backbone = True
+
+        params, buffers = stack_module_state([HyperHeads(replica) for replica in replicas])
+        self.stacked = nn.Module()
+        for name, param in params.items():
+            self.stacked.register_parameter(name.replace('.', ':'), nn.Parameter(param.detach()))
+        for name, buffer in buffers.items():
+            self.stacked.register_buffer(name.replace('.', ':'), buffer)
+
+        # kept out of the module tree: the first replica gives the parameter groups, and a stateless
+        # (meta) copy of its heads is the function applied to every slice of the stacked state
+        self._template = [template]
+        self._heads = [deepcopy(HyperHeads(template)).to('meta')]
+
+    def stacked_state(self):
+        params = {name.replace(':', '.'): param for name, param in self.stacked.named_parameters()}
+        buffers = {name.replace(':', '.'): buffer for name, buffer in self.stacked.named_buffers()}
+        return params, buffers
+
+    def _forward_replica(self, params, buffers, backbone_out, task_idx):
+        return functional_call(self._heads[0], (params, buffers), (backbone_out, task_idx))
+
+    def forward(self, support_set, task_idx, **kwargs):
+        """
+        Returns:
+            torch.Tensor: Logits of every replica, of shape (K, batch, num_classes).
+        """
+        backbone_out = self.backbone(support_set)
+        task_idx = torch.as_tensor([int(task_idx)], device=backbone_out.device)
+        params, buffers = self.stacked_state()
+        return vmap(self._forward_replica, in_dims=(0, 0, None, None))(params, buffers, backbone_out, task_idx)
+
+    def clip_grad_norm_(self, max_norm):
+        """
+        Clips the gradient norm of every replica separately, as a standalone run would.
+        """
+        grads = [param.grad for param in self.stacked.parameters() if param.grad is not None]
+        if not grads:
+            return
+        norms = torch.stack([grad.flatten(1).pow(2).sum(1) for grad in grads]).sum(0).sqrt()
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for grad in grads:
+            grad.mul_(scale.view(-1, *[1] * (grad.dim() - 1)))
+
+    def replica_state_dict(self, k):
+        """
+        Returns:
+            dict: State dict of replica k, loadable into a HyperCMTL_seq_simple.
+        """
+        params, buffers = self.stacked_state()
+        state_dict = {f'backbone.{name}': tensor for name, tensor in self.backbone.state_dict().items()}
+        state_dict.update({name: tensor[k].detach() for name, tensor in {**params, **buffers}.items()})
+        return state_dict
+
+    def deepcopy(self):
+        return deepcopy(self)
+
+    def get_optimizer_list(self):
+        # the parameter groups (and learning rates) of a single replica, with the stacked parameters
+        stacked_params, _ = self.stacked_state()
+        names = {id(param): name for name, param in self._template[0].named_parameters()}
+        optimizer_list = []
+        for group in self._template[0].get_optimizer_list():
+            # the backbone parameters are shared, the others are replaced by their stacked version
+            params = [stacked_params.get(names[id(param)], param) for param in group['params']]
+            optimizer_list.append({**group, 'params': params})
+        return optimizer_list
@@ -9,12 +9,8 @@ from networks.metamodules import FCBlock, BatchLinear, HyperNetwork, get_subdict
 from networks.torchmeta.modules import MetaModule
 from copy import deepcopy
 
-from networks.backbones import ResNet50, AlexNet, MobileNetV2, EfficientNetB0, ViT, ResNet18, ReducedResNet18
+from networks.backbones import ResNet50, AlexNet, MobileNetV2, EfficientNetB0, ViT, ResNet18, ReducedResNet18, get_backbone
 import random
-from utils import config_load
-import sys
-
-config = config_load(sys.argv[1])["config"]
 
 backbone_dict = {
     'resnet50': ResNet50,
@@ -27,6 +23,11 @@ backbone_dict = {
 }
 
 
+def generated_head(task_head, params):
+    """Classifier of backbone features with the task head weights generated by the hypernetwork, logits of shape (batch, num_classes)."""
+    return lambda features: task_head(features, params=params).squeeze(0)
+
+
 class HyperCMTL(nn.Module):
     """
     Hypernetwork-based Conditional Multi-Task Learning (HyperCMTL) model.
@@ -39,6 +40,7 @@ class HyperCMTL(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -59,7 +61,8 @@ class HyperCMTL(nn.Module):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         super().__init__()
 
         self.num_instances = num_instances
@@ -72,6 +75,7 @@ class HyperCMTL(nn.Module):
         self.channels = channels
         self.img_size = img_size
         self.std = std
+        self.pretrained = pretrained
 
         # Backbone
         '''self.backbone = ConvBackbone(layers=backbone_layers,
@@ -79,7 +83,7 @@ class HyperCMTL(nn.Module):
                                      device=device)
         '''
         if backbone in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=True)
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=pretrained)
         else: 
             raise ValueError(f"Backbone {backbone} is not supported.")
         
@@ -128,7 +132,8 @@ class HyperCMTL(nn.Module):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std)
+                    std=self.std,
+                    pretrained=self.pretrained)
         new_model.load_state_dict(self.state_dict())
         return new_model.to(device=self.device)
     
@@ -156,6 +161,7 @@ class HyperCMTL_all(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -176,7 +182,8 @@ class HyperCMTL_all(nn.Module):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         super().__init__()
 
         self.num_instances = num_instances
@@ -189,6 +196,7 @@ class HyperCMTL_all(nn.Module):
         self.channels = channels
         self.img_size = img_size
         self.std = std
+        self.pretrained = pretrained
 
         # Backbone
         '''self.backbone = ConvBackbone(layers=backbone_layers,
@@ -200,7 +208,7 @@ class HyperCMTL_all(nn.Module):
         # else: 
         #     raise ValueError(f"Backbone {backbone} is not supported.")
         
-        self.backbone = Backbone(self.backbone_name, device=device, pretrained=True)
+        self.backbone = get_backbone(self.backbone_name, pretrained=pretrained, device=device)
 
         # Task head
         self.task_head = TaskHead(input_size=self.backbone.num_features,
@@ -256,7 +264,8 @@ class HyperCMTL_all(nn.Module):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std)
+                    std=self.std,
+                    pretrained=self.pretrained)
         new_model.load_state_dict(self.state_dict())
         return new_model.to(device=self.device)
     
@@ -287,6 +296,7 @@ class HyperCMTL_seq(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -307,7 +317,8 @@ class HyperCMTL_seq(nn.Module):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         super().__init__()
 
         self.num_instances = num_instances
@@ -320,6 +331,7 @@ class HyperCMTL_seq(nn.Module):
         self.channels = channels
         self.img_size = img_size
         self.std = std
+        self.pretrained = pretrained
 
         # Backbone
         '''self.backbone = ConvBackbone(layers=backbone_layers,
@@ -327,7 +339,7 @@ class HyperCMTL_seq(nn.Module):
                                      device=device)
         '''
         if backbone in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=True)
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=pretrained)
         else: 
             raise ValueError(f"Backbone {backbone} is not supported.")
         
@@ -388,7 +400,8 @@ class HyperCMTL_seq(nn.Module):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std)
+                    std=self.std,
+                    pretrained=self.pretrained)
         new_model.load_state_dict(self.state_dict())
         return new_model.to(device=self.device)
     
@@ -417,6 +430,7 @@ class HyperCMTL_seq_simple(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -449,7 +463,7 @@ class HyperCMTL_seq_simple(nn.Module):
 
         # Backbone
         if self.backbone_name in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=config["model"]["pretrained"])
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=model_config.get("pretrained", True))
         else: 
             raise ValueError(f"Backbone {self.backbone_name} is not supported.")
         
@@ -460,6 +474,9 @@ class HyperCMTL_seq_simple(nn.Module):
             for param in self.backbone.parameters():
                 param.requires_grad = True
 
+        # Optional segment-wise activation checkpointing of the backbone (trades recomputation for memory)
+        self.backbone.enable_activation_checkpointing(model_config.get("checkpoint_segments", 0))
+
         # Task head
         self.task_head = TaskHead_simple(input_size=self.backbone.num_features,
                                         num_classes=self.num_classes_per_task,
@@ -488,6 +505,14 @@ class HyperCMTL_seq_simple(nn.Module):
         
         return task_head_out.squeeze(0)
     
+    def backbone_features(self, x):
+        """Backbone features, the input of the task head."""
+        return self.backbone(x)
+
+    def task_classifier(self, task_idx, prototypes=None):
+        """Classifier of a task on backbone_features, with its head weights generated once."""
+        return generated_head(self.task_head, self.get_params(task_idx, None))
+
     def deepcopy(self):
         new_model = HyperCMTL_seq_simple(num_tasks=self.num_tasks,
                     num_classes_per_task=self.num_classes_per_task,
@@ -519,6 +544,7 @@ class HyperCMTL_seq_simple_2d(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -551,7 +577,7 @@ class HyperCMTL_seq_simple_2d(nn.Module):
 
         # Backbone
         if self.backbone_name in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=True)
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=model_config.get("pretrained", True))
         else: 
             raise ValueError(f"Backbone {self.backbone_name} is not supported.")
         
@@ -562,6 +588,9 @@ class HyperCMTL_seq_simple_2d(nn.Module):
             for param in self.backbone.parameters():
                 param.requires_grad = True
 
+        # Optional segment-wise activation checkpointing of the backbone (trades recomputation for memory)
+        self.backbone.enable_activation_checkpointing(model_config.get("checkpoint_segments", 0))
+
         # Task head
         self.task_head = TaskHead_simple(input_size=self.backbone.num_features,
                                         num_classes=self.num_classes_per_task,
@@ -585,7 +614,7 @@ class HyperCMTL_seq_simple_2d(nn.Module):
         z = self.hyper_emb(torch.LongTensor([task_idx]).to(self.device))
         return self.hypernet(z), z
 
-    def forward(self, support_set, task_idx, **kwargs):
+    def forward(self, support_set, task_idx, return_prototypes=False, **kwargs):
         params, z = self.get_params(task_idx)
         
         backbone_out = self.backbone(support_set)
@@ -594,6 +623,19 @@ class HyperCMTL_seq_simple_2d(nn.Module):
         z_2d = z.view(self.num_classes_per_task, self.prototypes_channels, self.prototypes_size, self.prototypes_size)
         self.learned_prototyes = z_2d
 
+        if not return_prototypes:
+            return task_head_out.squeeze(0)
+        return task_head_out.squeeze(0), self.classify_prototypes(task_idx, params=params)
+
+    def classify_prototypes(self, task_idx, params=None):
+        """
+        Predictions of the task head on the task's learned prototypes (an extra backbone pass,
+        computed only when asked for: evaluation, logging).
+        """
+        if params is None:
+            params, _ = self.get_params(task_idx)
+        z_2d = self.get_prototypes(task_idx)
+
         if z_2d.size(1) == 1:
             z_2d = z_2d.repeat(1, 3, 1, 1)
             
@@ -601,8 +643,17 @@ class HyperCMTL_seq_simple_2d(nn.Module):
             z_out = self.backbone(z_2d)
             z_out = self.task_head(z_out, params=params)
 
-        return task_head_out.squeeze(0), z_out.squeeze(0)
+        return z_out.squeeze(0)
     
+    def backbone_features(self, x):
+        """Backbone features, the input of the task head."""
+        return self.backbone(x)
+
+    def task_classifier(self, task_idx, prototypes=None):
+        """Classifier of a task on backbone_features, with its head weights generated once."""
+        params, _ = self.get_params(task_idx)
+        return generated_head(self.task_head, params)
+
     def deepcopy(self):
         new_model = HyperCMTL_seq_simple_2d(num_tasks=self.num_tasks,
                     num_classes_per_task=self.num_classes_per_task,
@@ -656,6 +707,7 @@ class HyperCMTL_seq_simple_2d_color(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -676,7 +728,8 @@ class HyperCMTL_seq_simple_2d_color(nn.Module):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         super().__init__()
 
         self.num_instances = num_instances
@@ -689,6 +742,7 @@ class HyperCMTL_seq_simple_2d_color(nn.Module):
         self.channels = channels
         self.img_size = img_size
         self.std = std
+        self.pretrained = pretrained
 
         # Backbone
         '''self.backbone = ConvBackbone(layers=backbone_layers,
@@ -696,7 +750,7 @@ class HyperCMTL_seq_simple_2d_color(nn.Module):
                                      device=device)
         '''
         if backbone in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=True)
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=pretrained)
         else: 
             raise ValueError(f"Backbone {backbone} is not supported.")
         
@@ -705,6 +759,9 @@ class HyperCMTL_seq_simple_2d_color(nn.Module):
         # for param in self.backbone.parameters():
         #     param.requires_grad = False
 
+        # Optional segment-wise activation checkpointing of the backbone (trades recomputation for memory)
+        self.backbone.enable_activation_checkpointing(model_config.get("checkpoint_segments", 0))
+
         # Task head
         self.task_head = TaskHead_simple(input_size=self.backbone.num_features,
                                   projection_size=task_head_projection_size,
@@ -766,7 +823,8 @@ class HyperCMTL_seq_simple_2d_color(nn.Module):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std)
+                    std=self.std,
+                    pretrained=self.pretrained)
         new_model.load_state_dict(self.state_dict())
         return new_model.to(device=self.device)
     
@@ -801,7 +859,8 @@ class HyperCMTL_prototype(nn.Module):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         super().__init__()
 
         self.num_instances = num_instances
@@ -814,10 +873,11 @@ class HyperCMTL_prototype(nn.Module):
         self.channels = channels
         self.img_size = img_size
         self.std = std
+        self.pretrained = pretrained
 
 
         if backbone in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=True)
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=pretrained)
         else: 
             raise ValueError(f"Backbone {backbone} is not supported.")
         
@@ -900,7 +960,8 @@ class HyperCMTL_prototype(nn.Module):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std).to(self.device)
+                    std=self.std,
+                    pretrained=self.pretrained).to(self.device)
         new_model.load_state_dict(self.state_dict())
         return new_model.to(device=self.device)
 
@@ -915,7 +976,8 @@ class HyperCMTL_prototype_attention_old(HyperCMTL):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         
         super().__init__(num_instances=num_instances,
                             backbone=backbone,
@@ -926,7 +988,8 @@ class HyperCMTL_prototype_attention_old(HyperCMTL):
                             device=device,
                             channels=channels,
                             img_size=img_size,
-                            std=std)
+                            std=std,
+                            pretrained=pretrained)
 
         # freeze the backbone
         # for param in self.backbone.parameters():
@@ -1013,7 +1076,8 @@ class HyperCMTL_prototype_attention_old(HyperCMTL):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std).to(self.device)
+                    std=self.std,
+                    pretrained=self.pretrained).to(self.device)
         new_model.load_state_dict(self.state_dict())
         return new_model
 
@@ -1028,7 +1092,8 @@ class HyperCMTL_prototype_attention(HyperCMTL):
                  hyper_hidden_layers=2,                    # Hypernetwork number of layers
                  channels=1,
                  img_size=[32, 32],
-                 std=0.01):
+                 std=0.01,
+                 pretrained=True):                         # Load the pretrained backbone weights
         
         super().__init__(num_instances=num_instances,
                             backbone=backbone,
@@ -1039,7 +1104,8 @@ class HyperCMTL_prototype_attention(HyperCMTL):
                             device=device,
                             channels=channels,
                             img_size=img_size,
-                            std=std)
+                            std=std,
+                            pretrained=pretrained)
 
         # freeze the backbone
         # for param in self.backbone.parameters():
@@ -1142,7 +1208,8 @@ class HyperCMTL_prototype_attention(HyperCMTL):
                     device=self.device,
                     channels=self.channels,
                     img_size=self.img_size, 
-                    std=self.std).to(self.device)
+                    std=self.std,
+                    pretrained=self.pretrained).to(self.device)
         new_model.load_state_dict(self.state_dict())
         return new_model
 
@@ -1163,6 +1230,7 @@ class HyperCMTL_seq_prototype_simple(nn.Module):
         num_instances (int): Number of task instances to support (e.g., number of tasks).
         device (str, optional): Device for computation ('cuda' or 'cpu'). Default is 'cuda'.
         std (float, optional): Standard deviation for initializing the task embeddings. Default is 0.01.
+        pretrained (bool, optional): Whether to load the pretrained backbone weights. Default is True.
 
     Attributes:
         num_instances (int): Number of task instances.
@@ -1196,7 +1264,7 @@ class HyperCMTL_seq_prototype_simple(nn.Module):
         
         # Backbone
         if self.backbone_name in backbone_dict:
-            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=True)
+            self.backbone = backbone_dict[self.backbone_name](device=device, pretrained=model_config.get("pretrained", True))
         else: 
             raise ValueError(f"Backbone {self.backbone_name} is not supported.")
         
@@ -1216,6 +1284,9 @@ class HyperCMTL_seq_prototype_simple(nn.Module):
                 param.requires_grad = True
             
 
+        # Optional segment-wise activation checkpointing of the backbone (trades recomputation for memory)
+        self.backbone.enable_activation_checkpointing(model_config.get("checkpoint_segments", 0))
+
         # Task head
         self.task_head = TaskHead_simple(input_size=self.backbone.num_features,
                                         num_classes=self.num_classes_per_task,
@@ -1252,6 +1323,14 @@ class HyperCMTL_seq_prototype_simple(nn.Module):
         task_head_out = self.task_head(backbone_out, params=params)
         return task_head_out.squeeze(0)
     
+    def backbone_features(self, x):
+        """Backbone features, the input of the task head."""
+        return self.backbone(x)
+
+    def task_classifier(self, task_idx, prototypes):
+        """Classifier of a task on backbone_features, with its head weights generated once from the task's prototypes."""
+        return generated_head(self.task_head, self.get_params(task_idx, self.backbone_prototype_frozen(prototypes)))
+
     def deepcopy(self):
         new_model = HyperCMTL_seq_prototype_simple(num_tasks=self.num_tasks,
                     num_classes_per_task=self.num_classes_per_task,
@@ -55,6 +55,44 @@ class TaskHead_simple(nn.Module):
         return self.classifier(x)
     
 
+def grouped_heads_forward(heads, features):
+    """
+    Logits of several task heads on the same features, with the weights of the heads stacked so
+    that every layer is one matmul for all of them: a single GEMM over the concatenated
+    classifiers for TaskHead_simple, a GEMM then a batched matmul (baddbmm) for TaskHead_Baseline.
+    Heads of another type, or TaskHead_Baseline heads of different sizes, are run one by one.
+
+    With dropout, the TaskHead_Baseline heads share the dropout mask of the features.
+
+    Args:
+        heads (list[nn.Module]): Task heads.
+        features (torch.Tensor): Activated backbone features, of shape (batch, input_size).
+
+    Returns:
+        list[torch.Tensor]: Logits of every head, of shape (batch, num_classes of the head).
+    """
+    if all(isinstance(head, TaskHead_simple) for head in heads):
+        weight = torch.cat([head.classifier.weight for head in heads])
+        logits = features @ weight.t()
+        return list(logits.split([head.classifier.out_features for head in heads], dim=1))
+
+    if (all(isinstance(head, TaskHead_Baseline) for head in heads)
+            and len({(head.projection.weight.shape, head.classifier.weight.shape) for head in heads}) == 1):
+        first = heads[0]
+        projection_size = first.projection.out_features
+        hidden = torch.addmm(torch.cat([head.projection.bias for head in heads]),
+                             first.relu(first.dropout(features)),
+                             torch.cat([head.projection.weight for head in heads]).t())
+        # (num_heads, batch, projection_size)
+        hidden = first.relu(first.dropout(hidden)).view(len(features), len(heads), projection_size).transpose(0, 1)
+        logits = torch.baddbmm(torch.stack([head.classifier.bias for head in heads]).unsqueeze(1),
+                               hidden,
+                               torch.stack([head.classifier.weight for head in heads]).transpose(1, 2))
+        return list(logits)
+
+    return [head(features) for head in heads]
+
+
 ### and a baseline_lwf_model that contains a backbone plus multiple class heads,
 ### and performs task-ID routing at runtime, allowing it to perform any learned task:
 class MultitaskModel_Baseline(nn.Module):
@@ -80,6 +118,10 @@ class MultitaskModel_Baseline(nn.Module):
     def forward(self, x: torch.Tensor, task_id: int):
         if x.device != self.device:
             x = x.to(self.device)
+
+        # one task id per sample (mixed-task batch)
+        if torch.is_tensor(task_id) and task_id.dim() == 1:
+            return self.forward_mixed(x, task_id)
         
         task_id = str(int(task_id))
         # nn.ModuleDict requires string keys for some reason,
@@ -97,6 +139,45 @@ class MultitaskModel_Baseline(nn.Module):
 
         return x
 
+    def forward_heads(self, x: torch.Tensor, task_ids):
+        """
+        Logits of several task heads on the same batch: the backbone runs once and the heads
+        share one grouped matmul (see grouped_heads_forward).
+
+        Args:
+            x (torch.Tensor): Input batch.
+            task_ids (list[int]): Heads to evaluate.
+
+        Returns:
+            list[torch.Tensor]: Logits of each requested head, in the order of task_ids.
+        """
+        if x.device != self.device:
+            x = x.to(self.device)
+        features = self.relu(self.backbone(x))
+        return grouped_heads_forward([self.task_heads[str(int(task_id))] for task_id in task_ids], features)
+
+    def forward_mixed(self, x: torch.Tensor, task_ids: torch.Tensor):
+        """
+        Logits of a batch mixing several tasks, each sample through the head of its own task id.
+        The heads must have the same number of classes.
+        """
+        head_ids, head_index = task_ids.unique(sorted=True, return_inverse=True)
+        for head_id in head_ids.tolist():
+            assert str(head_id) in self.task_heads, f"no head exists for task id {head_id}"
+        # (num_heads, batch, num_classes), then the logits of its own head for every sample
+        logits = torch.stack(self.forward_heads(x, head_ids.tolist()))
+        return logits[head_index.to(logits.device), torch.arange(len(x), device=logits.device)]
+
+    def backbone_features(self, x: torch.Tensor):
+        """Activated backbone features, the input of the task heads."""
+        if x.device != self.device:
+            x = x.to(self.device)
+        return self.relu(self.backbone(x))
+
+    def task_classifier(self, task_id: int, prototypes=None):
+        """Classifier of a task on backbone_features (its head)."""
+        return self.task_heads[str(int(task_id))]
+
     def add_task(self, 
                  task_id: int, 
                  head: nn.Module):
@@ -146,6 +227,16 @@ class MultitaskModel_Baseline_notaskid(nn.Module):
 
         return x
 
+    def backbone_features(self, x: torch.Tensor):
+        """Activated backbone features, the input of the task heads."""
+        if x.device != self.device:
+            x = x.to(self.device)
+        return self.relu(self.backbone(x))
+
+    def task_classifier(self, task_id: int, prototypes=None):
+        """Classifier of a task on backbone_features (the head shared by all tasks)."""
+        return self.task_heads["0"]
+
     def add_task(self, 
                  task_id: int, 
                  head: nn.Module):
@@ -0,0 +1,151 @@
+import torch
+import torch.nn as nn
+from copy import deepcopy
+
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from networks.networks_baseline import MultitaskModel_Baseline, MultitaskModel_Baseline_notaskid
+
+
+def quantize_backbone_static(backbone: nn.Module,
+                             calibration_loaders,
+                             num_calibration_batches: int = 10,
+                             backend: str = "x86"):
+    """
+    Statically quantizes a convolutional backbone to int8 for CPU inference.
+
+    The backbone is traced with torch.fx, observers are inserted after every conv / linear /
+    activation, and a calibration pass is run over the given loaders (one per task validation
+    split) to fix the activation ranges before converting to int8 kernels.
+
+    Args:
+        backbone (nn.Module): Backbone from networks/backbones.py (ResNet18/50, ReducedResNet18,
+            MobileNetV2, EfficientNetB0, AlexNet). The original module is left untouched.
+        calibration_loaders (list[DataLoader]): Loaders yielding (x, y, task_id) batches.
+        num_calibration_batches (int, optional): Maximum number of batches used per loader. Default is 10.
+        backend (str, optional): Quantized engine ('x86', 'fbgemm', 'qnnpack', 'onednn'). Default is 'x86'.
+
+    Returns:
+        torch.fx.GraphModule: Int8 backbone mapping images to pooled feature vectors, on CPU.
+    """
+    # ViT only stores a bound forward method, there is no module graph to quantize
+    feature_module = getattr(backbone, "feature_extractor", getattr(backbone, "model", None))
+    if not isinstance(feature_module, nn.Module):
+        raise ValueError(f"Static int8 quantization is not supported for {type(backbone).__name__}.")
+
+    torch.backends.quantized.engine = backend
+
+    float_backbone = deepcopy(backbone).cpu().eval()
+    example_x = next(iter(calibration_loaders[0]))[0][:1]
+
+    prepared = prepare_fx(float_backbone, get_default_qconfig_mapping(backend), example_inputs=(example_x,))
+
+    # calibration pass over the validation split of every task seen so far
+    with torch.no_grad():
+        for loader in calibration_loaders:
+            for batch_idx, (x, _, _) in enumerate(loader):
+                if batch_idx >= num_calibration_batches:
+                    break
+                prepared(x.cpu())
+
+    return convert_fx(prepared)
+
+
+def quantize_head_dynamic(weight: torch.Tensor, bias: torch.Tensor = None):
+    """
+    Builds a dynamically quantized int8 linear layer from a (generated) weight matrix.
+
+    Args:
+        weight (torch.Tensor): Weight of shape `(num_classes, input_size)`, or `(1, num_classes, input_size)`
+            as returned by the hypernetwork.
+        bias (torch.Tensor, optional): Bias of shape `(num_classes,)`. Default is None.
+
+    Returns:
+        nn.Module: Dynamically quantized linear layer on CPU.
+    """
+    weight = weight.detach().reshape(weight.shape[-2], weight.shape[-1]).cpu()
+    head = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    with torch.no_grad():
+        head.weight.copy_(weight)
+        if bias is not None:
+            head.bias.copy_(bias.detach().reshape(-1).cpu())
+    return quantize_dynamic(head.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+class QuantizedMultitaskModel(nn.Module):
+    """
+    Int8 CPU inference wrapper around a trained multitask model.
+
+    The backbone is statically quantized with a calibration pass over each task's validation
+    split, and the task heads are dynamically quantized. For hypernetwork models the head
+    weights are generated once per task by the fp32 hypernetwork and cached as int8 layers,
+    so inference never runs the hypernetwork again.
+
+    Supported models: MultitaskModel_Baseline, MultitaskModel_Baseline_notaskid,
+    HyperCMTL_seq_simple and HyperCMTL_seq_prototype_simple. The call signature is the same
+    as the wrapped model, i.e. `model(x, task_id)` or `model(x, prototypes, task_id)`, so it
+    can be passed directly to `evaluate_model_timed` with `device='cpu'`.
+
+    Args:
+        model (nn.Module): Trained fp32 multitask model.
+        calibration_loaders (list[DataLoader]): Validation loaders of the tasks seen so far.
+        num_calibration_batches (int, optional): Maximum number of calibration batches per task. Default is 10.
+        backend (str, optional): Quantized engine used for the backbone. Default is 'x86'.
+    """
+    def __init__(self,
+                 model: nn.Module,
+                 calibration_loaders,
+                 num_calibration_batches: int = 10,
+                 backend: str = "x86"):
+        super().__init__()
+
+        self.is_baseline = isinstance(model, (MultitaskModel_Baseline, MultitaskModel_Baseline_notaskid))
+        self.is_hyper = hasattr(model, "hypernet") and hasattr(model, "task_head")
+        if not (self.is_baseline or self.is_hyper):
+            raise ValueError(f"Quantized inference is not supported for {type(model).__name__}.")
+
+        self.device = torch.device("cpu")
+        self.backbone = quantize_backbone_static(model.backbone,
+                                                 calibration_loaders,
+                                                 num_calibration_batches=num_calibration_batches,
+                                                 backend=backend)
+
+        # int8 heads, one per task, keyed by str(task_id) as in MultitaskModel_Baseline
+        self.task_heads = nn.ModuleDict()
+        if self.is_baseline:
+            for task_id, head in model.task_heads.items():
+                self.task_heads[task_id] = quantize_dynamic(deepcopy(head).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+            self.relu = nn.ReLU()
+            self.single_head = isinstance(model, MultitaskModel_Baseline_notaskid)
+        else:
+            # fp32 copy used only to generate (and then quantize) the head of each task once
+            self._generator = [deepcopy(model).cpu().eval()]
+            self._generator[0].device = self.device
+
+    def _hyper_head(self, task_id, prototypes=None):
+        if task_id not in self.task_heads:
+            generator = self._generator[0]
+            with torch.no_grad():
+                if prototypes is not None:
+                    params = generator.get_params(int(task_id), generator.backbone_prototype_frozen(prototypes.cpu()))
+                else:
+                    params = generator.get_params(int(task_id), None)
+            self.task_heads[task_id] = quantize_head_dynamic(params["classifier.weight"], params.get("classifier.bias"))
+        return self.task_heads[task_id]
+
+    def forward(self, x, *args):
+        # accepts (x, task_id) or (x, prototypes, task_id), same as the fp32 models
+        prototypes, task_id = (None, args[0]) if len(args) == 1 else args
+        x = x.cpu()
+
+        if self.is_baseline:
+            head = self.task_heads["0" if self.single_head else str(int(task_id))]
+            return head(self.relu(self.backbone(x)))
+
+        head = self._hyper_head(str(int(task_id)), prototypes)
+        return head(self.backbone(x))
+
+    def train(self, mode: bool = True):
+        # int8 modules are inference-only, keep them in eval mode
+        return super().train(False)
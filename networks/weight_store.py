@@ -0,0 +1,92 @@
+import os
+import sys
+import torch
+
+# Location of the converted checkpoints, shared by every training process on the machine
+DEFAULT_STORE_DIR = os.environ.get("TSR_WEIGHT_STORE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "tsr", "weights"))
+
+
+def weight_path(arch, store_dir=None):
+    """
+    Returns the path of the converted checkpoint of an architecture.
+
+    Args:
+        arch (str): torchvision / timm architecture name (e.g. 'resnet18', 'efficientnet_b0').
+        store_dir (str, optional): Root of the weight store. Default is DEFAULT_STORE_DIR.
+
+    Returns:
+        str: Path of the checkpoint inside the store.
+    """
+    return os.path.join(store_dir or DEFAULT_STORE_DIR, f"{arch}.pt")
+
+
+def has_weights(arch, store_dir=None):
+    return os.path.isfile(weight_path(arch, store_dir))
+
+
+def save_weights(arch, state_dict, store_dir=None):
+    """
+    Writes a state dict to the store in a memory-mappable format.
+
+    The file is written next to its final location and renamed, so concurrent readers never
+    see a partially written checkpoint.
+
+    Args:
+        arch (str): Architecture name the weights belong to.
+        state_dict (dict): State dict to store.
+        store_dir (str, optional): Root of the weight store. Default is DEFAULT_STORE_DIR.
+
+    Returns:
+        str: Path of the stored checkpoint.
+    """
+    path = weight_path(arch, store_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save({name: tensor.detach().cpu().contiguous() for name, tensor in state_dict.items()}, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_weights(arch, store_dir=None):
+    """
+    Memory-maps a stored checkpoint.
+
+    The tensors point directly into the file (no copy is made), so processes loading the same
+    architecture share the page cache. Writes (e.g. fine-tuning a backbone) are copy-on-write
+    and never touch the file.
+
+    Args:
+        arch (str): Architecture name.
+        store_dir (str, optional): Root of the weight store. Default is DEFAULT_STORE_DIR.
+
+    Returns:
+        dict: State dict of CPU tensors backed by the memory-mapped file.
+    """
+    return torch.load(weight_path(arch, store_dir), map_location="cpu", mmap=True, weights_only=True)
+
+
+def convert_backbones(backbone_names, store_dir=None):
+    """
+    Downloads (through torchvision / timm) and converts the pretrained weights of the given
+    backbones into the store. Backbones that are already converted are skipped, so this only
+    needs network access the first time.
+
+    Args:
+        backbone_names (list[str]): Names from `networks.backbones.backbone_registry` (e.g. 'resnet18', 'mobilenetv2').
+        store_dir (str, optional): Root of the weight store. Default is DEFAULT_STORE_DIR.
+    """
+    from networks.backbones import backbone_archs, load_pretrained_state_dict
+
+    for name in backbone_names:
+        arch = backbone_archs.get(name)
+        if arch is None or has_weights(arch, store_dir):
+            continue
+        path = save_weights(arch, load_pretrained_state_dict(arch), store_dir)
+        print(f"Converted {name} ({arch}) weights to {path}")
+
+
+if __name__ == "__main__":
+    # python -m networks.weight_store resnet18 mobilenetv2 efficientnetb0 resnet50
+    convert_backbones(sys.argv[1:])
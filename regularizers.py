@@ -0,0 +1,362 @@
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, grad, vmap
+
+
+# ------------------ Fisher information ------------------ #
+
+FISHER_NORMALIZATIONS = ('batch', 'sample')
+
+
+def compute_fisher(model, dataset_loader, device, sample_size=200, chunk_size=32, normalization='batch'):
+    """
+    Diagonal (empirical) Fisher information of the trainable parameters over `sample_size`
+    samples, with one of two normalizations:
+
+    - 'batch' (default): the mean over the batches of the squared gradient of the batch-mean
+      log-likelihood, the original estimate of the EWC baseline (the batch is routed through the
+      head of its first task id). The shipped ewc_lambda values are tuned for this scale.
+    - 'sample': the mean of the squared gradient of each sample's log-likelihood, the diagonal
+      Fisher. It is roughly batch_size times larger, so ewc_lambda has to be scaled down.
+
+    With 'sample', the per-sample gradients come from `torch.func` (vmap over grad) on
+    `chunk_size` samples at a time, squared and summed into the Fisher chunk by chunk, which
+    bounds the memory to `chunk_size` gradients of the model. Samples of a batch are grouped by
+    task id, so models routing each task to its own head (MultitaskModel_Baseline) get the
+    gradient through the right head.
+
+    Args:
+        model (nn.Module): Model called as model(x, task_id).
+        dataset_loader (DataLoader): Batches of (x, y, task_ids).
+        device (torch.device): Device of the model.
+        sample_size (int, optional): Number of samples the Fisher is estimated on ('batch': rounded up to whole batches). Default is 200.
+        chunk_size (int, optional): Samples whose gradients are computed at once ('sample'). Default is 32.
+        normalization (str, optional): 'batch' or 'sample'. Default is 'batch'.
+
+    Returns:
+        dict: Fisher information per parameter name.
+    """
+    if normalization not in FISHER_NORMALIZATIONS:
+        raise ValueError(f"Unknown Fisher normalization {normalization}, use one of {FISHER_NORMALIZATIONS}")
+
+    model.eval()
+    params = {n: p.detach() for n, p in model.named_parameters() if p.requires_grad}
+    buffers = {n: b.detach() for n, b in model.named_buffers()}
+    fisher = {n: torch.zeros_like(p) for n, p in params.items()}
+
+    def mean_loss(params, x, y, task_id):
+        pred = functional_call(model, (params, buffers), (x, task_id))
+        return F.nll_loss(F.log_softmax(pred, dim=1), y)
+
+    if normalization == 'batch':
+        count, num_batches = 0, 0
+        for x, y, task_ids in dataset_loader:
+            grads = grad(mean_loss)(params, x.to(device), y.to(device), task_ids[0])
+            for n, g in grads.items():
+                fisher[n] += g.pow(2)
+            count += len(x)
+            num_batches += 1
+            if count >= sample_size:
+                break
+
+        for n in fisher:
+            fisher[n] /= max(num_batches, 1)
+        return fisher
+
+    def sample_loss(params, x, y, task_id):
+        return mean_loss(params, x.unsqueeze(0), y.unsqueeze(0), task_id)
+
+    per_sample_grads = vmap(grad(sample_loss), in_dims=(None, 0, 0, None))
+
+    count = 0
+    for x, y, task_ids in dataset_loader:
+        x, y, task_ids = x[:sample_size - count].to(device), y[:sample_size - count].to(device), task_ids[:sample_size - count]
+        for task_id in task_ids.unique().tolist():
+            mask = (task_ids == task_id).to(device)
+            for x_chunk, y_chunk in zip(x[mask].split(chunk_size), y[mask].split(chunk_size)):
+                grads = per_sample_grads(params, x_chunk, y_chunk, task_id)
+                for n, g in grads.items():
+                    fisher[n] += g.pow(2).sum(0)
+        count += len(x)
+        if count >= sample_size:
+            break
+
+    for n in fisher:
+        fisher[n] /= max(count, 1)
+    return fisher
+
+
+def compute_fisher_loop(model, dataset_loader, device, sample_size=200):
+    """
+    Reference for compute_fisher(normalization='sample'): one backward pass per sample.
+    """
+    model.eval()
+    fisher = {n: torch.zeros_like(p) for n, p in model.named_parameters() if p.requires_grad}
+    count = 0
+    for x, y, task_ids in dataset_loader:
+        for i in range(min(len(x), sample_size - count)):
+            model.zero_grad()
+            pred = model(x[i:i+1].to(device), task_ids[i])
+            F.nll_loss(F.log_softmax(pred, dim=1), y[i:i+1].to(device)).backward()
+            for n, p in model.named_parameters():
+                if p.requires_grad and p.grad is not None:
+                    fisher[n] += p.grad.pow(2)
+            count += 1
+        if count >= sample_size:
+            break
+
+    for n in fisher:
+        fisher[n] /= max(count, 1)
+    return fisher
+
+
+# ------------------ Flat parameter buffers ------------------ #
+
+class FlatParameters:
+    """
+    The trainable parameters of a module gathered in one contiguous buffer, `params`, which the
+    module's parameters become views of. Their gradients are views of a second buffer, `grads`,
+    so per-parameter state (anchors, Fisher, Omega, ...) can be kept as flat tensors too and
+    updated with a single op per step instead of a Python loop over the parameters.
+
+    The gradients only stay views of `grads` if the optimizer does not free them between steps
+    (`zero_grad(set_to_none=False)`, see Strategy.set_grads_to_none).
+
+    Args:
+        module (nn.Module): Module whose trainable parameters (requires_grad) are gathered. They
+            must share one dtype and device, and must not be replaced afterwards (e.g. by
+            module.to()); load_state_dict copies in place and keeps the views.
+    """
+    def __init__(self, module):
+        named = [(n, p) for n, p in module.named_parameters() if p.requires_grad]
+        self.names = [n for n, _ in named]
+        self.parameters = [p for _, p in named]
+        self.numels = [p.numel() for p in self.parameters]
+        self.params = torch.cat([p.detach().reshape(-1) for p in self.parameters])
+        self.grads = torch.zeros_like(self.params)
+        self.bind()
+
+    def views(self, flat):
+        return [view.view_as(p) for view, p in zip(flat.split(self.numels), self.parameters)]
+
+    def bind(self):
+        """
+        Points the parameters and their gradients at the flat buffers (again, e.g. after something
+        set the gradients to None). The current gradients are kept.
+        """
+        for p, param_view, grad_view in zip(self.parameters, self.views(self.params), self.views(self.grads)):
+            if p.data_ptr() != param_view.data_ptr():
+                param_view.copy_(p.detach())
+                p.data = param_view
+            if p.grad is None or p.grad.data_ptr() != grad_view.data_ptr():
+                grad_view.copy_(p.grad) if p.grad is not None else grad_view.zero_()
+                p.grad = grad_view
+
+    def flatten(self, tensors):
+        """
+        Returns:
+            torch.Tensor: Flat buffer from a dict of tensors per parameter name (e.g. a Fisher
+            estimate or a state dict of the strategy saved before the flat buffers).
+        """
+        return torch.cat([tensors[n].reshape(-1).to(self.params) for n in self.names])
+
+    def unflatten(self, flat):
+        return dict(zip(self.names, self.views(flat)))
+
+
+# ------------------ Compact regularizer state ------------------ #
+
+ANCHOR_DTYPES = {None: None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class BlockQuantized:
+    """
+    Blockwise int8 quantization of a flat tensor: every block of `block_size` values is stored
+    as int8 with one fp32 scale (absolute maximum of the block / 127), about a quarter of the
+    fp32 memory.
+    """
+    format = 'int8'
+
+    def __init__(self, q, scale, numel):
+        self.q, self.scale, self.numel = q, scale, numel
+
+    @classmethod
+    def quantize(cls, tensor, block_size=256):
+        blocks = F.pad(tensor, (0, -tensor.numel() % block_size)).view(-1, block_size)
+        scale = blocks.abs().amax(1).clamp(min=1e-30) / 127
+        return cls(torch.round(blocks / scale[:, None]).to(torch.int8), scale, tensor.numel())
+
+    def dense(self):
+        return (self.q.float() * self.scale[:, None]).view(-1)[:self.numel]
+
+    def nbytes(self):
+        return self.q.numel() * self.q.element_size() + self.scale.numel() * self.scale.element_size()
+
+    def state_dict(self):
+        return {'format': self.format, 'q': self.q, 'scale': self.scale, 'numel': self.numel}
+
+
+class TopK:
+    """
+    The `fraction` largest (in absolute value) entries of a flat tensor, stored as int32 indices
+    and fp32 values, the other entries are dropped (zero).
+    """
+    format = 'topk'
+
+    def __init__(self, indices, values, numel):
+        self.indices, self.values, self.numel = indices, values, numel
+
+    @classmethod
+    def sparsify(cls, tensor, fraction=0.1):
+        indices = tensor.abs().topk(max(1, int(fraction * tensor.numel())), sorted=False).indices
+        return cls(indices.to(torch.int32), tensor[indices], tensor.numel())
+
+    def dense(self):
+        return torch.zeros(self.numel, device=self.values.device).index_put_((self.indices.long(),), self.values)
+
+    def nbytes(self):
+        return self.indices.numel() * self.indices.element_size() + self.values.numel() * self.values.element_size()
+
+    def state_dict(self):
+        return {'format': self.format, 'indices': self.indices, 'values': self.values, 'numel': self.numel}
+
+
+def load_compact(state):
+    if state['format'] == BlockQuantized.format:
+        return BlockQuantized(state['q'], state['scale'], state['numel'])
+    return TopK(state['indices'], state['values'], state['numel'])
+
+
+def state_nbytes(tensor):
+    return tensor.nbytes() if hasattr(tensor, 'dense') else tensor.numel() * tensor.element_size()
+
+
+class QuadraticPenalty:
+    """
+    weight * sum_i importance_i * (theta_i - anchor_i)^2 over the flat parameters, the penalty of
+    EWC (importance = Fisher) and SI (importance = Omega, weight = si_lambda / 2).
+
+    The penalty is not differentiated by autograd: `value()` is only logged and `add_grad()` adds
+    its gradient 2 * weight * importance * (theta - anchor) to the flat gradient buffer, a single
+    fused op per step.
+
+    The state can be stored compactly: anchors in fp16/bf16, importance blockwise quantized to
+    int8 ('int8') or restricted to its largest values ('topk', the penalty and its gradient
+    then only touch those entries). `set()` compresses, `dense_importance()` decompresses, e.g.
+    to consolidate the importance of a new task into it.
+
+    Args:
+        flat (FlatParameters): Parameters the penalty applies to.
+        weight (float): Penalty weight.
+        anchor_dtype (str, optional): 'fp16' or 'bf16' anchors. Default is None (parameter dtype).
+        importance_format (str, optional): 'int8' or 'topk'. Default is None (dense, parameter dtype).
+        topk_fraction (float, optional): Fraction of the importance values kept with 'topk'. Default is 0.1.
+        block_size (int, optional): Values sharing one scale with 'int8'. Default is 256.
+    """
+    def __init__(self, flat, weight, anchor_dtype=None, importance_format=None, topk_fraction=0.1, block_size=256):
+        if importance_format not in (None, BlockQuantized.format, TopK.format):
+            raise ValueError(f"Unknown importance format {importance_format}, use None, 'int8' or 'topk'")
+        self.flat = flat
+        self.weight = weight
+        self.anchor_dtype = ANCHOR_DTYPES[anchor_dtype]
+        self.importance_format = importance_format
+        self.topk_fraction = topk_fraction
+        self.block_size = block_size
+        self.anchor = None
+        self.importance = None
+
+    @property
+    def active(self):
+        return self.anchor is not None and self.importance is not None
+
+    def set(self, anchor, importance):
+        self.anchor = anchor.to(self.anchor_dtype) if self.anchor_dtype is not None else anchor
+        if self.importance_format == BlockQuantized.format:
+            importance = BlockQuantized.quantize(importance, self.block_size)
+        elif self.importance_format == TopK.format:
+            importance = TopK.sparsify(importance, self.topk_fraction)
+        self.importance = importance
+
+    def dense_importance(self):
+        return self.importance.dense() if hasattr(self.importance, 'dense') else self.importance
+
+    def nbytes(self):
+        """
+        Returns:
+            int: Memory of the anchor and importance.
+        """
+        return state_nbytes(self.anchor) + state_nbytes(self.importance) if self.active else 0
+
+    @torch.no_grad()
+    def value(self):
+        if isinstance(self.importance, TopK):
+            indices = self.importance.indices
+            diff = self.flat.params[indices] - self.anchor[indices]
+            return self.weight * torch.dot(self.importance.values * diff, diff)
+        diff = self.flat.params - self.anchor
+        return self.weight * torch.dot(self.dense_importance() * diff, diff)
+
+    @torch.no_grad()
+    def add_grad(self, scale=1.0):
+        """
+        Args:
+            scale (float, optional): Loss scale the gradients are multiplied by (GradScaler). Default is 1.
+        """
+        if isinstance(self.importance, TopK):
+            indices = self.importance.indices
+            diff = self.flat.params[indices] - self.anchor[indices]
+            self.flat.grads.index_add_(0, indices, self.importance.values * diff, alpha=2 * self.weight * scale)
+        else:
+            self.flat.grads.addcmul_(self.dense_importance(), self.flat.params - self.anchor, value=2 * self.weight * scale)
+
+    def state_dict(self):
+        importance = self.importance.state_dict() if hasattr(self.importance, 'dense') else self.importance
+        return {'anchor': self.anchor, 'importance': importance}
+
+    def load_state_dict(self, state):
+        """
+        Accepts the flat state of any format, or per-parameter dicts (strategy checkpoints saved
+        before the flat buffers), and stores it in the format of this penalty.
+        """
+        def to_dense(x):
+            if isinstance(x, dict):
+                x = load_compact(x).dense() if 'format' in x else self.flat.flatten(x)
+            return x.to(self.flat.params)
+        self.set(to_dense(state['anchor']), to_dense(state['importance']))
+
+
+class PathIntegral:
+    """
+    Path integral of Synaptic Intelligence, W += (theta_after - theta_before) * g over every
+    optimizer step, accumulated by step hooks of the optimizer on the flat buffers.
+
+    The parameters before the step are copied into a buffer allocated once; after the step the
+    update is done in place as W -= (theta_before - theta_after) * g, which is exactly
+    W + delta * g. Steps skipped by the GradScaler do not call the hooks (their delta is zero).
+    The sign is that of the per-parameter loop of the SI baseline (the SI paper accumulates
+    -delta * g), so the results are identical to it.
+
+    Args:
+        flat (FlatParameters): Parameters updated by the optimizer.
+        optimizer (torch.optim.Optimizer): Optimizer whose steps are accumulated.
+    """
+    def __init__(self, flat, optimizer):
+        self.flat = flat
+        self.W = torch.zeros_like(flat.params)
+        self.before_step = torch.empty_like(flat.params)
+        self.handles = [optimizer.register_step_pre_hook(self.pre_step),
+                        optimizer.register_step_post_hook(self.post_step)]
+
+    def pre_step(self, optimizer, args, kwargs):
+        self.before_step.copy_(self.flat.params)
+
+    def post_step(self, optimizer, args, kwargs):
+        self.before_step.sub_(self.flat.params).mul_(self.flat.grads)
+        self.W.sub_(self.before_step)
+
+    def reset(self):
+        self.W.zero_()
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import subprocess
+import threading
+import time
+
+
+class JobQueue:
+    """
+    Persistent queue of training jobs in a SQLite database, one row per job in the `jobs` table.
+
+    Jobs are identified by their name: adding a job that is already queued does nothing, so a
+    sweep script can be started again and only the jobs it has not finished run. Jobs left
+    running by a scheduler that was killed go back to the queue when the next one starts.
+
+    Args:
+        path (str): Database file. The job configs and logs are written next to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        os.makedirs(os.path.join(self.root, 'logs'), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, command TEXT, "
+                                "cpus INTEGER, memory_gb REAL, device INTEGER, max_retries INTEGER, status TEXT, "
+                                "attempts INTEGER, returncode INTEGER, slot TEXT, log TEXT, updated REAL)")
+        self.connection.commit()
+
+    def add(self, name, command, cpus=1, memory_gb=0.0, device=False, max_retries=0):
+        """
+        Queues a job unless one with the same name exists.
+
+        Args:
+            name (str): Unique name of the job.
+            command (list[str]): Command to run, e.g. ['python', 'train_hyper.py', 'configs/hyper.py'].
+            cpus (int, optional): Cores reserved for the job, also its OMP_NUM_THREADS. Default is 1.
+            memory_gb (float, optional): Host memory reserved for the job. Default is 0.
+            device (bool, optional): Whether the job needs a GPU slot of its own. Default is False.
+            max_retries (int, optional): Times a failed job is queued again. Default is 0.
+
+        Returns:
+            bool: Whether the job was added.
+        """
+        log = os.path.join(self.root, 'logs', f'{name}.log')
+        cursor = self.connection.execute("INSERT OR IGNORE INTO jobs VALUES (NULL, ?, ?, ?, ?, ?, ?, 'pending', 0, NULL, NULL, ?, ?)",
+                                         (name, json.dumps(command), cpus, memory_gb, int(device), max_retries, log, time.time()))
+        self.connection.commit()
+        return cursor.rowcount == 1
+
+    def jobs(self, status=None):
+        query = "SELECT id, name, command, cpus, memory_gb, device, max_retries, status, attempts, returncode, slot, log FROM jobs"
+        rows = self.connection.execute(query + (" WHERE status = ? ORDER BY id" if status else " ORDER BY id"),
+                                       (status,) if status else ()).fetchall()
+        keys = ('id', 'name', 'command', 'cpus', 'memory_gb', 'device', 'max_retries', 'status', 'attempts', 'returncode', 'slot', 'log')
+        jobs = [dict(zip(keys, row)) for row in rows]
+        for job in jobs:
+            job['command'] = json.loads(job['command'])
+        return jobs
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        self.connection.execute(f"UPDATE jobs SET {assignments}, updated = ? WHERE id = ?",
+                                (*fields.values(), time.time(), job_id))
+        self.connection.commit()
+
+    def requeue_interrupted(self):
+        """
+        Puts the jobs of a scheduler that did not exit cleanly back in the queue.
+        """
+        self.connection.execute("UPDATE jobs SET status = 'pending', slot = NULL WHERE status = 'running'")
+        self.connection.commit()
+
+    def summary(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+def visible_devices():
+    """
+    Returns:
+        list[str]: GPU ids the jobs can be pinned to (CUDA_VISIBLE_DEVICES of this process if
+        set), empty on a CPU-only machine.
+    """
+    if os.environ.get('CUDA_VISIBLE_DEVICES', None) is not None:
+        return [device for device in os.environ['CUDA_VISIBLE_DEVICES'].split(',') if device.strip()]
+    import torch
+    return [str(i) for i in range(torch.cuda.device_count())]
+
+
+def total_memory_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+
+
+class LocalScheduler:
+    """
+    Runs the jobs of a JobQueue on this machine, as many at a time as the declared resources allow.
+
+    Every job reserves its cores and memory, plus a GPU if it asks for one, until it exits. A
+    queued job starts as soon as a finishing job frees what it needs (jobs further down the queue
+    fill in the gaps left by bigger ones). The exit status of every job is recorded, failed jobs are
+    queued again up to their `max_retries`. A job asking for more cores or memory than the scheduler
+    has is clamped to what it has (with a warning), rather than never starting.
+
+    On a machine without GPUs the device requests are ignored and the jobs run on the CPU.
+
+    Args:
+        job_queue (JobQueue): Jobs to run.
+        cpus (int, optional): Cores to hand out. Default is every core of the machine.
+        memory_gb (float, optional): Memory to hand out. Default is the physical memory.
+        devices (list[str], optional): GPU ids to hand out, one job per GPU. Default is every visible GPU.
+        max_jobs (int, optional): Cap on the number of concurrent jobs. Default is no cap.
+        cwd (str, optional): Working directory of the jobs. Default is the current one.
+    """
+    def __init__(self, job_queue, cpus=None, memory_gb=None, devices=None, max_jobs=None, cwd=None):
+        self.job_queue = job_queue
+        self.cpus = cpus or os.cpu_count()
+        self.memory_gb = memory_gb or total_memory_gb()
+        self.devices = visible_devices() if devices is None else list(devices)
+        self.max_jobs = max_jobs
+        self.cwd = cwd
+
+        self.free_cpus, self.free_memory_gb, self.free_devices = self.cpus, self.memory_gb, list(self.devices)
+        self.running = {}
+        # (job id, return code) of the finished jobs, put by the thread waiting on each process
+        self.finished = queue.Queue()
+
+    def clamp(self, job):
+        cpus, memory_gb = min(job['cpus'], self.cpus), min(job['memory_gb'], self.memory_gb)
+        if (cpus, memory_gb) != (job['cpus'], job['memory_gb']):
+            print(f"Warning: {job['name']} asks for {job['cpus']} cores and {job['memory_gb']}GB, the scheduler has "
+                  f"{self.cpus} cores and {self.memory_gb:.1f}GB: clamped to {cpus} cores and {memory_gb:.1f}GB")
+            # stored, so that the job is released with what it reserved and only warned about once
+            self.job_queue.update(job['id'], cpus=cpus, memory_gb=memory_gb)
+            job['cpus'], job['memory_gb'] = cpus, memory_gb
+        return job
+
+    def fits(self, job):
+        if self.max_jobs is not None and len(self.running) >= self.max_jobs:
+            return False
+        return (job['cpus'] <= self.free_cpus and job['memory_gb'] <= self.free_memory_gb
+                and (not job['device'] or not self.devices or bool(self.free_devices)))
+
+    def start(self, job):
+        slot = self.free_devices[0] if job['device'] and self.devices else None
+
+        # CPU jobs do not see the GPUs, the thread count follows the reserved cores
+        env = {**os.environ, 'CUDA_VISIBLE_DEVICES': slot or '', 'OMP_NUM_THREADS': str(job['cpus'])}
+        try:
+            with open(job['log'], 'a') as log:
+                log.write(f"\n### attempt {job['attempts'] + 1}: {' '.join(job['command'])} (device: {slot})\n")
+                log.flush()
+                process = subprocess.Popen(job['command'], stdout=log, stderr=subprocess.STDOUT, env=env, cwd=self.cwd)
+        except OSError as error:
+            # nothing was reserved, the job cannot run as queued (e.g. missing executable)
+            self.job_queue.update(job['id'], status='failed', attempts=job['attempts'] + 1)
+            print(f"{job['name']} could not be started ({error}), marked as failed")
+            return
+
+        # the resources are taken only once the process runs
+        if slot is not None:
+            self.free_devices.remove(slot)
+        self.free_cpus -= job['cpus']
+        self.free_memory_gb -= job['memory_gb']
+        self.running[job['id']] = (job, slot, process)
+        threading.Thread(target=lambda: self.finished.put((job['id'], process.wait())), daemon=True).start()
+
+        self.job_queue.update(job['id'], status='running', attempts=job['attempts'] + 1, slot=slot)
+        print(f"Started {job['name']} (cores: {job['cpus']}, memory: {job['memory_gb']}GB, device: {slot})")
+
+    def release(self, job_id, returncode):
+        job, slot, _ = self.running.pop(job_id)
+        self.free_cpus += job['cpus']
+        self.free_memory_gb += job['memory_gb']
+        if slot is not None:
+            self.free_devices.append(slot)
+
+        attempts = job['attempts'] + 1
+        if returncode == 0:
+            status = 'done'
+        elif attempts <= job['max_retries']:
+            status = 'pending'
+        else:
+            status = 'failed'
+        self.job_queue.update(job_id, status=status, returncode=returncode, slot=None)
+        print(f"{job['name']} exited with code {returncode} ({status}), log: {job['log']}")
+
+    def schedule(self):
+        for job in self.job_queue.jobs('pending'):
+            if self.fits(self.clamp(job)):
+                self.start(job)
+
+    def run(self):
+        """
+        Runs until no job is pending or running.
+
+        Returns:
+            dict: Number of jobs per status.
+        """
+        self.job_queue.requeue_interrupted()
+        try:
+            self.schedule()
+            while self.running:
+                # blocks until a job exits, then fills the freed resources right away
+                self.release(*self.finished.get())
+                while not self.finished.empty():
+                    self.release(*self.finished.get())
+                self.schedule()
+        finally:
+            for _, _, process in self.running.values():
+                process.terminate()
+        return self.job_queue.summary()
+
+
+if __name__ == "__main__":
+    # runs (or resumes) the jobs of an existing queue, e.g. after the sweep script was interrupted
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queue", help="Job queue database written by a sweep script")
+    parser.add_argument("--cpus", type=int, default=None)
+    parser.add_argument("--memory_gb", type=float, default=None)
+    parser.add_argument("--devices", nargs="*", default=None)
+    parser.add_argument("--max_jobs", type=int, default=None)
+    parser.add_argument("--status", action="store_true", help="Print the jobs and their status, run nothing")
+    args = parser.parse_args()
+
+    job_queue = JobQueue(args.queue)
+    if args.status:
+        for job in job_queue.jobs():
+            print(f"{job['name']:<60}{job['status']:>10}{job['attempts']:>4} attempts, exit code {job['returncode']}")
+    else:
+        print(LocalScheduler(job_queue, cpus=args.cpus, memory_gb=args.memory_gb, devices=args.devices,
+                             max_jobs=args.max_jobs).run())
+    job_queue.close()
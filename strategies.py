@@ -0,0 +1,646 @@
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import matplotlib.pyplot as plt
+import wandb
+from copy import deepcopy
+
+from torch.utils.data import DataLoader
+
+from distributed import all_reduce_mean, is_main_process
+from networks.networks_baseline import TaskHead_simple
+from networks.quantization import QuantizedMultitaskModel
+from regularizers import compute_fisher, FlatParameters, QuadraticPenalty, PathIntegral
+from utils import (evaluate_model_timed, evaluate_model_2d, test_evaluate_metrics, test_evaluate_2d,
+                   distillation_output_loss, compute_FM_BWT, TotalVariationLoss)
+
+
+class Strategy:
+    """
+    Base continual learning strategy, plugged into `trainer.ContinualTrainer`.
+
+    A strategy holds everything that is specific to a method (teacher model, regularizer state,
+    prototypes, ...) and is called by the trainer through the following hooks:
+
+        setup(trainer)                             once, before the first task
+        before_task(trainer, t)                    task boundary, before training task t
+        compute_loss(trainer, x, y, task_id, t)    every step, returns (total_loss, pred, loss_terms)
+        after_backward(trainer)                    every step, after backward and before optimizer.step()
+        clip_gradients(trainer)                    every step, before optimizer.step() (clips to clip_grad_norm)
+        after_step(trainer)                        every step, after optimizer.step()
+        evaluate(trainer, val_loader, t)           validation on the current task
+        test(trainer, t)                           test on every task seen so far
+        after_task(trainer, t)                     task boundary, after testing task t
+
+    and, for checkpointing:
+
+        state_dict(trainer)                        strategy state to checkpoint (teacher, regularizer, ...)
+        load_state_dict(trainer, state)            restores it, before the model and optimizer are loaded
+        resume_task(trainer, t)                    replaces before_task when resuming in the middle of task t
+
+    The base class trains with the classification loss only (fine-tuning).
+
+    Args:
+        config (dict): Full run configuration.
+    """
+    name = 'Finetune'
+    # max gradient norm applied before every optimizer step, None disables clipping
+    clip_grad_norm = None
+    # whether optimizer.zero_grad() frees the gradients (False keeps them allocated in place)
+    set_grads_to_none = True
+
+    def __init__(self, config):
+        self.config = config
+        self.clip_grad_norm = config['training'].get('clip_grad_norm', self.clip_grad_norm)
+
+    def setup(self, trainer):
+        pass
+
+    def before_task(self, trainer, t):
+        pass
+
+    def forward(self, model, x, task_id):
+        return model(x, task_id)
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        pred = self.forward(trainer.model, x, task_id)
+        hard_loss = trainer.loss_fn(pred, y)
+        return hard_loss, pred, {'hard_loss': hard_loss.detach()}
+
+    def after_backward(self, trainer):
+        pass
+
+    def clip_gradients(self, trainer):
+        if self.clip_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(trainer.model.parameters(), self.clip_grad_norm)
+
+    def after_step(self, trainer):
+        pass
+
+    def task_prototypes(self, trainer, t=None):
+        """
+        Prototypes passed to the model at evaluation time: those of task t, or the list of all
+        tasks when t is None. Strategies without prototypes return None.
+        """
+        return None
+
+    def evaluate(self, trainer, val_loader, t):
+        """
+        Returns:
+            dict: 'val_loss', 'val_acc' and 'time', plus any strategy specific entries.
+        """
+        prototypes = self.task_prototypes(trainer, t)
+        avg_val_loss, avg_val_acc, time = evaluate_model_timed(multitask_model=trainer.model,
+                                                              val_loader=val_loader,
+                                                              loss_fn=trainer.loss_fn,
+                                                              device=trainer.device,
+                                                              prototypes=prototypes.to(trainer.device) if prototypes is not None else None)
+        return {'val_loss': avg_val_loss, 'val_acc': avg_val_acc, 'time': time}
+
+    def test(self, trainer, t):
+        data, config = trainer.data, self.config
+
+        # optional int8 CPU copy of the model, calibrated on the validation split of every task seen so far
+        quantized_model = None
+        if config.get('evaluation', {}).get('quantized_inference', False):
+            calibration_loaders = [DataLoader(data['timestep_tasks'][i][1], batch_size=config['dataset']['BATCH_SIZE'])
+                                   for i in range(t+1)]
+            quantized_model = QuantizedMultitaskModel(trainer.model, calibration_loaders)
+
+        return test_evaluate_metrics(multitask_model=trainer.model,
+                                     selected_test_sets=data['task_test_sets'][:t+1],
+                                     task_test_sets=data['task_test_sets'],
+                                     model_name=f'{self.name} at t={t}',
+                                     prev_accs=trainer.prev_test_accs,
+                                     verbose=True,
+                                     results_dir=trainer.results_dir,
+                                     task_id=t,
+                                     task_metadata=data['task_metadata'],
+                                     device=trainer.device,
+                                     task_prototypes=self.task_prototypes(trainer),
+                                     quantized_model=quantized_model,
+                                     artifacts=trainer.artifacts,
+                                     evaluator=trainer.evaluator)
+
+    def after_task(self, trainer, t):
+        pass
+
+    def state_dict(self, trainer):
+        return {}
+
+    def load_state_dict(self, trainer, state):
+        pass
+
+    def resume_task(self, trainer, t):
+        self.before_task(trainer, t)
+
+
+# ------------------ Learning without Forgetting ------------------ #
+
+class LwFStrategy(Strategy):
+    """
+    Learning without Forgetting on MultitaskModel_Baseline: a new head is added at every task and
+    the outputs of the old heads are distilled from a frozen copy of the model taken at the end
+    of the previous task.
+    """
+    name = 'LwF'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.previous_model = None
+        self.temperature = config['training']['temperature']
+        self.stability = config['training']['stability']
+
+    def before_task(self, trainer, t):
+        self.add_task_head(trainer, t)
+
+    def add_task_head(self, trainer, t):
+        model = trainer.model
+        if str(t) not in model.task_heads:
+            task_head = TaskHead_simple(input_size=model.backbone.num_features,
+                                        num_classes=len(trainer.data['timestep_task_classes'][t]),
+                                        device=trainer.device)
+            model.add_task(t, task_head)
+            trainer.optimizer.add_param_group({'params': task_head.parameters()})
+            trainer.logger.log(f"Task head added for task {t}")
+
+    def distillation_loss(self, trainer, x, t):
+        soft_loss = torch.tensor(0.0, device=trainer.device)
+        if self.previous_model is not None:
+            for old_task_id in range(t):
+                with torch.no_grad():
+                    old_pred = self.forward(self.previous_model, x, old_task_id)
+                new_prev_pred = self.forward(trainer.model, x, old_task_id)
+                soft_loss += distillation_output_loss(new_prev_pred, old_pred, self.temperature).mean()
+        return soft_loss * self.stability
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        if hasattr(trainer.model, 'forward_heads'):
+            return self.compute_loss_fused(trainer, x, y, task_id, t)
+        pred = self.forward(trainer.model, x, task_id)
+        hard_loss = trainer.loss_fn(pred, y)
+        soft_loss = self.distillation_loss(trainer, x, t)
+        return hard_loss + soft_loss, pred, {'hard_loss': hard_loss.detach(), 'soft_loss': soft_loss.detach()}
+
+    def compute_loss_fused(self, trainer, x, y, task_id, t):
+        # MultitaskModel_Baseline: the current head and the old ones on a single backbone pass of
+        # the student (and of the teacher), instead of one pass per head
+        old_task_ids = list(range(t)) if self.previous_model is not None else []
+        pred, *new_prev_preds = trainer.model.forward_heads(x, [task_id, *old_task_ids])
+        hard_loss = trainer.loss_fn(pred, y)
+
+        soft_loss = torch.tensor(0.0, device=trainer.device)
+        if old_task_ids:
+            with torch.no_grad():
+                old_preds = self.previous_model.forward_heads(x, old_task_ids)
+            for new_prev_pred, old_pred in zip(new_prev_preds, old_preds):
+                soft_loss += distillation_output_loss(new_prev_pred, old_pred, self.temperature).mean()
+        soft_loss = soft_loss * self.stability
+        return hard_loss + soft_loss, pred, {'hard_loss': hard_loss.detach(), 'soft_loss': soft_loss.detach()}
+
+    def snapshot(self, model):
+        return deepcopy(model)
+
+    def after_task(self, trainer, t):
+        # store the current model as the previous model
+        self.previous_model = self.snapshot(trainer.model)
+
+    def state_dict(self, trainer):
+        return {'task_heads': list(getattr(trainer.model, 'task_heads', {}).keys()),
+                'previous_model': self.previous_model.state_dict() if self.previous_model is not None else None}
+
+    def load_state_dict(self, trainer, state):
+        # the heads have to exist before the model weights are loaded
+        for task_id in state['task_heads']:
+            self.add_task_head(trainer, int(task_id))
+
+        if state['previous_model'] is not None:
+            self.previous_model = self.snapshot(trainer.model)
+            # when resuming mid-task, the model already has the head of the current task but the teacher doesn't
+            missing_keys, unexpected_keys = self.previous_model.load_state_dict(state['previous_model'], strict=False)
+            if unexpected_keys:
+                raise RuntimeError(f"Unexpected keys in the previous model checkpoint: {unexpected_keys}")
+
+
+class HyperLwFStrategy(LwFStrategy):
+    """
+    LwF on the hypernetwork models (HyperCMTL_seq_simple, ...): the task heads are generated, so
+    nothing is added at task boundaries, and the teacher is copied with `model.deepcopy()`.
+    """
+    clip_grad_norm = 1.0
+
+    def add_task_head(self, trainer, t):
+        pass
+
+    def snapshot(self, model):
+        return model.deepcopy()
+
+
+class HyperEnsembleStrategy(HyperLwFStrategy):
+    """
+    LwF on a `networks.ensemble.HyperEnsemble`: K hypernetwork replicas trained at once on the
+    same batches. Each replica gets the gradient (and the gradient clipping) it would get in a
+    standalone run, the training accuracy is that of the ensemble (mean logits), and validation /
+    test metrics are reported per replica and averaged.
+    """
+    name = 'HyperCMTL_seq ensemble'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.prev_test_accs_replicas = []
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        # (K, batch, num_classes)
+        pred = self.forward(trainer.model, x, task_id)
+        num_replicas = pred.shape[0]
+
+        # mean over the replicas of their own losses
+        hard_loss = trainer.loss_fn(pred.flatten(0, 1), y.repeat(num_replicas))
+        soft_loss = torch.tensor(0.0, device=trainer.device)
+        if self.previous_model is not None:
+            for old_task_id in range(t):
+                with torch.no_grad():
+                    old_pred = self.forward(self.previous_model, x, old_task_id)
+                new_prev_pred = self.forward(trainer.model, x, old_task_id)
+                soft_loss += distillation_output_loss(new_prev_pred.flatten(0, 1), old_pred.flatten(0, 1), self.temperature).mean()
+        soft_loss = soft_loss * self.stability
+
+        # summed over the replicas, so each one gets the gradient of its own loss
+        total_loss = (hard_loss + soft_loss) * num_replicas
+        return total_loss, pred.mean(dim=0), {'hard_loss': hard_loss.detach(), 'soft_loss': soft_loss.detach()}
+
+    def clip_gradients(self, trainer):
+        if self.clip_grad_norm is not None:
+            trainer.model.clip_grad_norm_(self.clip_grad_norm)
+
+    def replica_metrics(self, trainer, loader):
+        """
+        One pass of the ensemble over a loader.
+
+        Returns:
+            tuple: Per-replica mean loss and accuracy (numpy arrays of shape (K,)), and the
+                average inference time per batch.
+        """
+        model = trainer.model
+        model.eval()
+        losses, correct, num_samples, times = 0.0, 0.0, 0, []
+        with torch.no_grad():
+            for x, y, task_ids in loader:
+                x, y = x.to(trainer.device), y.to(trainer.device)
+                start_time = time.time()
+                pred = model(x, task_ids[0])
+                times.append(time.time() - start_time)
+
+                losses = losses + F.cross_entropy(pred.transpose(1, 2), y.expand(pred.shape[0], -1), reduction='none').sum(dim=1)
+                correct = correct + (pred.argmax(dim=-1) == y).sum(dim=1)
+                num_samples += len(y)
+        model.train()
+        return (losses / num_samples).cpu().numpy(), (correct / num_samples).cpu().numpy(), np.mean(times)
+
+    def evaluate(self, trainer, val_loader, t):
+        val_losses, val_accs, time_inf = self.replica_metrics(trainer, val_loader)
+        return {'val_loss': val_losses.mean(), 'val_acc': val_accs.mean(), 'val_acc_replicas': val_accs.tolist(), 'time': time_inf}
+
+    def test(self, trainer, t):
+        data = trainer.data
+        # (K, t+1): accuracy of every replica on every task seen so far
+        task_test_accs = np.stack([self.replica_metrics(trainer, DataLoader(test_set, batch_size=self.config['dataset']['BATCH_SIZE']))[1]
+                                   for test_set in data['task_test_sets'][:t+1]], axis=1)
+
+        AA, FM, BWT = task_test_accs.mean(axis=1), np.zeros(len(task_test_accs)), np.zeros(len(task_test_accs))
+        if t > 0:
+            for k, replica_accs in enumerate(task_test_accs):
+                FM[k], BWT[k] = compute_FM_BWT(replica_accs.tolist(), [prev_accs[k].tolist() for prev_accs in self.prev_test_accs_replicas])
+        self.prev_test_accs_replicas.append(task_test_accs)
+
+        trainer.logger.log(f'{self.name} at t={t}: AA {AA.mean():.2%} +- {AA.std():.2%}, FM {FM.mean():.2%} +- {FM.std():.2%} '
+                           f'(per replica AA: {", ".join(f"{acc:.2%}" for acc in AA)})')
+        return {'task_test_accs': task_test_accs.mean(axis=0).tolist(),
+                'AA': AA.mean(), 'AA_std': AA.std(), 'FM': FM.mean(), 'FM_std': FM.std(), 'BWT': BWT.mean(),
+                'AA_replicas': AA.tolist(), 'FM_replicas': FM.tolist()}
+
+    def state_dict(self, trainer):
+        return {**super().state_dict(trainer), 'prev_test_accs_replicas': self.prev_test_accs_replicas}
+
+    def load_state_dict(self, trainer, state):
+        super().load_state_dict(trainer, state)
+        self.prev_test_accs_replicas = state['prev_test_accs_replicas']
+
+
+class PrototypeStrategy(HyperLwFStrategy):
+    """
+    LwF on HyperCMTL_seq_prototype_simple: the head of every task is generated from the class
+    prototypes of the task being trained, which are also given to the teacher.
+    """
+    clip_grad_norm = None
+
+    def before_task(self, trainer, t):
+        # Shape: (num_classes_per_task, C, H, W)
+        self.prototypes = trainer.data['task_prototypes'][t].to(trainer.device)
+
+    def forward(self, model, x, task_id):
+        return model(x, self.prototypes, task_id)
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        total_loss, pred, loss_terms = super().compute_loss(trainer, x, y, task_id, t)
+        return total_loss, pred.squeeze(0), loss_terms
+
+    def task_prototypes(self, trainer, t=None):
+        return trainer.data['task_prototypes'] if t is None else trainer.data['task_prototypes'][t]
+
+
+class Prototype2DStrategy(HyperLwFStrategy):
+    """
+    LwF on HyperCMTL_seq_simple_2d, with learned 2D prototypes (the task embeddings). Training
+    uses the LwF loss only; the prototypes are classified by the task head in `evaluate` (and
+    at test time), and rendered every `evaluation.prototype_plot_frequency` evaluations.
+    """
+    name = 'HyperCMTL_seq + LwF'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.tv_loss_fn = TotalVariationLoss()
+        self.prev_test_accs_prot = []
+        self.prototype_plot_frequency = config.get('evaluation', {}).get('prototype_plot_frequency', 1)
+        self.num_evaluations = 0
+
+    def setup(self, trainer):
+        model, data, model_config = trainer.model, trainer.data, self.config['model']
+        if not model_config['initialize_prot_w_images']:
+            return
+
+        num_tasks = len(data['task_metadata'])
+        num_classes_per_task = len(data['task_metadata'][0])
+        prototypes_inititalization = torch.zeros((num_tasks, num_classes_per_task*model_config['prototypes_channels']*model_config['prototypes_size']*model_config['prototypes_size']))
+        fig, ax = plt.subplots(num_tasks, num_classes_per_task, figsize=(num_classes_per_task*3, (num_tasks)*3))
+        for t in range(num_tasks):
+            if model_config['prototypes_size'] != 20:
+                trainer.logger.log(f"Warning: Prototype size is not 20, but {model_config['prototypes_size']}. Check wheather this initialization is correct.")
+            prototypes = torch.mean(data['task_prototypes'][t][:, :, 6:26, 6:26], dim=1, keepdim=True)
+            prototypes_inititalization[t] = prototypes.reshape(-1)
+
+            for i in range(len(data['task_metadata'][t])):
+                ax[t][i].imshow(prototypes[i].permute(1, 2, 0), cmap='gray')
+                ax[t][i].axis('off')
+                ax[t][i].set_title(data['task_metadata'][t][i])
+
+        if is_main_process():
+            plt.savefig(trainer.results_dir + '/prototypes.png')
+        plt.close()
+        model.initialize_embeddings(prototypes_inititalization.to(trainer.device))
+        if is_main_process():
+            wandb.log({"all prototypes": wandb.Image(trainer.results_dir + '/prototypes.png')})
+
+    def before_task(self, trainer, t):
+        # logs the prototypes of the task before training on it
+        self.num_evaluations = 0
+        self.evaluate(trainer, trainer.val_loader, t)
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        model, loss_fn, training_config = trainer.model, trainer.loss_fn, self.config['training']
+
+        # the prototypes are classified by evaluate only: their predictions carry no gradient
+        pred = model(x, task_id)
+        prototypes = model.get_prototypes()
+
+        hard_loss = loss_fn(pred, y)
+        # logged only, not part of the objective
+        smoothness_loss = self.tv_loss_fn(prototypes) * training_config['weight_smoothness_loss']
+
+        soft_loss = torch.tensor(0.0, device=trainer.device)
+        if self.previous_model is not None:
+            for old_task_id in range(t):
+                with torch.no_grad():
+                    old_pred = self.previous_model(x, old_task_id)
+                new_prev_pred = model(x, old_task_id)
+                soft_loss += distillation_output_loss(new_prev_pred, old_pred, self.temperature).mean()
+        soft_loss = soft_loss * self.stability
+
+        total_loss = hard_loss + soft_loss
+        return total_loss, pred, {'hard_loss': hard_loss.detach(),
+                                  'soft_loss': soft_loss.detach(),
+                                  'smoothness_loss': smoothness_loss.detach()}
+
+    def evaluate(self, trainer, val_loader, t):
+        avg_val_loss, avg_val_acc, avg_val_loss_prot, avg_val_acc_prot, time = evaluate_model_2d(trainer.model, val_loader,
+                                                                                               loss_fn=trainer.loss_fn,
+                                                                                               device=trainer.device,
+                                                                                               task_metadata=trainer.data['task_metadata'],
+                                                                                               task_id=t)
+        # prototypes rendered and uploaded by the artifact process, every prototype_plot_frequency evaluations
+        if trainer.artifacts is not None and self.prototype_plot_frequency and self.num_evaluations % self.prototype_plot_frequency == 0:
+            trainer.artifacts.submit('prototypes', os.path.join(trainer.results_dir, f'prototypes_{t}_{self.num_evaluations}.png'),
+                                     {'prototypes': trainer.model.get_prototypes(t)},
+                                     wandb_key=f'prototypes_{t}', log={'task': t})
+        self.num_evaluations += 1
+        return {'val_loss': avg_val_loss, 'val_acc': avg_val_acc, 'val_prot_loss': avg_val_loss_prot,
+                'val_prot_accuracy': avg_val_acc_prot, 'time': time}
+
+    def test(self, trainer, t):
+        data = trainer.data
+        metrics_test = test_evaluate_2d(multitask_model=trainer.model,
+                                        selected_test_sets=data['task_test_sets'][:t+1],
+                                        task_test_sets=data['task_test_sets'],
+                                        prev_accs=trainer.prev_test_accs,
+                                        prev_accs_prot=self.prev_test_accs_prot,
+                                        show_taskwise_accuracy=True,
+                                        baseline_taskwise_accs=None,
+                                        model_name=self.name,
+                                        verbose=True,
+                                        batch_size=self.config['dataset']['BATCH_SIZE'],
+                                        results_dir=trainer.results_dir,
+                                        task_id=t,
+                                        task_metadata=data['task_metadata'],
+                                        artifacts=trainer.artifacts,
+                                        evaluator=trainer.evaluator,
+                                        device=trainer.device)
+        self.prev_test_accs_prot.append(metrics_test['task_test_accs_prot'])
+        return metrics_test
+
+    def state_dict(self, trainer):
+        return {**super().state_dict(trainer), 'prev_test_accs_prot': self.prev_test_accs_prot}
+
+    def load_state_dict(self, trainer, state):
+        super().load_state_dict(trainer, state)
+        self.prev_test_accs_prot = state['prev_test_accs_prot']
+
+
+# ------------------ Elastic Weight Consolidation ------------------ #
+
+def loss_scale(trainer):
+    # scale of the loss under fp16 mixed precision, the gradients added by hand must follow it
+    return trainer.grad_scaler.get_scale() if trainer.grad_scaler.is_enabled() else 1.0
+
+
+def build_penalty(flat, weight, training_config):
+    # storage format of the anchors and importance (Fisher / Omega), see regularizers.QuadraticPenalty
+    return QuadraticPenalty(flat, weight,
+                            anchor_dtype=training_config.get('regularizer_anchor_dtype', None),
+                            importance_format=training_config.get('regularizer_importance', None),
+                            topk_fraction=training_config.get('regularizer_topk_fraction', 0.1),
+                            block_size=training_config.get('regularizer_block_size', 256))
+
+
+class EWCStrategy(Strategy):
+    """
+    Elastic Weight Consolidation on MultitaskModel_Baseline_notaskid (single shared head).
+    The Fisher information and the anchor parameters are computed at the end of every task.
+
+    The parameters, anchors and Fisher are kept in flat buffers (regularizers.FlatParameters),
+    the penalty gradient is added to the flat gradient buffer in one op after every backward.
+    With `ewc_online_gamma` the Fisher of the previous tasks is decayed by gamma and summed with
+    the new one (online EWC) instead of being replaced by it.
+    """
+    name = 'EWC'
+    # the gradients are views of the flat gradient buffer, they must survive zero_grad()
+    set_grads_to_none = False
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.ewc_lambda = config['training']['ewc_lambda']
+        self.fisher_sample_size = config['training'].get('fisher_sample_size', 200)
+        self.fisher_chunk_size = config['training'].get('fisher_chunk_size', 32)
+        self.fisher_normalization = config['training'].get('fisher_normalization', 'batch')
+        self.online_gamma = config['training'].get('ewc_online_gamma', None)
+
+    def setup(self, trainer):
+        self.flat = FlatParameters(trainer.model)
+        self.penalty = build_penalty(self.flat, self.ewc_lambda, self.config['training'])
+
+    def before_task(self, trainer, t):
+        self.flat.bind()
+
+    def resume_task(self, trainer, t):
+        self.flat.bind()
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        pred = self.forward(trainer.model, x, task_id)
+        hard_loss = trainer.loss_fn(pred, y)
+
+        # EWC penalty if not the first task, only logged here: its gradient is added in after_backward
+        penalty = torch.tensor(0.0, device=trainer.device)
+        if t > 0 and self.penalty.active:
+            penalty = self.penalty.value()
+
+        return hard_loss + penalty, pred, {'hard_loss': hard_loss.detach(), 'ewc_penalty': penalty}
+
+    def after_backward(self, trainer):
+        if self.penalty.active:
+            self.penalty.add_grad(loss_scale(trainer))
+
+    def after_task(self, trainer, t):
+        # After finishing training task t, compute Fisher and store old params
+        model = trainer.model
+        model.eval()
+        # every rank estimates the Fisher on its shard of the data, the estimates are averaged
+        fisher = self.flat.flatten(compute_fisher(model, trainer.train_loader, trainer.device,
+                                                  sample_size=self.fisher_sample_size // trainer.world_size,
+                                                  chunk_size=self.fisher_chunk_size,
+                                                  normalization=self.fisher_normalization))
+        all_reduce_mean([fisher])
+        if self.online_gamma is not None and self.penalty.active:
+            fisher += self.online_gamma * self.penalty.dense_importance()
+        self.penalty.set(self.flat.params.clone(), fisher)
+        trainer.logger.log(f"EWC state: {self.penalty.nbytes() / 2**20:.1f}MB")
+        model.train()
+
+    def state_dict(self, trainer):
+        state = self.penalty.state_dict()
+        return {'old_params': state['anchor'], 'fisher': state['importance']}
+
+    def load_state_dict(self, trainer, state):
+        if state['old_params'] is not None:
+            self.penalty.load_state_dict({'anchor': state['old_params'], 'importance': state['fisher']})
+
+
+# ------------------ Synaptic Intelligence ------------------ #
+
+class SIStrategy(Strategy):
+    """
+    Synaptic Intelligence on MultitaskModel_Baseline_notaskid (single shared head). The path
+    integral W is accumulated after every optimizer step and consolidated into Omega at the end
+    of every task.
+
+    Parameters, anchors, W and Omega are flat buffers (regularizers.FlatParameters), so the
+    penalty gradient is a single op per step and W is accumulated in place by optimizer step
+    hooks (regularizers.PathIntegral).
+
+    The Omega used by the penalty is reset to zero after the first optimizer step of every task
+    (the per-parameter loop reset it after every step, which has the same effect): the penalty
+    only acts on that first step, and Omega holds the importance of the last task only.
+    """
+    name = 'SI'
+    # the gradients are views of the flat gradient buffer, they must survive zero_grad()
+    set_grads_to_none = False
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.si_lambda = config['training']['si_lambda']
+        self.epsilon = config['training']['si_epsilon']
+
+    def setup(self, trainer):
+        self.flat = FlatParameters(trainer.model)
+        # Omega (importance accumulated over the tasks) and the parameters before the first task
+        self.penalty = build_penalty(self.flat, self.si_lambda / 2, self.config['training'])
+        self.penalty.set(self.flat.params.clone(), torch.zeros_like(self.flat.params))
+        self.path_integral = PathIntegral(self.flat, trainer.optimizer)
+
+    def before_task(self, trainer, t):
+        # Store initial params at start of the task and reset W for this task
+        self.flat.bind()
+        self.current_task = t
+        self.initial_params = self.flat.params.clone()
+        self.path_integral.reset()
+        self.reset_importance = True
+
+    def compute_loss(self, trainer, x, y, task_id, t):
+        pred = self.forward(trainer.model, x, task_id)
+        hard_loss = trainer.loss_fn(pred, y)
+
+        # SI penalty if not the first task, only logged here: its gradient is added in after_backward
+        penalty = torch.tensor(0.0, device=trainer.device)
+        if t > 0:
+            penalty = self.penalty.value()
+
+        return hard_loss + penalty, pred, {'hard_loss': hard_loss.detach(), 'si_penalty': penalty}
+
+    def after_backward(self, trainer):
+        if self.current_task > 0:
+            self.penalty.add_grad(loss_scale(trainer))
+
+    def after_step(self, trainer):
+        # the per-parameter loop reset Omega[n] to zeros after every optimizer step
+        if self.reset_importance:
+            self.penalty.set(self.penalty.anchor, torch.zeros_like(self.flat.params))
+            self.reset_importance = False
+
+    def after_task(self, trainer, t):
+        # After finishing training this task: Omega += W / ((theta_final - theta_init)^2 + epsilon)
+        params = self.flat.params
+        omega = self.penalty.dense_importance() + self.path_integral.W / ((params - self.initial_params).pow(2) + self.epsilon)
+
+        # Set old_params to the parameters at the end of this task
+        self.penalty.set(params.clone(), omega)
+        trainer.logger.log(f"SI state: {self.penalty.nbytes() / 2**20:.1f}MB")
+
+    def state_dict(self, trainer):
+        state = self.penalty.state_dict()
+        return {'Omega': state['importance'], 'old_params': state['anchor'],
+                'initial_params': self.initial_params, 'W': self.path_integral.W}
+
+    def load_state_dict(self, trainer, state):
+        to_flat = lambda x: self.flat.flatten(x) if isinstance(x, dict) else x.to(self.flat.params)
+        self.penalty.load_state_dict({'anchor': state['old_params'], 'importance': state['Omega']})
+        self.initial_params = to_flat(state['initial_params'])
+        self.path_integral.W.copy_(to_flat(state['W']))
+
+    def resume_task(self, trainer, t):
+        # initial_params and W of the task are restored from the checkpoint (Omega already reset
+        # if the task had taken a step, resetting it again is a no-op)
+        self.flat.bind()
+        self.current_task = t
+        self.reset_importance = True
@@ -28,39 +28,13 @@ from networks.backbones import ResNet50, MobileNetV2, EfficientNetB0, ViT, ResNe
 from networks.networks_baseline import MultitaskModel_Baseline, TaskHead_Baseline, TaskHead_simple, MultitaskModel_Baseline_notaskid
 
 from utils import *
+from regularizers import compute_fisher
 
 import optuna
 from optuna.visualization import plot_optimization_history, plot_param_importances
 
 
 # ------------------ EWC Auxiliary Functions ------------------ #
-def compute_fisher(model, dataset_loader, device, sample_size=200):
-    """
-    Compute Fisher Information for EWC.
-    We sample a subset of the dataset (sample_size) to approximate.
-    """
-    model.eval()
-    fisher = {n: torch.zeros(p.shape, device=device) for n, p in model.named_parameters() if p.requires_grad}
-    count = 0
-    for i, (x, y, task_ids) in enumerate(dataset_loader):
-        x, y = x.to(device), y.to(device)
-        model.zero_grad()
-        # Get loss
-        pred = model(x, task_ids[0])
-        loss = F.nll_loss(F.log_softmax(pred, dim=1), y)
-        loss.backward()
-        for n, p in model.named_parameters():
-            if p.requires_grad and p.grad is not None:
-                fisher[n] += p.grad.data.pow(2)
-        count += 1
-        if count * dataset_loader.batch_size >= sample_size:
-            break
-
-    # Average fisher
-    for n in fisher:
-        fisher[n] = fisher[n] / count
-    return fisher
-
 def ewc_loss(model, old_params, fisher, ewc_lambda):
     """
     Compute EWC penalty term.
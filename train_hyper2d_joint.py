@@ -35,6 +35,8 @@ import os
 
 # Functions from utils to help with training and evaluation
 from utils import *
+from artifacts import ArtifactWriter
+from metrics import MetricsLogger, WandbSink
 
 # Import the HyperCMTL_seq model architecture
 from networks.hypernetwork import HyperCMTL_seq, HyperCMTL_seq_simple_2d
@@ -122,6 +124,10 @@ prev_test_accs_prot = []
 logger.log(f"Starting training for {config['logging']['name']}")
 
 with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', config=config, group=config['logging']['group']) as run:
+    # prototype plots are rendered in a separate process and uploaded by the wandb sink thread
+    artifact_logger = MetricsLogger([WandbSink()])
+    artifacts = ArtifactWriter(metrics_logger=artifact_logger)
+    prototype_plot_frequency = config.get('evaluation', {}).get('prototype_plot_frequency', 1)
 
     # if config['model']['initialize_prot_w_images']:
         # wandb.log({"all prototypes": wandb.Image(results_dir + '/prototypes.png')})
@@ -170,19 +176,20 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
         
         if t != 0:
             # Concatenate the training and validation sets
-            task_train = ConcatDataset(extra_ds_train)
+            task_train = concat_task_datasets(extra_ds_train)
             task_val = extra_ds_val[-1]
         else:
             task_train, task_val = extra_ds_train[0], extra_ds_val[0]
         
         
         # build train and validation loaders for the current task:
-        train_loader, val_loader = [utils.data.DataLoader(data,
+        train_loader, val_loader = [batched_loader(data,
                                         batch_size=config['dataset']['BATCH_SIZE'],
                                         shuffle=True)
                                         for data in (task_train, task_val)]
 
-        eval_data = evaluate_model_2d(model, val_loader, loss_fn = loss_fn, device = device, task_metadata = data['task_metadata'], task_id=t, wandb_run = run.id)
+        eval_data = evaluate_model_2d(model, val_loader, loss_fn = loss_fn, device = device, task_metadata = data['task_metadata'], task_id=t)
+        artifacts.submit('prototypes', f'{results_dir}/prototypes_{t}_start.png', {'prototypes': model.get_prototypes(t)}, wandb_key=f'prototypes_{t}', log={'task': t})
         avg_val_loss, avg_val_acc, avg_val_loss_prot, avg_val_acc_prot, time = eval_data
 
         # inner loop over the current task:
@@ -202,12 +209,10 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
                 opt.zero_grad()
 
                 # get the predictions from the model
-                pred, pred_prototypes = model(x, task_id)
+                pred = model(x, task_id)
                 prototypes = model.get_prototypes()
-                y_prototypes = torch.arange(len(data['task_metadata'][int(task_id)]), device=device, dtype=torch.int64)
                 
                 hard_loss = loss_fn(pred, y)
-                prototypes_loss = loss_fn(pred_prototypes, y_prototypes) * config['training']['weight_hard_loss_prototypes']
                 
                 # print(prototypes.shape)
                 smoothness_loss = tv_loss_fn(prototypes) * config['training']['weight_smoothness_loss']
@@ -221,7 +226,7 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
                 accuracy_batch = get_batch_acc(pred, y)
                 
                 wandb.log({'hard_loss': hard_loss.item(), 
-                           'train_loss': total_loss.item(), 'prototype_loss': prototypes_loss.item(),
+                           'train_loss': total_loss.item(),
                            'smoothness_loss': smoothness_loss.item(),
                            'epoch': e, 'task_id': t, 'batch_idx': batch_idx, 'train_accuracy': accuracy_batch})
 
@@ -234,7 +239,9 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
                     progress_bar.set_description((f'E{e} batch loss:{hard_loss:.2f}, batch acc:{accuracy_batch:>5.1%}'))
 
             # evaluate after each epoch on the current task's validation set:
-            eval_data = evaluate_model_2d(model, val_loader, loss_fn = loss_fn, device = device, task_metadata = data['task_metadata'], task_id=t, wandb_run = run.id)
+            eval_data = evaluate_model_2d(model, val_loader, loss_fn = loss_fn, device = device, task_metadata = data['task_metadata'], task_id=t)
+            if prototype_plot_frequency and (e + 1) % prototype_plot_frequency == 0:
+                artifacts.submit('prototypes', f'{results_dir}/prototypes_{t}_{e}.png', {'prototypes': model.get_prototypes(t)}, wandb_key=f'prototypes_{t}', log={'task': t})
             avg_val_loss, avg_val_acc, avg_val_loss_prot, avg_val_acc_prot, time = eval_data
 
             wandb.log({'val_loss': avg_val_loss, 'val_accuracy': avg_val_acc, 
@@ -261,7 +268,7 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
 
         # plot training curves only if validation losses exist
         if config["logging"]["plot_training"] and len(metrics['val_losses']) > 0:
-            training_plot(metrics, show_timesteps=True, results_dir = results_dir + f'/training-t{t}.png')
+            training_plot(metrics, show_timesteps=True, results_dir = results_dir + f'/training-t{t}.png', artifacts = artifacts)
 
         if config["logging"]["verbose"]:
             logger.log(f"Best validation accuracy: {metrics['best_val_acc']:.4f}")
@@ -283,7 +290,7 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
                         results_dir=results_dir,
                         task_id=t,
                         task_metadata=data['task_metadata'],
-                        wandb_run = run.id,
+                        artifacts = artifacts,
                         device=device
                         )
         
@@ -292,6 +299,9 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
         prev_test_accs.append(metrics_test['task_test_accs'])
         prev_test_accs_prot.append(metrics_test['task_test_accs_prot'])
 
+    artifacts.close()
+    artifact_logger.close()
+
     #Log final metrics
     logger.log(f"Task {t} completed!")
     logger.log(f'final metrics: {metrics_test}')
@@ -146,13 +146,13 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
         
         if t != 0:
             # Concatenate the training and validation sets
-            task_train = ConcatDataset(extra_ds_train)
+            task_train = concat_task_datasets(extra_ds_train)
             task_val = extra_ds_val[-1]
         else:
             task_train, task_val = extra_ds_train[0], extra_ds_val[0]
         
         # build train and validation loaders for the current task:
-        train_loader, val_loader = [utils.data.DataLoader(data,
+        train_loader, val_loader = [batched_loader(data,
                                         batch_size=config['dataset']['BATCH_SIZE'],
                                         shuffle=True)
                                         for data in (task_train, task_val)]
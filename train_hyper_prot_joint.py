@@ -144,7 +144,7 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
         
         if t != 0:
             # Concatenate the training and validation sets
-            task_train = ConcatDataset(extra_ds_train)
+            task_train = concat_task_datasets(extra_ds_train)
             task_val = extra_ds_val[-1]
         else:
             task_train, task_val = extra_ds_train[0], extra_ds_val[0]
@@ -153,12 +153,12 @@ with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{name_run}', con
         loss_fn = nn.CrossEntropyLoss()
         
         # Build train and validation loaders for the current task
-        train_loader = DataLoader(
+        train_loader = batched_loader(
             task_train, 
             batch_size=config['dataset']['BATCH_SIZE'], 
             shuffle=True
         )
-        val_loader = DataLoader(
+        val_loader = batched_loader(
             task_val, 
             batch_size=config['dataset']['BATCH_SIZE'], 
             shuffle=False
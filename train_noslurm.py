@@ -1,13 +1,13 @@
 import os
-import subprocess
-from time import sleep
-import threading
+import sys
+
+from networks.weight_store import convert_backbones
+from scheduler import JobQueue, LocalScheduler
 
 # Define your datasets, freeze options, models, and devices
 all_datasets = ["TinyImageNet", "Split-MNIST", "Split-CIFAR100"]
 freeze = ["False", "True"]
 models = ["EWC", "SI"]
-devices = ["0", "1", "2", "3", "4", "5"]
 backbones = ["resnet18", "mobilenetv2", "efficientnetb0", "resnet50"]
 # Mapping of models to their corresponding training and config files
 training_files = {
@@ -30,60 +30,21 @@ config_files = {
     "Hyper2d": "hyper2d.py"
 }
 
-# Set to keep track of busy GPUs
-busy_gpus = set()
-gpu_lock = threading.Lock()
-
-def gpu_is_free(device):
-    """
-    Check if a GPU is free by querying its compute processes.
-    """
-    cmd = f"nvidia-smi -i {device} --query-compute-apps=pid --format=csv,noheader"
-    try:
-        result = subprocess.check_output(cmd, shell=True).decode().strip()
-        return len(result) == 0
-    except subprocess.CalledProcessError as e:
-        print(f"Error checking GPU {device}: {e}")
-        return False
-
-def wait_for_free_gpu():
-    """
-    Wait until a GPU becomes free and return its ID.
-    """
-    while True:
-        for dev in devices:
-            with gpu_lock:
-                if dev in busy_gpus:
-                    continue
-            print(f"Checking GPU {dev}...")
-            if gpu_is_free(dev):
-                print(f"GPU {dev} is free.")
-                with gpu_lock:
-                    busy_gpus.add(dev)
-                return dev
-        print("No free GPUs found. Waiting for 60 seconds...")
-        sleep(60)
+# Resources declared by every job: the scheduler runs as many jobs at once as the cores, memory
+# and GPUs of the machine allow, one job per GPU (on a CPU-only machine the jobs run on the CPU)
+# A request larger than the machine (e.g. 16GB on a smaller one) is clamped to it by the scheduler
+cpus_per_job = 4
+memory_per_job_gb = 16
+max_retries = 1
 
-def monitor_gpus():
-    """
-    Continuously monitor the status of busy GPUs and update the busy_gpus set.
-    """
-    while True:
-        to_remove = set()
-        with gpu_lock:
-            current_busy_gpus = list(busy_gpus)
-        for dev in current_busy_gpus:
-            if gpu_is_free(dev):
-                print(f"GPU {dev} is now free.")
-                to_remove.add(dev)
-        if to_remove:
-            with gpu_lock:
-                busy_gpus.difference_update(to_remove)
-        sleep(30)
+# Persistent job queue: starting this script again only runs the jobs that have not finished
+sweep_dir = "results/sweep"
+os.makedirs(os.path.join(sweep_dir, "configs"), exist_ok=True)
+job_queue = JobQueue(os.path.join(sweep_dir, "jobs.db"))
 
-# Start the GPU monitoring thread
-monitor_thread = threading.Thread(target=monitor_gpus, daemon=True)
-monitor_thread.start()
+# Convert the pretrained weights once, every launched job then memory-maps them from the local
+# weight store (shared page cache, no hub access from the training processes)
+convert_backbones(backbones)
 
 # Iterate over all combinations of freeze options, datasets, and models
 for fr in freeze:
@@ -97,9 +58,7 @@ for fr in freeze:
             }
 
             for model in models:
-                # Wait for a free GPU and get its ID
-                selected_gpu = wait_for_free_gpu()
-                print(f"Starting new job with model={model}, dataset={dataset}, freeze={fr}, backbone={backbone} on GPU={selected_gpu}")
+                name = f"{model}-{dataset}-{backbone}-frozen{fr}"
 
                 # Read and modify the config file
                 config_path = f"configs/{config_files[model]}"
@@ -108,26 +67,14 @@ for fr in freeze:
                     for key, value in changes.items():
                         content = content.replace(key, value)
 
-                # Write the modified config to a temporary file
-                temp_config = f"configs/{config_files[model]}-temp.py"
-                with open(temp_config, "w") as f:
+                # Kept until the sweep is over, the job may be retried
+                job_config = os.path.join(sweep_dir, "configs", f"{name}.py")
+                with open(job_config, "w") as f:
                     f.write(content)
 
-                # Construct the command to run the training script
-                cmd = (
-                    f"CUDA_VISIBLE_DEVICES={selected_gpu} "
-                    f"nohup python {training_files[model]} {temp_config} "
-                    f"> {temp_config}.log 2>&1 &"
-                )
-                print(f"Executing command: {cmd}")
-
-                # Launch the training script in the background
-                subprocess.Popen(cmd, shell=True)
-
-                # Brief pause to allow the system to recognize the new job
-                sleep(15)
-
-                # Remove the temporary config file
-                os.remove(temp_config)
+                if job_queue.add(name, [sys.executable, training_files[model], job_config], cpus=cpus_per_job,
+                                 memory_gb=memory_per_job_gb, device=True, max_retries=max_retries):
+                    print(f"Queued job with model={model}, dataset={dataset}, freeze={fr}, backbone={backbone}")
 
-print("All jobs have been submitted.")
+print(f"Job status: {LocalScheduler(job_queue).run()}")
+job_queue.close()
@@ -0,0 +1,478 @@
+import os
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn as nn
+import wandb
+
+from torch.utils.data import DataLoader, DistributedSampler
+from tqdm import tqdm
+
+from distributed import all_reduce_gradients, average_buffers, broadcast_module, get_rank, get_world_size
+from artifacts import ArtifactWriter
+from evaluation import ContinualEvaluator
+from checkpointing import CheckpointWriter, ModelHistory, get_rng_state, load_checkpoint, set_rng_state
+from metrics import MetricsLogger, build_sinks
+from utils import training_plot
+
+AUTOCAST_DTYPES = {None: None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class EarlyStopping:
+    """
+    Per-task convergence controller on the validation accuracy.
+
+    Args:
+        patience (int, optional): Evaluations without improvement before the task stops. None disables early stopping.
+        min_delta (float, optional): Minimum increase of the validation accuracy counted as an improvement. Default is 0.
+        restore_best (bool, optional): Keep a copy of the best weights and restore them when the task ends. Default is True.
+    """
+    def __init__(self, patience=None, min_delta=0.0, restore_best=True):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+        self.reset()
+
+    @property
+    def enabled(self):
+        return self.patience is not None
+
+    def reset(self):
+        self.best_acc = float('-inf')
+        self.best_epoch = None
+        self.best_state = None
+        self.wait = 0
+
+    def step(self, model, val_acc, epoch):
+        """
+        Records the validation accuracy of an epoch.
+
+        Returns:
+            bool: Whether the task should stop.
+        """
+        if not self.enabled:
+            return False
+
+        if val_acc > self.best_acc + self.min_delta:
+            self.best_acc, self.best_epoch, self.wait = val_acc, epoch, 0
+            if self.restore_best:
+                self.best_state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+        else:
+            self.wait += 1
+        return self.wait >= self.patience
+
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+        self.best_state = None
+
+    def state_dict(self):
+        return {'best_acc': self.best_acc, 'best_epoch': self.best_epoch, 'best_state': self.best_state, 'wait': self.wait}
+
+    def load_state_dict(self, state):
+        self.best_acc, self.best_epoch, self.wait = state['best_acc'], state['best_epoch'], state['wait']
+        self.best_state = state['best_state']
+
+
+class ContinualTrainer:
+    """
+    Task-incremental training engine shared by the train scripts.
+
+    The trainer owns the task loop, the epoch loop, the per-step hot loop, validation, testing,
+    plotting and wandb logging. Everything that is specific to a method (LwF, EWC, SI,
+    hypernetwork, prototypes, ...) lives in a `strategies.Strategy` and is called through its
+    per-step and task-boundary hooks.
+
+    Step metrics stay on the device and are logged through a `metrics.MetricsLogger`, aggregated
+    every `logging.log_frequency` steps, to the sinks listed in `logging.metric_sinks`
+    ('wandb', 'jsonl', 'sqlite'). Without 'wandb' the wandb run is disabled (offline runs).
+
+    Checkpoints (model, optimizer, strategy state such as the LwF teacher or the EWC / SI
+    importances, metrics and RNG state) are written to `<results_dir>/checkpoints` by a
+    background thread: `task_<t>.pt` after every task and `last.pt` every
+    `training.checkpoint_frequency` epochs (0: task boundaries only, None: no checkpoints).
+    Setting `training.resume` to a checkpoint, or to the results folder of a previous run,
+    continues that run from the last completed task or epoch.
+
+    With `logging.model_history`, the model after every task is also kept in
+    `<results_dir>/model_history` (a `checkpointing.ModelHistory`, unchanged tensors stored once)
+    for forgetting analysis, in fp16 for the deltas with `logging.model_history_half`.
+
+    `training.mixed_precision` ('bf16' or 'fp16', None for fp32) runs the training forward and
+    loss under autocast. The weights and optimizer state stay in fp32, the distillation loss and
+    the EWC / SI penalties are accumulated in fp32, and fp16 adds dynamic loss scaling.
+
+    Plots (training curves, task-wise test accuracies, learned prototypes) are rendered and uploaded
+    by an `artifacts.ArtifactWriter` in a separate process and logged through the metrics logger,
+    so the training loop does not wait for matplotlib, the disk or wandb.
+
+    Validation runs every `evaluation.eval_frequency` epochs and after the last one. With
+    `training.early_stopping_patience`, a task stops once the validation accuracy has not improved
+    for that many evaluations, and the weights of its best evaluated epoch are restored
+    (`training.restore_best_weights`).
+
+    After every task, the test sets of the tasks seen so far are evaluated by an
+    `evaluation.ContinualEvaluator` kept for the whole run: unshuffled batches of
+    `evaluation.test_batch_size`, the task head generated once per test set and, with
+    `evaluation.cache_test_features` and a frozen backbone, the backbone features of every test
+    set computed once and reused at the next task boundaries.
+
+    Started by a local launcher (`torchrun --standalone --nproc_per_node N <script> <config>`, see
+    `distributed.init_distributed`), the trainer runs data-parallel on N CPU processes: each
+    task's training data is sharded across the ranks (BATCH_SIZE / N samples per rank and step),
+    gradients are all-reduced before every optimizer step, BatchNorm statistics are averaged
+    after every epoch, and new task heads are broadcast from rank 0, so the model, the LwF
+    teacher and the SI importances stay identical on every rank (the EWC Fisher is averaged
+    over the shards). Validation runs on every rank, testing, logging, plots and checkpoints
+    on rank 0 only.
+
+    Args:
+        model (nn.Module): Model to train.
+        optimizer (torch.optim.Optimizer): Optimizer over the model parameters.
+        strategy (Strategy): Continual learning strategy.
+        data (dict): Dataset dictionary returned by setup_dataset / setup_dataset_prototype / setup_tinyimagenet.
+        config (dict): Full run configuration.
+        device (torch.device): Device to train on.
+        logger (logger): Logger of the run.
+        results_dir (str): Directory where the plots are saved.
+        name_run (str): Name of the wandb run.
+        loss_fn (_Loss, optional): Classification loss. Default is CrossEntropyLoss.
+    """
+    def __init__(self,
+                 model: nn.Module,
+                 optimizer: torch.optim.Optimizer,
+                 strategy,
+                 data,
+                 config,
+                 device,
+                 logger,
+                 results_dir,
+                 name_run,
+                 loss_fn: nn.modules.loss._Loss = nn.CrossEntropyLoss()):
+        self.model = model
+        self.optimizer = optimizer
+        self.strategy = strategy
+        self.data = data
+        self.config = config
+        self.device = device
+        self.logger = logger
+        self.results_dir = results_dir
+        self.name_run = name_run
+        self.loss_fn = loss_fn
+
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.is_main = self.rank == 0
+
+        self.run = None
+        self.metrics_logger = None
+        self.checkpoint_writer = None
+        self.artifacts = None
+        self.evaluator = None
+        self.checkpoint_frequency = config['training'].get('checkpoint_frequency', 0)
+        self.resume = config['training'].get('resume', None)
+        self.model_history = None
+
+        mixed_precision = config['training'].get('mixed_precision', None)
+        if mixed_precision not in AUTOCAST_DTYPES:
+            raise ValueError(f"Unknown mixed precision mode {mixed_precision}, use one of {list(AUTOCAST_DTYPES)}")
+        self.autocast_dtype = AUTOCAST_DTYPES[mixed_precision]
+        # fp16 gradients underflow without loss scaling, bf16 has the exponent range of fp32
+        self.grad_scaler = torch.amp.GradScaler(device.type, enabled=mixed_precision == 'fp16')
+        # None: the whole BATCH_SIZE batch goes through the model at once
+        self.micro_batch_size = config['training'].get('micro_batch_size', None)
+        self.train_sampler = None
+        self.eval_frequency = config.get('evaluation', {}).get('eval_frequency', 1)
+        self.early_stopping = EarlyStopping(patience=config['training'].get('early_stopping_patience', None),
+                                            min_delta=config['training'].get('early_stopping_min_delta', 0.0),
+                                            restore_best=config['training'].get('restore_best_weights', True))
+        self.train_loader, self.val_loader = None, None
+
+        # track metrics for plotting training curves:
+        self.metrics = {'train_losses': [],
+                        'train_accs': [],
+                        'val_losses': [],
+                        'val_accs': [],
+                        'epoch_steps': [], # used for plotting val loss at the correct x-position
+                        'CL_timesteps': [], # used to draw where each new timestep begins
+                        'best_val_acc': 0.0,
+                        'steps_trained': 0,
+                        'soft_losses': [], # distillation loss
+                       }
+        self.prev_test_accs = []
+        self.metrics_test = None
+
+    def fit(self):
+        """
+        Trains on every task of `data['timestep_tasks']` in sequence.
+
+        Returns:
+            dict: Test metrics after the last task (as returned by the strategy's `test`).
+        """
+        config = self.config
+        self.logger.log(f"Starting training for {config['logging']['name']}")
+
+        metric_sinks = config['logging'].get('metric_sinks', ['wandb'])
+        wandb_mode = None if 'wandb' in metric_sinks and self.is_main else 'disabled'
+
+        checkpoint = load_checkpoint(self.resume) if self.resume else None
+        # a resumed run keeps logging to the same wandb run
+        wandb_id = checkpoint.get('wandb_run_id') if checkpoint is not None else None
+
+        with wandb.init(project='HyperCMTL', entity='pilligua2', name=f'{self.name_run}', config=config, group=config['logging']['group'],
+                        mode=wandb_mode, id=wandb_id, resume='allow' if wandb_id else None) as run:
+            self.run = run
+            self.metrics_logger = MetricsLogger(build_sinks(metric_sinks if self.is_main else [], self.results_dir),
+                                                log_frequency=config['logging'].get('log_frequency', 50))
+            if self.is_main:
+                self.artifacts = ArtifactWriter(metrics_logger=self.metrics_logger)
+                self.evaluator = ContinualEvaluator(self.data['task_test_sets'],
+                                                    batch_size=config.get('evaluation', {}).get('test_batch_size', 512),
+                                                    cache_features=config.get('evaluation', {}).get('cache_test_features', True))
+            if self.is_main and (self.checkpoint_frequency is not None or config['logging'].get('model_history', False)):
+                self.checkpoint_writer = CheckpointWriter(os.path.join(self.results_dir, 'checkpoints'))
+            if self.is_main and config['logging'].get('model_history', False):
+                self.model_history = ModelHistory(os.path.join(self.results_dir, 'model_history'),
+                                                  half=config['logging'].get('model_history_half', False))
+            self.strategy.setup(self)
+
+            start_task, start_epoch = 0, 0
+            if checkpoint is not None:
+                start_task, start_epoch = self.load_state_dict(checkpoint)
+                self.logger.log(f"Resuming from {self.resume} at task {start_task}, epoch {start_epoch}")
+
+            try:
+                # outer loop over each task, in sequence
+                for t, (task_train, task_val) in self.data['timestep_tasks'].items():
+                    if t < start_task:
+                        continue
+                    self.train_task(t, task_train, task_val, start_epoch=start_epoch if t == start_task else 0)
+            finally:
+                # the artifact writer logs its last plots through the metrics logger
+                if self.artifacts is not None:
+                    self.artifacts.close()
+                self.metrics_logger.close()
+                if self.checkpoint_writer is not None:
+                    self.checkpoint_writer.close()
+
+            #Log final metrics
+            self.logger.log(f"Task {t} completed!")
+            self.logger.log(f'final metrics: {self.metrics_test}')
+            if self.is_main:
+                wandb.summary.update(self.metrics_test)
+
+        return self.metrics_test
+
+    def train_task(self, t, task_train, task_val, start_epoch=0):
+        config, metrics = self.config, self.metrics
+
+        task_train.num_classes = len(self.data['timestep_task_classes'][t])
+        self.logger.log(f"Task {t}: {task_train.num_classes} classes\n: {self.data['task_metadata'][t]}")
+
+        # build train and validation loaders for the current task:
+        if self.world_size > 1:
+            # every rank trains on its own shard, the gradient is averaged over the full BATCH_SIZE batch
+            self.train_sampler = DistributedSampler(task_train, shuffle=True, seed=config['misc']['seed'])
+            self.train_loader = DataLoader(task_train, batch_size=config['dataset']['BATCH_SIZE'] // self.world_size, sampler=self.train_sampler)
+        else:
+            self.train_sampler = None
+            self.train_loader = DataLoader(task_train, batch_size=config['dataset']['BATCH_SIZE'], shuffle=True)
+        self.val_loader = DataLoader(task_val, batch_size=config['dataset']['BATCH_SIZE'], shuffle=False)
+
+        if start_epoch > 0:
+            self.strategy.resume_task(self, t)
+        else:
+            self.strategy.before_task(self, t)
+        # task heads added by the strategy are initialized independently on every rank
+        broadcast_module(self.model)
+
+        # inner loop over the current task:
+        epochs = config['training']['epochs_per_timestep']
+        if start_epoch == 0:
+            self.early_stopping.reset()
+        e = start_epoch - 1  # last trained epoch, when resuming after the final one
+        for e in range(start_epoch, epochs):
+            if self.train_sampler is not None:
+                self.train_sampler.set_epoch(t * epochs + e)
+            epoch_train_losses, epoch_train_accs, epoch_soft_losses = self.train_epoch(t, e)
+            average_buffers(self.model)
+
+            ### update metrics:
+            metrics['train_losses'].extend(epoch_train_losses)
+            metrics['train_accs'].extend(epoch_train_accs)
+            metrics['soft_losses'].extend(epoch_soft_losses)
+
+            # evaluate every eval_frequency epochs (and after the last one) on the current task's validation set:
+            stop = False
+            if (e + 1) % self.eval_frequency == 0 or e + 1 == epochs:
+                val_metrics = self.strategy.evaluate(self, self.val_loader, t)
+                self.metrics_logger.log({**val_metrics, 'epoch': e, 'task_id': t})
+
+                metrics['epoch_steps'].append(metrics['steps_trained'])
+                metrics['val_losses'].append(val_metrics['val_loss'])
+                metrics['val_accs'].append(val_metrics['val_acc'])
+
+                if config["logging"]["show_progress"]:
+                    # log end-of-epoch stats:
+                    self.logger.log((f'E{e} loss:{np.mean(epoch_train_losses):.2f}|v:{val_metrics["val_loss"]:.2f}' +
+                                     f'| acc t:{np.mean(epoch_train_accs):>5.1%}|v:{val_metrics["val_acc"]:>5.1%} in {val_metrics["time"]:.2f}s'))
+
+                if val_metrics['val_acc'] > metrics['best_val_acc']:
+                    metrics['best_val_acc'] = val_metrics['val_acc']
+
+                stop = self.early_stopping.step(self.model, val_metrics['val_acc'], e)
+
+            if stop:
+                break
+
+            if self.checkpoint_writer is not None and self.checkpoint_frequency and (e + 1) % self.checkpoint_frequency == 0:
+                self.save_checkpoint(t, e + 1, 'last.pt')
+
+        if self.early_stopping.enabled:
+            self.early_stopping.restore(self.model)
+            epochs_saved = epochs - (e + 1)
+            self.logger.log(f"Task {t}: trained {e + 1}/{epochs} epochs ({epochs_saved} saved), "
+                            f"best validation accuracy at epoch {self.early_stopping.best_epoch}")
+            self.metrics_logger.log({'epochs_trained': e + 1, 'epochs_saved': epochs_saved,
+                                     'best_epoch': self.early_stopping.best_epoch, 'task_id': t})
+
+        # this one is important for nice plots:
+        metrics['CL_timesteps'].append(metrics['steps_trained'])
+
+        # plot training curves only if validation losses exist
+        if self.is_main and config["logging"]["plot_training"] and len(metrics['val_losses']) > 0:
+            training_plot(metrics, show_timesteps=True, results_dir=self.results_dir + f'/training-t{t}.png', artifacts=self.artifacts)
+
+        if config["logging"]["verbose"]:
+            self.logger.log(f"Best validation accuracy: {metrics['best_val_acc']:.4f}")
+        metrics['best_val_acc'] = 0.0
+
+        # evaluate on all tasks:
+        if self.is_main:
+            self.metrics_test = self.strategy.test(self, t)
+            self.metrics_logger.log({**self.metrics_test, 'task_id': t})
+            self.prev_test_accs.append(self.metrics_test['task_test_accs'])
+
+        self.strategy.after_task(self, t)
+
+        if self.checkpoint_writer is not None and self.checkpoint_frequency is not None:
+            self.save_checkpoint(t + 1, 0, f'task_{t}.pt')
+        if self.model_history is not None:
+            self.checkpoint_writer.submit(self.model.state_dict(), partial(self.model_history.add, t))
+
+    def train_epoch(self, t, e):
+        """
+        Runs one epoch over the current task's train loader.
+
+        Returns:
+            tuple: Per-step hard losses, accuracies and soft (distillation) losses of the epoch.
+        """
+        self.model.train()
+        show_progress = self.config["logging"]["show_progress"] and self.is_main
+        progress_bar = tqdm(self.train_loader, ncols=100, desc=f"Task {t}, Epoch {e}") if show_progress else self.train_loader
+
+        for batch_idx, (x, y, task_ids) in enumerate(progress_bar):
+            x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
+            task_id = task_ids[0]
+
+            pred, loss_terms = self.train_step(x, y, task_id, t)
+            # kept on the device, read back by the metrics logger every log_frequency steps
+            accuracy_batch = (pred.argmax(axis=1) == y).float().mean()
+
+            self.metrics_logger.log_step({**loss_terms, 'train_accuracy': accuracy_batch}, epoch=e, task_id=t, batch_idx=batch_idx)
+            self.metrics['steps_trained'] += 1
+
+            if show_progress and self.metrics_logger.last:
+                last = self.metrics_logger.last
+                progress_bar.set_description((f'E{e} batch loss:{last["hard_loss"]:.2f}, batch acc:{last["train_accuracy"]:>5.1%}'))
+
+        # track loss and accuracy:
+        history = self.metrics_logger.pop_history()
+        epoch_train_losses, epoch_train_accs = history['hard_loss'], history['train_accuracy']
+        epoch_soft_losses = history.get('soft_loss', [0.0] * len(epoch_train_losses))
+        return epoch_train_losses, epoch_train_accs, epoch_soft_losses
+
+    def train_step(self, x, y, task_id, t):
+        """
+        One optimization step on a batch of the current task.
+
+        With `training.micro_batch_size`, the batch is split into micro-batches whose gradients
+        are accumulated before the single optimizer step. Every loss term (classification,
+        distillation, prototype, penalties) is a mean, so each micro-batch is weighted by its
+        share of the batch and the step matches the one on the full batch (up to BatchNorm
+        statistics, which are computed per micro-batch).
+
+        Returns:
+            tuple: Predictions of the current task head and the dict of (detached) loss terms,
+                including 'train_loss', the total optimized loss.
+        """
+        strategy = self.strategy
+        micro_batch_size = self.micro_batch_size or len(x)
+
+        self.optimizer.zero_grad(set_to_none=strategy.set_grads_to_none)
+        preds, loss_terms = [], {}
+        for x_micro, y_micro in zip(x.split(micro_batch_size), y.split(micro_batch_size)):
+            weight = len(x_micro) / len(x)
+            with torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+                micro_loss, pred, micro_terms = strategy.compute_loss(self, x_micro, y_micro, task_id, t)
+            self.grad_scaler.scale(micro_loss * weight).backward()
+
+            preds.append(pred.detach())
+            for name, value in {**micro_terms, 'train_loss': micro_loss.detach()}.items():
+                loss_terms[name] = loss_terms.get(name, 0.0) + value * weight
+        all_reduce_gradients(self.model)
+        strategy.after_backward(self)
+
+        # gradients are unscaled before clipping and before the strategy reads them in after_step
+        self.grad_scaler.unscale_(self.optimizer)
+        strategy.clip_gradients(self)
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+        strategy.after_step(self)
+
+        return torch.cat(preds), loss_terms
+
+    def state_dict(self, task, epoch):
+        """
+        Full training state. `task` and `epoch` are the position training continues from.
+        """
+        return {'task': task,
+                'epoch': epoch,
+                'model': self.model.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'grad_scaler': self.grad_scaler.state_dict(),
+                'strategy': self.strategy.state_dict(self),
+                'metrics': self.metrics,
+                'prev_test_accs': self.prev_test_accs,
+                'metrics_test': self.metrics_test,
+                'early_stopping': self.early_stopping.state_dict(),
+                'rng': get_rng_state(),
+                'wandb_run_id': self.run.id if self.run is not None else None}
+
+    def load_state_dict(self, checkpoint):
+        """
+        Restores the training state of a checkpoint.
+
+        Returns:
+            tuple: Task and epoch to continue from.
+        """
+        # the strategy goes first, it may add the task heads the model weights refer to
+        self.strategy.load_state_dict(self, checkpoint['strategy'])
+        self.model.load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if checkpoint.get('grad_scaler'):
+            self.grad_scaler.load_state_dict(checkpoint['grad_scaler'])
+
+        self.metrics = checkpoint['metrics']
+        self.prev_test_accs = checkpoint['prev_test_accs']
+        self.metrics_test = checkpoint['metrics_test']
+        if 'early_stopping' in checkpoint:
+            self.early_stopping.load_state_dict(checkpoint['early_stopping'])
+        self.metrics_logger.step = self.metrics['steps_trained']
+
+        # last, building the strategy state may have drawn random numbers
+        set_rng_state(checkpoint['rng'])
+        return checkpoint['task'], checkpoint['epoch']
+
+    def save_checkpoint(self, task, epoch, filename):
+        self.checkpoint_writer.save(self.state_dict(task, epoch), filename)
@@ -3,7 +3,7 @@ import torch
 import matplotlib.pyplot as plt
 import torch.nn as nn
 import torch.utils as utils
-from torch.utils.data import TensorDataset, DataLoader, random_split, ConcatDataset, Subset
+from torch.utils.data import TensorDataset, DataLoader, random_split, ConcatDataset, Subset, BatchSampler, RandomSampler, SequentialSampler
 from torchvision import datasets, transforms
 #from tinyimagenet import TinyImageNet
 import pandas as pd
@@ -22,9 +22,10 @@ from torch.utils.data import Sampler
 import time
 import os
 from easydict import EasyDict 
-from time import sleep
 import shutil
 
+from artifacts import plot_artifact
+
 
 
 def inspect_batch(images, labels=None, predictions=None, class_names=None, title=None,
@@ -158,7 +159,8 @@ def training_plot(metrics,
       baselines=None, # optional list, or named dict, of baseline accuracies to compare to
       show_epochs=False,    # display boundary lines between epochs
       show_timesteps=False, # display discontinuities between CL timesteps
-      results_dir=""
+      results_dir="",
+      artifacts=None
       ):
     """
     Plots training and validation loss/accuracy curves over training steps.
@@ -178,122 +180,18 @@ def training_plot(metrics,
             Can be a list of values or a dictionary with names and values. Defaults to None.
         show_epochs (bool, optional): If True, draws vertical lines at epoch boundaries. Defaults to False.
         show_timesteps (bool, optional): If True, draws vertical lines at Continual Learning timestep boundaries. Defaults to False.
+        results_dir (str): File the plot is saved to.
+        artifacts (ArtifactWriter, optional): Renders the plot in the artifact process instead of on the calling thread.
 
     Returns:
-        None: Displays the generated plot.
+        None: Saves the generated plot.
     """
     for metric_name in 'train_losses', 'val_losses', 'train_accs', 'val_accs', 'epoch_steps':
         assert metric_name in metrics, f"{metric_name} missing from metrics dict"
 
-    fig, (loss_ax, acc_ax) = plt.subplots(1,2)
-
-    # determine where to place boundaries, by calculating steps per epoch and epochs per timestep:
-    steps_per_epoch = int(np.round(len(metrics['train_losses']) / len(metrics['val_losses'])))
-    epochs_per_ts = int(np.round(len(metrics['epoch_steps']) / len(metrics['CL_timesteps'])))
-
-    # if needing to show timesteps, we plot the curves discontinuously:
-    if show_timesteps:
-        # break the single list of metrics into nested sub-lists:
-        timestep_train_losses, timestep_val_losses = [], []
-        timestep_train_accs, timestep_val_accs = [], []
-        timestep_epoch_steps, timestep_soft_losses = [], []
-        prev_ts = 0
-        for t, ts in enumerate(metrics['CL_timesteps']):
-            timestep_train_losses.append(metrics['train_losses'][prev_ts:ts])
-            timestep_train_accs.append(metrics['train_accs'][prev_ts:ts])
-            timestep_val_losses.append(metrics['val_losses'][t*epochs_per_ts:(t+1)*epochs_per_ts])
-            timestep_val_accs.append(metrics['val_accs'][t*epochs_per_ts:(t+1)*epochs_per_ts])
-            timestep_epoch_steps.append(metrics['epoch_steps'][t*epochs_per_ts:(t+1)*epochs_per_ts])
-            if 'soft_losses' in metrics:
-                timestep_soft_losses.append(metrics['soft_losses'][prev_ts:ts])
-            else:
-                timestep_soft_losses.append(None)
-            prev_ts = ts
-    else:
-        # just treat this as one timestep, by making lists of size 1:
-        timestep_train_losses = [metrics['train_losses']]
-        timestep_train_accs = [metrics['train_accs']]
-        timestep_val_losses = [metrics['val_losses']]
-        timestep_val_accs = [metrics['val_accs']]
-        timestep_epoch_steps = [metrics['epoch_steps']]
-        if 'soft_losses' in metrics:
-            timestep_soft_losses = metrics['soft_losses']
-        else:
-            timestep_soft_losses = [None]
-
-    # zip up the individual curves at each timestep:
-    timestep_metrics = zip(timestep_train_losses,
-                          timestep_train_accs,
-                          timestep_val_losses,
-                          timestep_val_accs,
-                          timestep_epoch_steps,
-                          metrics['CL_timesteps'],
-                          timestep_soft_losses)
-
-    for train_losses, train_accs, val_losses, val_accs, epoch_steps, ts, soft_losses in timestep_metrics:
-        ### plot loss:
-        smooth_train_loss = pd.Series(train_losses).ewm(alpha=alpha).mean()
-        steps = np.arange(ts-len(train_losses), ts)
-
-        # train loss is plotted at every step:
-        loss_ax.plot(steps, smooth_train_loss, 'b-', label=f'train loss')
-        # but val loss is plotted at every epoch:
-        loss_ax.plot(epoch_steps, val_losses, 'r-', label=f'val loss')
-
-        ### plot soft loss if given:
-        if soft_losses is not None:
-            smooth_soft_loss = pd.Series(soft_losses).ewm(alpha=alpha).mean()
-            loss_ax.plot(steps, smooth_soft_loss, 'g-', label=f'soft loss')
-
-        ### plot acc:
-        smooth_train_acc = pd.Series(train_accs).ewm(alpha=alpha).mean()
-
-        acc_ax.plot(steps, smooth_train_acc, 'b-', label=f'train acc')
-        acc_ax.plot(epoch_steps, val_accs, 'r-', label=f'val acc')
-
-
-    loss_legend = ['train loss', 'val loss'] if 'soft_loss' not in metrics else ['train loss', 'val loss', 'soft loss']
-    acc_legend = ['train acc', 'val acc']
-
-    loss_ax.legend(loss_legend); loss_ax.set_xlabel(f'Training step'); loss_ax.set_ylabel(f'Loss (CXE)')
-    acc_ax.legend(acc_legend); acc_ax.set_xlabel(f'Training step'); acc_ax.set_ylabel(f'Accuracy')
-
-    # format as percentage on right:
-    acc_ax.yaxis.set_major_formatter(mpl.ticker.PercentFormatter(xmax=1.0))
-    acc_ax.yaxis.tick_right()
-    acc_ax.yaxis.set_label_position('right')
-
-    # optionally, draw lines at baseline accuracy points:
-    if baselines is not None:
-        if type(baselines) is list:
-            for height in baselines:
-                acc_ax.axhline(height, c=[0.8]*3, linestyle=':')
-            # rescale y-axis to accommodate baselines if needed:
-            plt.ylim([0, max(list(smooth_train_acc) + metrics['val_accs'] + baselines)+0.05])
-        elif type(baselines) is dict:
-            for name, height in baselines.items():
-                acc_ax.axhline(height, c=[0.8]*3, linestyle=':')
-                # add text label as well:
-                acc_ax.text(0, height+0.002, name, c=[0.6]*3, size=8)
-            plt.ylim([0, max(list(smooth_train_acc) + metrics['val_accs'] + [h for h in baselines.values()])+0.05])
-
-    # optionally, draw epoch boundaries
-    if show_epochs:
-        for ax in (loss_ax, acc_ax):
-            for epoch in metrics['epoch_steps']:
-                ax.axvline(epoch, c=[0.9]*3, linestyle=':', zorder=1)
-
-    # and/or CL timesteps:
-    if show_timesteps:
-        for ax in (loss_ax, acc_ax):
-            for epoch in metrics['CL_timesteps']:
-                ax.axvline(epoch, c=[.7,.7,.9], linestyle='--', zorder=0)
-
-
-    plt.suptitle(title)
-    plt.tight_layout()
-    plt.savefig(results_dir)
-    plt.close()
+    plot_artifact(artifacts, 'training_curves', results_dir,
+                  {'metrics': metrics, 'title': title, 'alpha': alpha, 'baselines': baselines,
+                   'show_epochs': show_epochs, 'show_timesteps': show_timesteps})
 
 
 def get_batch_acc(pred, y):
@@ -400,10 +298,10 @@ def evaluate_model_2d(multitask_model: nn.Module,  # trained model capable of mu
                    loss_fn: nn.modules.loss._Loss = nn.CrossEntropyLoss(),
                    task_metadata = None,
                    task_id = 0,
-                   wandb_run = None
                   ):
     """
-    Evaluates the model on a validation dataset.
+    Evaluates the model on a validation dataset, and its task head on the learned prototypes.
+    The prototypes do not depend on the batch and are classified once per task.
 
     Args:
         multitask_model (nn.Module): The trained multitask model to evaluate.
@@ -411,22 +309,12 @@ def evaluate_model_2d(multitask_model: nn.Module,  # trained model capable of mu
         loss_fn (_Loss, optional): Loss function to calculate validation loss. Default is CrossEntropyLoss.
 
     Returns:
-        tuple: Average validation loss and accuracy across all batches.
+        tuple: Average validation loss and accuracy across all batches, loss and accuracy on the prototypes, inference time.
     """
     with torch.no_grad():
         batch_val_losses, batch_val_accs = [], []
         batch_val_losses_prototypes, batch_val_accs_prototypes = [], []
-
-        fig, ax = plt.subplots(len(task_metadata[int(task_id)]), 1, figsize=(10, 10))
-        ax = ax.flatten()
-        prototypes = multitask_model.get_prototypes(task_id)
-        for i in range(len(task_metadata[int(task_id)])):
-            ax[i].imshow(prototypes[i].cpu().detach().numpy().reshape(1, 20, 20).transpose(1, 2, 0), cmap='gray')
-            ax[i].axis('off')
-        file_name = f'prototypes_{int(task_id)}_{wandb_run}.png'
-        plt.savefig(file_name)
-        wandb.log({f'prototypes_{int(task_id)}': wandb.Image(file_name), 'task': task_id})
-        plt.close()
+        prototype_preds = {}
 
         time_inf = []
         # Iterate over all batches in the validation DataLoader
@@ -437,9 +325,14 @@ def evaluate_model_2d(multitask_model: nn.Module,  # trained model capable of mu
             start_time = time.time()
 
             # Forward pass with task-specific parameters
-            vpred, vpred_prototypes = multitask_model(vx, task_ids[0])
+            vpred = multitask_model(vx, task_ids[0])
             time_inf.append(time.time() - start_time)
 
+            batch_task_id = int(task_ids[0])
+            if batch_task_id not in prototype_preds:
+                prototype_preds[batch_task_id] = multitask_model.classify_prototypes(batch_task_id)
+            vpred_prototypes = prototype_preds[batch_task_id]
+
             # Calculate loss and accuracy for the batch
             val_loss = loss_fn(vpred, vy)
             vy_prototypes = torch.arange(len(task_metadata[int(task_id)]), device=device, dtype=torch.int64)         
@@ -634,7 +527,8 @@ def test_evaluate_2d(multitask_model: nn.Module,
                   results_dir="",
                   task_id=0,
                   task_metadata=None,
-                  wandb_run = None,
+                  artifacts = None,
+                  evaluator = None,
                  ):
     """
     Evaluates the model on all selected test sets and optionally displays results.
@@ -646,6 +540,9 @@ def test_evaluate_2d(multitask_model: nn.Module,
         baseline_taskwise_accs (list[float], optional): Baseline accuracies for comparison.
         model_name (str, optional): Name of the model to show in plots. Default is ''.
         verbose (bool, optional): If True, prints detailed evaluation results. Default is False.
+        artifacts (ArtifactWriter, optional): Renders and uploads the plots in the artifact process instead of on the calling thread.
+        evaluator (ContinualEvaluator, optional): Evaluation engine over the test sets of all tasks (see evaluation.py).
+            If None, one is built over selected_test_sets with batches of batch_size.
     Returns:
         list[float]: Taskwise accuracies for the selected test sets.
     """
@@ -653,25 +550,24 @@ def test_evaluate_2d(multitask_model: nn.Module,
     
     print(f'{model_name} evaluation on test set of all tasks:'.capitalize())
 
-    task_test_accs = []
-    task_test_accs_prot = []
-    task_test_times = []
-
-    # Iterate over each task's test dataset
-    for t, test_data in enumerate(selected_test_sets):
-        # Create a DataLoader for the current task's test dataset
-        test_loader = utils.data.DataLoader(test_data,
-                                       batch_size=batch_size,
-                                       shuffle=True)
-
-        # Evaluate the model on the current task
-        task_test_loss, task_test_acc, task_test_loss_prot, task_test_acc_prot, time = evaluate_model_2d(multitask_model, test_loader, task_metadata=task_metadata, task_id=task_id, wandb_run=wandb_run, device=device)
-
-        print(f'{task_metadata[t]}: {task_test_acc:.2%}, prototypes acc: {task_test_acc_prot:.2%} in {time:.2f} s')
+    if evaluator is None:
+        # evaluation imports utils
+        from evaluation import ContinualEvaluator
+        evaluator = ContinualEvaluator(selected_test_sets, batch_size=batch_size)
 
-        task_test_accs.append(task_test_acc)
-        task_test_accs_prot.append(task_test_acc_prot)
-        task_test_times.append(time)
+    # Accuracy of every task seen so far, in large unshuffled batches, and of its head on its prototypes
+    task_test_accs, task_test_times = evaluator.evaluate(multitask_model, len(selected_test_sets), device)
+    task_test_accs_prot = []
+    # in eval mode as well: BatchNorm must neither use the prototypes' statistics nor update its running stats
+    was_training = multitask_model.training
+    multitask_model.eval()
+    with torch.no_grad():
+        for t, (task_test_acc, time) in enumerate(zip(task_test_accs, task_test_times)):
+            prototype_labels = torch.arange(len(task_metadata[t]), device=device, dtype=torch.int64)
+            task_test_acc_prot = get_batch_acc(multitask_model.classify_prototypes(t), prototype_labels)
+            print(f'{task_metadata[t]}: {task_test_acc:.2%}, prototypes acc: {task_test_acc_prot:.2%} in {time:.2f} s')
+            task_test_accs_prot.append(task_test_acc_prot)
+    multitask_model.train(was_training)
 
     metrics['task_test_accs'] = task_test_accs        
     AA = np.mean(task_test_accs)
@@ -698,52 +594,18 @@ def test_evaluate_2d(multitask_model: nn.Module,
     
     print(f'\n +++ AA: {AA:.2%}, AA_prot: {AA_prot:.2%}, FM: {FM:.2%}, BWT: {BWT:.2%}, Num_params: {Num_params}, Time_inf: {Time_inf:.2f} +++ ')
 
-    # Plot taskwise accuracy if enabled
-    bar_heights = task_test_accs + [0]*(len(task_test_sets) - len(selected_test_sets))
-    plt.bar(x = range(len(task_test_sets)), height=bar_heights, zorder=1)
-
-    plt.xticks(range(len(task_test_sets)), [','.join(task_classes.values()) for t, task_classes in task_metadata.items()], rotation='vertical')
-
-    plt.axhline(AA, c=[0.4]*3, linestyle=':')
-    plt.text(0, AA+0.002, f'{model_name} (average)', c=[0.4]*3, size=8)
-
-    if prev_accs is not None:
-        for p, prev_acc_list in enumerate(prev_accs):
-            plt.bar(x = range(len(prev_acc_list)), height=prev_acc_list, fc='tab:red', zorder=0, alpha=0.5*((p+1)/len(prev_accs)))
-
-    plt.ylim([0, 1])
-    #plt.tight_layout(rect=[0, 0, 1, 0.95])
-
-    # Save figure to wandb
-    file_path = os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png')
-    plt.savefig(file_path)
-    img = Image.open(file_path)
-    wandb.log({f'taskwise accuracy': wandb.Image(img), 'task': task_id})
-
-    plt.close()
+    # Plot taskwise accuracy, rendered and uploaded by the artifact process
+    task_labels = [','.join(task_classes.values()) for t, task_classes in task_metadata.items()]
+    plot_artifact(artifacts, 'taskwise_accuracy', os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png'),
+                  {'accs': task_test_accs, 'task_labels': task_labels, 'average': AA, 'model_name': model_name,
+                   'prev_accs': prev_accs},
+                  wandb_key='taskwise accuracy', log={'task': task_id})
 
     print(f'\n +++ AVERAGE TASK TEST ACCURACY PROTOTYPES: {AA:.2%} +++ ')
 
-    # Plot taskwise accuracy if enabled
-    bar_heights = task_test_accs_prot + [0]*(len(task_test_sets) - len(selected_test_sets))
-    plt.bar(x = range(len(task_test_sets)), height=bar_heights, zorder=1)
-
-    plt.xticks(range(len(task_test_sets)), [','.join(task_classes.values()) for t, task_classes in task_metadata.items()], rotation='vertical')
-
-    plt.axhline(AA_prot, c=[0.4]*3, linestyle=':')
-
-    for p, prev_acc_list in enumerate(prev_accs_prot):
-        plt.bar(x = range(len(prev_acc_list)), height=prev_acc_list, fc='tab:red', zorder=0, alpha=0.5*((p+1)/len(prev_accs)))
-
-    plt.ylim([0, 1])
-
-    # Save figure to wandb
-    file_path = os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}_prot.png')
-    plt.savefig(file_path)
-    img = Image.open(file_path)
-    wandb.log({f'taskwise accuracy prototypes': wandb.Image(img), 'task': task_id})
-
-    plt.close()
+    plot_artifact(artifacts, 'taskwise_accuracy', os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}_prot.png'),
+                  {'accs': task_test_accs_prot, 'task_labels': task_labels, 'average': AA_prot, 'prev_accs': prev_accs_prot},
+                  wandb_key='taskwise accuracy prototypes', log={'task': task_id})
 
     return metrics
 
@@ -792,7 +654,8 @@ def test_evaluate(multitask_model: nn.Module,
                   task_id=0,
                   task_metadata=None,
                   device=None,
-                  task_prototypes = None
+                  task_prototypes = None,
+                  artifacts = None
                  ):
     """
     Evaluates the model on all selected test sets and optionally displays results.
@@ -804,6 +667,7 @@ def test_evaluate(multitask_model: nn.Module,
         baseline_taskwise_accs (list[float], optional): Baseline accuracies for comparison.
         model_name (str, optional): Name of the model to show in plots. Default is ''.
         verbose (bool, optional): If True, prints detailed evaluation results. Default is False.
+        artifacts (ArtifactWriter, optional): Renders and uploads the plots in the artifact process instead of on the calling thread.
     Returns:
         list[float]: Taskwise accuracies for the selected test sets.
     """
@@ -840,46 +704,14 @@ def test_evaluate(multitask_model: nn.Module,
 
     print(f'\n +++ AVERAGE TASK TEST ACCURACY: {avg_task_test_acc:.2%} +++ ')
 
-    # Plot taskwise accuracy if enabled
+    # Plot taskwise accuracy if enabled, rendered and uploaded by the artifact process
     if show_taskwise_accuracy:
-        bar_heights = task_test_accs + [0]*(len(task_test_sets) - len(selected_test_sets))
-        # display bar plot with accuracy on each evaluation task
-        plt.bar(x = range(len(task_test_sets)), height=bar_heights, zorder=1)
-
-        plt.xticks(
-        range(len(task_test_sets)),
-        [','.join(task_classes.values()) for t, task_classes in task_metadata.items()],
-        rotation='vertical'
-        )
-
-        plt.axhline(avg_task_test_acc, c=[0.4]*3, linestyle=':')
-        plt.text(0, avg_task_test_acc+0.002, f'{model_name} (average)', c=[0.4]*3, size=8)
-
-        if prev_accs is not None:
-            # plot the previous step's accuracies on top
-            # (will show forgetting in red)
-            for p, prev_acc_list in enumerate(prev_accs):
-                plt.bar(x = range(len(prev_acc_list)), height=prev_acc_list, fc='tab:red', zorder=0, alpha=0.5*((p+1)/len(prev_accs)))
-
-        if baseline_taskwise_accs is not None:
-            for t, acc in enumerate(baseline_taskwise_accs):
-                plt.plot([t-0.5, t+0.5], [acc, acc], c='black', linestyle='--')
-
-            # show average as well:
-            baseline_avg = np.mean(baseline_taskwise_accs)
-            plt.axhline(baseline_avg, c=[0.6]*3, linestyle=':')
-            plt.text(0, baseline_avg+0.002, 'baseline average', c=[0.6]*3, size=8)
-
-        plt.ylim([0, 1])
-        #plt.tight_layout(rect=[0, 0, 1, 0.95])
-
-        # Save figure to wandb
-        file_path = os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png')
-        plt.savefig(file_path)
-        img = Image.open(file_path)
-        wandb.log({f'taskwise accuracy': wandb.Image(img), 'task': task_id})
-
-        plt.close()
+        plot_artifact(artifacts, 'taskwise_accuracy', os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png'),
+                      {'accs': task_test_accs,
+                       'task_labels': [','.join(task_classes.values()) for t, task_classes in task_metadata.items()],
+                       'average': avg_task_test_acc, 'model_name': model_name, 'prev_accs': prev_accs,
+                       'baseline_accs': baseline_taskwise_accs},
+                      wandb_key='taskwise accuracy', log={'task': task_id})
 
     return task_test_accs
 
@@ -893,12 +725,15 @@ def test_evaluate_metrics(multitask_model: nn.Module,
                   baseline_taskwise_accs = None, 
                   model_name: str='', 
                   verbose=False, 
-                  batch_size=16,
+                  batch_size=512,
                   results_dir="",
                   task_id=0,
                   task_metadata=None,
                   device=None,
-                  task_prototypes = None
+                  task_prototypes = None,
+                  quantized_model = None,
+                  artifacts = None,
+                  evaluator = None
                  ):
     """
     Evaluates the model on all selected test sets and optionally displays results.
@@ -910,36 +745,31 @@ def test_evaluate_metrics(multitask_model: nn.Module,
         baseline_taskwise_accs (list[float], optional): Baseline accuracies for comparison.
         model_name (str, optional): Name of the model to show in plots. Default is ''.
         verbose (bool, optional): If True, prints detailed evaluation results. Default is False.
+        quantized_model (nn.Module, optional): Int8 CPU version of the model (see networks/quantization.py).
+            If given, it is evaluated on the same test sets and its accuracies, per-task accuracy deltas
+            and latency are added to the metrics with an '_int8' suffix.
+        artifacts (ArtifactWriter, optional): Renders and uploads the plot in the artifact process instead of on the calling thread.
+        evaluator (ContinualEvaluator, optional): Evaluation engine over the test sets of all tasks (see evaluation.py),
+            kept across tasks to reuse the gathered test tensors and the cached features of a frozen backbone.
+            If None, one is built over selected_test_sets with batches of batch_size.
     Returns:
-        list[float]: Taskwise accuracies for the selected test sets.
+        dict: Taskwise accuracies, AA, FM, BWT, Num_params and Time_inf (plus the '_int8' entries).
     """
     metrics = {}
     
     print(f'{model_name} evaluation on test set of all tasks:'.capitalize())
 
-    task_test_losses = []
-    task_test_accs = []
-    task_test_times = []
-
-    # Iterate over each task's test dataset
-    for t, test_data in enumerate(selected_test_sets):
-        # Create a DataLoader for the current task's test dataset
-        test_loader = utils.data.DataLoader(test_data,
-                                       batch_size=batch_size,
-                                       shuffle=True)
-
-        prototypes = None
-        if task_prototypes is not None:
-            prototypes = task_prototypes[t].to(device)
-
-        # Evaluate the model on the current task
-        _, task_test_acc, time = evaluate_model_timed(multitask_model, test_loader, device=device, prototypes = prototypes)
+    if evaluator is None:
+        # evaluation imports utils
+        from evaluation import ContinualEvaluator
+        evaluator = ContinualEvaluator(selected_test_sets, batch_size=batch_size)
 
+    # Accuracy of every task seen so far, in large unshuffled batches
+    task_test_accs, task_test_times = evaluator.evaluate(multitask_model, len(selected_test_sets), device,
+                                                         task_prototypes=task_prototypes)
+    for t, (task_test_acc, time) in enumerate(zip(task_test_accs, task_test_times)):
         print(f'{task_metadata[t]}: {task_test_acc:.2%} in {time:.2f} seconds')
 
-        task_test_accs.append(task_test_acc)
-        task_test_times.append(time)
-
     # print(task_test_times)
     metrics['task_test_accs'] = task_test_accs        
     AA = np.mean(task_test_accs)
@@ -962,170 +792,28 @@ def test_evaluate_metrics(multitask_model: nn.Module,
     
     print(f'\n +++ AA: {AA:.2%}, FM: {FM:.2%}, BWT: {BWT:.2%}, Num_params: {Num_params}, Time_inf: {Time_inf:.2f} +++ ')
 
-    # Plot taskwise accuracy if enabled
-    if show_taskwise_accuracy:
-        bar_heights = task_test_accs + [0]*(len(task_test_sets) - len(selected_test_sets))
-        # display bar plot with accuracy on each evaluation task
-        plt.bar(x = range(len(task_test_sets)), height=bar_heights, zorder=1)
-
-        plt.xticks(
-        range(len(task_test_sets)),
-        [','.join(task_classes.values()) for t, task_classes in task_metadata.items()],
-        rotation='vertical'
-        )
-
-        plt.axhline(AA, c=[0.4]*3, linestyle=':')
-        plt.text(0, AA+0.002, f'{model_name} (average)', c=[0.4]*3, size=8)
-
-        if prev_accs is not None:
-            # plot the previous step's accuracies on top
-            # (will show forgetting in red)
-            for p, prev_acc_list in enumerate(prev_accs):
-                plt.bar(x = range(len(prev_acc_list)), height=prev_acc_list, fc='tab:red', zorder=0, alpha=0.5*((p+1)/len(prev_accs)))
-
-        if baseline_taskwise_accs is not None:
-            for t, acc in enumerate(baseline_taskwise_accs):
-                plt.plot([t-0.5, t+0.5], [acc, acc], c='black', linestyle='--')
-
-            # show average as well:
-            baseline_avg = np.mean(baseline_taskwise_accs)
-            plt.axhline(baseline_avg, c=[0.6]*3, linestyle=':')
-            plt.text(0, baseline_avg+0.002, 'baseline average', c=[0.6]*3, size=8)
-
-        plt.ylim([0, 1])
-        #plt.tight_layout(rect=[0, 0, 1, 0.95])
-
-        # Save figure to wandb
-        file_path = os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png')
-        plt.savefig(file_path)
-        sleep(1)
-        img = Image.open(file_path)
-        wandb.log({f'taskwise accuracy': wandb.Image(img), 'task': task_id})
-
-        plt.close()
+    if quantized_model is not None:
+        # int8 inference always runs on CPU
+        task_test_accs_int8, task_test_times_int8 = evaluator.evaluate(quantized_model, len(selected_test_sets), 'cpu',
+                                                                       task_prototypes=task_prototypes, use_cache=False)
+        for t, (task_test_acc, time) in enumerate(zip(task_test_accs_int8, task_test_times_int8)):
+            print(f'{task_metadata[t]} (int8): {task_test_acc:.2%} ({task_test_acc - task_test_accs[t]:+.2%}) in {time:.2f} seconds')
 
-    return metrics
+        metrics['task_test_accs_int8'] = task_test_accs_int8
+        metrics['task_acc_deltas_int8'] = [acc_q - acc for acc_q, acc in zip(task_test_accs_int8, task_test_accs)]
+        metrics['AA_int8'] = np.mean(task_test_accs_int8)
+        metrics['Time_inf_int8'] = np.mean(task_test_times_int8)
 
+        print(f' +++ int8 AA: {metrics["AA_int8"]:.2%} ({metrics["AA_int8"] - AA:+.2%}), Time_inf: {metrics["Time_inf_int8"]:.2f} +++ ')
 
-# Evaluate the model on the test sets of all tasks
-def test_evaluate_metrics(multitask_model: nn.Module, 
-                  selected_test_sets,  
-                  task_test_sets, 
-                  prev_accs = None,
-                  show_taskwise_accuracy=True, 
-                  baseline_taskwise_accs = None, 
-                  model_name: str='', 
-                  verbose=False, 
-                  batch_size=16,
-                  results_dir="",
-                  task_id=0,
-                  task_metadata=None,
-                  device=None,
-                  task_prototypes = None
-                 ):
-    """
-    Evaluates the model on all selected test sets and optionally displays results.
-    Args:
-        multitask_model (nn.Module): The trained multitask model to evaluate.
-        selected_test_sets (list[Dataset]): List of test datasets for each task.
-        prev_accs (list[list[float]], optional): Previous accuracies for tracking forgetting.
-        show_taskwise_accuracy (bool, optional): If True, plots a bar chart of taskwise accuracies.
-        baseline_taskwise_accs (list[float], optional): Baseline accuracies for comparison.
-        model_name (str, optional): Name of the model to show in plots. Default is ''.
-        verbose (bool, optional): If True, prints detailed evaluation results. Default is False.
-    Returns:
-        list[float]: Taskwise accuracies for the selected test sets.
-    """
-    metrics = {}
-    
-    print(f'{model_name} evaluation on test set of all tasks:'.capitalize())
-
-    task_test_losses = []
-    task_test_accs = []
-    task_test_times = []
-
-    # Iterate over each task's test dataset
-    for t, test_data in enumerate(selected_test_sets):
-        # Create a DataLoader for the current task's test dataset
-        test_loader = utils.data.DataLoader(test_data,
-                                       batch_size=batch_size,
-                                       shuffle=True)
-
-        prototypes = None
-        if task_prototypes is not None:
-            prototypes = task_prototypes[t].to(device)
-
-        # Evaluate the model on the current task
-        _, task_test_acc, time = evaluate_model_timed(multitask_model, test_loader, device=device, prototypes = prototypes)
-
-        print(f'{task_metadata[t]}: {task_test_acc:.2%} in {time:.2f} seconds')
-
-        task_test_accs.append(task_test_acc)
-        task_test_times.append(time)
-
-    # print(task_test_times)
-    metrics['task_test_accs'] = task_test_accs        
-    AA = np.mean(task_test_accs)
-    metrics['AA'] = AA
-    
-    if t > 0:
-        FM, BWT = compute_FM_BWT(task_test_accs, prev_accs)
-        metrics['FM'] = FM
-        metrics['BWT'] = BWT
-    else:
-        FM = 0
-        BWT = 0
-        metrics['FM'] = FM
-        metrics['BWT'] = BWT
-    
-    Num_params = sum(p.numel() for p in multitask_model.parameters())
-    Time_inf = np.mean(task_test_times)
-    metrics['Num_params'] = Num_params
-    metrics['Time_inf'] = Time_inf
-    
-    print(f'\n +++ AA: {AA:.2%}, FM: {FM:.2%}, BWT: {BWT:.2%}, Num_params: {Num_params}, Time_inf: {Time_inf:.2f} +++ ')
-
-    # Plot taskwise accuracy if enabled
+    # Plot taskwise accuracy if enabled, rendered and uploaded by the artifact process
     if show_taskwise_accuracy:
-        bar_heights = task_test_accs + [0]*(len(task_test_sets) - len(selected_test_sets))
-        # display bar plot with accuracy on each evaluation task
-        plt.bar(x = range(len(task_test_sets)), height=bar_heights, zorder=1)
-
-        plt.xticks(
-        range(len(task_test_sets)),
-        [','.join(task_classes.values()) for t, task_classes in task_metadata.items()],
-        rotation='vertical'
-        )
-
-        plt.axhline(AA, c=[0.4]*3, linestyle=':')
-        plt.text(0, AA+0.002, f'{model_name} (average)', c=[0.4]*3, size=8)
-
-        if prev_accs is not None:
-            # plot the previous step's accuracies on top
-            # (will show forgetting in red)
-            for p, prev_acc_list in enumerate(prev_accs):
-                plt.bar(x = range(len(prev_acc_list)), height=prev_acc_list, fc='tab:red', zorder=0, alpha=0.5*((p+1)/len(prev_accs)))
-
-        if baseline_taskwise_accs is not None:
-            for t, acc in enumerate(baseline_taskwise_accs):
-                plt.plot([t-0.5, t+0.5], [acc, acc], c='black', linestyle='--')
-
-            # show average as well:
-            baseline_avg = np.mean(baseline_taskwise_accs)
-            plt.axhline(baseline_avg, c=[0.6]*3, linestyle=':')
-            plt.text(0, baseline_avg+0.002, 'baseline average', c=[0.6]*3, size=8)
-
-        plt.ylim([0, 1])
-        #plt.tight_layout(rect=[0, 0, 1, 0.95])
-
-        # Save figure to wandb
-        file_path = os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png')
-        plt.savefig(file_path)
-        sleep(1)
-        img = Image.open(file_path)
-        wandb.log({f'taskwise accuracy': wandb.Image(img), 'task': task_id})
-
-        plt.close()
+        plot_artifact(artifacts, 'taskwise_accuracy', os.path.join(results_dir, f'taskwise_accuracy_task_{task_id}.png'),
+                      {'accs': task_test_accs,
+                       'task_labels': [','.join(task_classes.values()) for t, task_classes in task_metadata.items()],
+                       'average': AA, 'model_name': model_name, 'prev_accs': prev_accs,
+                       'baseline_accs': baseline_taskwise_accs},
+                      wandb_key='taskwise accuracy', log={'task': task_id})
 
     return metrics
 
@@ -1620,7 +1308,40 @@ class MinimumSubsetBatchSampler(Sampler):
     def __len__(self):
         min_class_len = min(len(indices) for indices in self.class_to_indices.values())
         return min_class_len
-    
+
+
+def dataset_tensors(dataset):
+    """
+    Returns the tensors (images, labels, task ids) of a TensorDataset, a Subset of one
+    (e.g. from random_split) or a ConcatDataset of those, gathered with one vectorized index per tensor.
+    """
+    if isinstance(dataset, TensorDataset):
+        return dataset.tensors
+    if isinstance(dataset, Subset):
+        indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+        return tuple(tensor[indices] for tensor in dataset_tensors(dataset.dataset))
+    if isinstance(dataset, ConcatDataset):
+        return tuple(torch.cat(tensors) for tensors in zip(*[dataset_tensors(d) for d in dataset.datasets]))
+    raise TypeError(f"Cannot gather the tensors of a {type(dataset).__name__}")
+
+
+def concat_task_datasets(datasets):
+    """
+    Concatenates the per-task datasets into one contiguous TensorDataset (images, labels, task ids).
+    Replaces ConcatDataset for joint training: a sample is one index into each tensor instead of a
+    bisect over the cumulative sizes, a Subset indirection and then the tensor index.
+    """
+    return TensorDataset(*[torch.cat(tensors) for tensors in zip(*[dataset_tensors(d) for d in datasets])])
+
+
+def batched_loader(dataset, batch_size, shuffle=False, drop_last=False, **kwargs):
+    """
+    DataLoader that fetches a whole batch with one indexing call (dataset[list_of_indices]) instead of
+    one __getitem__ per sample followed by collate. Works for TensorDataset, and Subsets of it.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=drop_last), batch_size=None, **kwargs)
+
     
 def setup_dataset_prototype(dataset_name, data_dir='./data', num_tasks=10, val_frac=0.1, test_frac=0.1, batch_size=256):
     """
@@ -1887,6 +1608,9 @@ def distillation_output_loss(student_pred, teacher_pred, temperature):
     Returns:
         torch.Tensor: Distillation loss per example in the batch (batch,).
     """
+    # Accumulated in fp32, also when the predictions come from an autocast (bf16 / fp16) forward
+    student_pred, teacher_pred = student_pred.float(), teacher_pred.float()
+
     # Apply temperature-scaled softmax to student and teacher predictions
     student_soft = temperature_softmax(student_pred, temperature)
     teacher_soft = temperature_softmax(teacher_pred, temperature)